@@ -13,6 +13,11 @@ class ViolationAdmin(admin.ModelAdmin):
                     "timestamp", "expiration", "is_base_status"]
 
 
+@admin.register(models.Notification)
+class NotificationAdmin(admin.ModelAdmin):
+    list_display = ["violation", "created", "attempts", "sent"]
+
+
 @admin.register(models.Target)
 class TargetAdmin(admin.ModelAdmin):
     list_display = ["username", "host"]
@@ -0,0 +1,145 @@
+"""
+A compact binary encoding of promclient.Matrix lists, used to store usage snapshots.
+
+    MAGIC | zlib(
+        header      <BIII   version, string count, series count, total point count
+        strings     uint32 lengths, then the utf-8 bytes of every distinct label name and value
+        series      uint32 label counts, uint32 point counts, int64 first timestamps (ms)
+        labels      uint32 (name, value) string indices of every series
+        timestamps  int32 ms since the series' previous point, 0 for the first
+        values      float32
+    )
+
+Columns are stored contiguously so they decode straight into NumPy arrays.
+"""
+
+import zlib
+import struct
+from typing import NamedTuple
+
+import numpy as np
+
+from arbiter3.arbiter.promclient import Matrix, ColumnarMatrix, Series
+
+MAGIC = b"ARBM"
+VERSION = 1
+HEADER = struct.Struct("<BIII")
+
+
+class MatrixArrays(NamedTuple):
+    """
+    Decoded matrices as arrays. Series i is labels[i] with points offsets[i]:offsets[i + 1]
+    of timestamps (float seconds) and values.
+    """
+    labels: list[dict[str, str]]
+    offsets: np.ndarray
+    timestamps: np.ndarray
+    values: np.ndarray
+
+    def series(self, i: int) -> tuple[np.ndarray, np.ndarray]:
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.timestamps[start:end], self.values[start:end]
+
+
+def encode_matrices(matrices: list[Matrix | ColumnarMatrix], level: int = 6) -> bytes:
+    strings: dict[str, int] = {}
+    label_indices, label_counts, point_counts, firsts = [], [], [], []
+    timestamps, values = [], []
+
+    for matrix in matrices:
+        for name, value in matrix.metric.items():
+            label_indices.append(strings.setdefault(name, len(strings)))
+            label_indices.append(strings.setdefault(value, len(strings)))
+        label_counts.append(len(matrix.metric))
+
+        columns = ColumnarMatrix.from_matrix(matrix)
+        stamps = np.rint(columns.timestamps * 1000).astype(np.int64)
+        point_counts.append(len(stamps))
+        firsts.append(stamps[0] if len(stamps) else 0)
+        timestamps.append(np.diff(stamps, prepend=stamps[:1]))
+        values.append(columns.samples.astype(np.float32))
+
+    encoded_strings = [string.encode() for string in strings]
+    deltas = np.concatenate(timestamps) if timestamps else np.empty(0, dtype=np.int64)
+    if deltas.size and (deltas.max() > np.iinfo(np.int32).max or deltas.min() < np.iinfo(np.int32).min):
+        raise ValueError("gap between samples is too large to encode")
+
+    body = b"".join((
+        HEADER.pack(VERSION, len(encoded_strings), len(matrices), int(deltas.size)),
+        np.array([len(s) for s in encoded_strings], dtype="<u4").tobytes(),
+        b"".join(encoded_strings),
+        np.array(label_counts, dtype="<u4").tobytes(),
+        np.array(point_counts, dtype="<u4").tobytes(),
+        np.array(firsts, dtype="<i8").tobytes(),
+        np.array(label_indices, dtype="<u4").tobytes(),
+        deltas.astype("<i4").tobytes(),
+        (np.concatenate(values) if values else np.empty(0)).astype("<f4").tobytes(),
+    ))
+    return MAGIC + zlib.compress(body, level)
+
+
+def decode_arrays(data: bytes) -> MatrixArrays:
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("not an encoded matrix")
+    body = memoryview(zlib.decompress(data[len(MAGIC):]))
+
+    version, n_strings, n_series, n_points = HEADER.unpack_from(body)
+    if version != VERSION:
+        raise ValueError(f"unsupported matrix encoding version {version}")
+    position = HEADER.size
+
+    def take(dtype: str, count: int) -> np.ndarray:
+        nonlocal position
+        array = np.frombuffer(body, dtype=dtype, count=count, offset=position)
+        position += array.nbytes
+        return array
+
+    lengths = take("<u4", n_strings)
+    strings = []
+    for length in lengths.tolist():
+        strings.append(bytes(body[position:position + length]).decode())
+        position += length
+
+    label_counts = take("<u4", n_series)
+    point_counts = take("<u4", n_series)
+    firsts = take("<i8", n_series)
+    label_indices = take("<u4", int(label_counts.sum()) * 2).tolist()
+    deltas = take("<i4", n_points)
+    values = take("<f4", n_points)
+
+    labels, i = [], 0
+    for count in label_counts.tolist():
+        labels.append({strings[label_indices[j]]: strings[label_indices[j + 1]] for j in range(i, i + 2 * count, 2)})
+        i += 2 * count
+
+    offsets = np.zeros(n_series + 1, dtype=np.int64)
+    np.cumsum(point_counts, out=offsets[1:])
+
+    # put each series' first timestamp in place of its leading 0 delta, then restart the running sum at each series
+    deltas = deltas.astype(np.int64)
+    nonempty = point_counts > 0
+    starts = offsets[:-1][nonempty]
+    deltas[starts] = firsts[nonempty]
+    stamps = np.cumsum(deltas)
+    if starts.size:
+        stamps -= np.repeat(np.concatenate(([0], stamps[starts[1:] - 1])), point_counts[nonempty])
+
+    return MatrixArrays(labels, offsets, stamps / 1000, values)
+
+
+def decode_matrices(data: bytes) -> list[Matrix]:
+    arrays = decode_arrays(data)
+    matrices = []
+    for i, labels in enumerate(arrays.labels):
+        timestamps, values = arrays.series(i)
+        matrices.append(Matrix(labels, [Series(t, v) for t, v in zip(timestamps.tolist(), values.tolist())]))
+    return matrices
+
+
+def decode_columns(data: bytes) -> list[ColumnarMatrix]:
+    arrays = decode_arrays(data)
+    columns = []
+    for i, labels in enumerate(arrays.labels):
+        timestamps, values = arrays.series(i)
+        columns.append(ColumnarMatrix(labels, timestamps, values.astype(np.float64)))
+    return columns
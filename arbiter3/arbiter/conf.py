@@ -130,6 +130,48 @@ except AssertionError:
     raise ImproperlyConfigured("setting ARBITER_EMAIL_TEMPLATE_DIR is a string")
 
 
+try:
+    ARBITER_NOTIFICATION_WORKERS = getattr(settings, "ARBITER_NOTIFICATION_WORKERS", 4)
+    assert isinstance(ARBITER_NOTIFICATION_WORKERS, int) and ARBITER_NOTIFICATION_WORKERS > 0
+except AssertionError:
+    raise ImproperlyConfigured("setting ARBITER_NOTIFICATION_WORKERS is a positive integer")
+
+try:
+    ARBITER_NOTIFICATION_RATE = getattr(settings, "ARBITER_NOTIFICATION_RATE", 60)
+    assert isinstance(ARBITER_NOTIFICATION_RATE, int) and ARBITER_NOTIFICATION_RATE >= 0
+except AssertionError:
+    raise ImproperlyConfigured("setting ARBITER_NOTIFICATION_RATE is a non-negative integer")
+
+try:
+    ARBITER_NOTIFICATION_RETRIES = getattr(settings, "ARBITER_NOTIFICATION_RETRIES", 5)
+    assert isinstance(ARBITER_NOTIFICATION_RETRIES, int) and ARBITER_NOTIFICATION_RETRIES > 0
+except AssertionError:
+    raise ImproperlyConfigured("setting ARBITER_NOTIFICATION_RETRIES is a positive integer")
+
+try:
+    ARBITER_RENDER_WORKERS = getattr(settings, "ARBITER_RENDER_WORKERS", 2)
+    assert isinstance(ARBITER_RENDER_WORKERS, int) and ARBITER_RENDER_WORKERS > 0
+except AssertionError:
+    raise ImproperlyConfigured("setting ARBITER_RENDER_WORKERS is a positive integer")
+
+try:
+    ARBITER_GRAPH_CACHE = getattr(settings, "ARBITER_GRAPH_CACHE", "default")
+    assert isinstance(ARBITER_GRAPH_CACHE, str) and ARBITER_GRAPH_CACHE in settings.CACHES
+except AssertionError:
+    raise ImproperlyConfigured("setting ARBITER_GRAPH_CACHE is the name of a cache in CACHES")
+
+try:
+    ARBITER_GRAPH_CACHE_TTL = getattr(settings, "ARBITER_GRAPH_CACHE_TTL", 30)
+    assert isinstance(ARBITER_GRAPH_CACHE_TTL, int) and ARBITER_GRAPH_CACHE_TTL >= 0
+except AssertionError:
+    raise ImproperlyConfigured("setting ARBITER_GRAPH_CACHE_TTL is a non-negative integer")
+
+try:
+    ARBITER_GRAPH_CACHE_HISTORICAL_TTL = getattr(settings, "ARBITER_GRAPH_CACHE_HISTORICAL_TTL", 24 * 60 * 60)
+    assert isinstance(ARBITER_GRAPH_CACHE_HISTORICAL_TTL, int) and ARBITER_GRAPH_CACHE_HISTORICAL_TTL >= 0
+except AssertionError:
+    raise ImproperlyConfigured("setting ARBITER_GRAPH_CACHE_HISTORICAL_TTL is a non-negative integer")
+
 if ARBITER_ADMIN_EMAILS and EMAIL_HOST is None:
     raise ImproperlyConfigured("setting EMAIL_HOST is required if ARBITER_ADMIN_EMAILS is not empty")
 
@@ -179,8 +221,79 @@ except AttributeError:
 except AssertionError:
     raise ImproperlyConfigured("setting PROMETHEUS_PASSWORD is a string or None")
 
-from arbiter3.arbiter.promclient import PrometheusSession
-PROMETHEUS_CONNECTION = PrometheusSession(base_url=PROMETHEUS_URL, username=PROMETHEUS_USERNAME, password=PROMETHEUS_PASSWORD, verify=PROMETHEUS_VERIFY_SSL)
+try:
+    PROMETHEUS_QUERY_WORKERS = getattr(settings, "PROMETHEUS_QUERY_WORKERS", 8)
+    assert isinstance(PROMETHEUS_QUERY_WORKERS, int) and PROMETHEUS_QUERY_WORKERS > 0
+except AssertionError:
+    raise ImproperlyConfigured("setting PROMETHEUS_QUERY_WORKERS is a positive integer")
+
+try:
+    PROMETHEUS_QUERY_TIMEOUT = getattr(settings, "PROMETHEUS_QUERY_TIMEOUT", 30)
+    assert isinstance(PROMETHEUS_QUERY_TIMEOUT, int) and PROMETHEUS_QUERY_TIMEOUT > 0
+except AssertionError:
+    raise ImproperlyConfigured("setting PROMETHEUS_QUERY_TIMEOUT is a positive integer")
+
+try:
+    PROMETHEUS_RETRIES = getattr(settings, "PROMETHEUS_RETRIES", 2)
+    assert isinstance(PROMETHEUS_RETRIES, int) and PROMETHEUS_RETRIES >= 0
+except AssertionError:
+    raise ImproperlyConfigured("setting PROMETHEUS_RETRIES is a non-negative integer")
+
+try:
+    PROMETHEUS_RETRY_BACKOFF = getattr(settings, "PROMETHEUS_RETRY_BACKOFF", 0.5)
+    assert isinstance(PROMETHEUS_RETRY_BACKOFF, (int, float)) and PROMETHEUS_RETRY_BACKOFF >= 0
+except AssertionError:
+    raise ImproperlyConfigured("setting PROMETHEUS_RETRY_BACKOFF is a non-negative number of seconds")
+
+try:
+    PROMETHEUS_HEDGE_PERCENTILE = getattr(settings, "PROMETHEUS_HEDGE_PERCENTILE", None)
+    if PROMETHEUS_HEDGE_PERCENTILE is not None:
+        assert isinstance(PROMETHEUS_HEDGE_PERCENTILE, (int, float)) and 0 < PROMETHEUS_HEDGE_PERCENTILE < 100
+except AssertionError:
+    raise ImproperlyConfigured("setting PROMETHEUS_HEDGE_PERCENTILE is a number between 0 and 100 or None")
+
+try:
+    PROMETHEUS_BREAKER_THRESHOLD = getattr(settings, "PROMETHEUS_BREAKER_THRESHOLD", 5)
+    assert isinstance(PROMETHEUS_BREAKER_THRESHOLD, int) and PROMETHEUS_BREAKER_THRESHOLD > 0
+except AssertionError:
+    raise ImproperlyConfigured("setting PROMETHEUS_BREAKER_THRESHOLD is a positive integer")
+
+try:
+    PROMETHEUS_BREAKER_RESET = getattr(settings, "PROMETHEUS_BREAKER_RESET", 30)
+    assert isinstance(PROMETHEUS_BREAKER_RESET, (int, float)) and PROMETHEUS_BREAKER_RESET > 0
+except AssertionError:
+    raise ImproperlyConfigured("setting PROMETHEUS_BREAKER_RESET is a positive number of seconds")
+
+from arbiter3.arbiter.resilience import QueryPolicy, CircuitBreaker
+PROMETHEUS_QUERY_POLICY = QueryPolicy(
+    retries=PROMETHEUS_RETRIES,
+    backoff=PROMETHEUS_RETRY_BACKOFF,
+    hedge_percentile=PROMETHEUS_HEDGE_PERCENTILE,
+    breaker=CircuitBreaker(threshold=PROMETHEUS_BREAKER_THRESHOLD, reset_timeout=PROMETHEUS_BREAKER_RESET),
+    hedge_workers=PROMETHEUS_QUERY_WORKERS,
+)
+
+try:
+    PROMETHEUS_POST_THRESHOLD = getattr(settings, "PROMETHEUS_POST_THRESHOLD", 2048)
+    if PROMETHEUS_POST_THRESHOLD is not None:
+        assert isinstance(PROMETHEUS_POST_THRESHOLD, int) and PROMETHEUS_POST_THRESHOLD >= 0
+except AssertionError:
+    raise ImproperlyConfigured("setting PROMETHEUS_POST_THRESHOLD is a non-negative integer or None")
+
+from arbiter3.arbiter.promclient import PrometheusSession, AsyncPrometheusSession, DECODERS, get_decoder
+
+try:
+    PROMETHEUS_DECODER = getattr(settings, "PROMETHEUS_DECODER", "auto")
+    assert PROMETHEUS_DECODER == "auto" or PROMETHEUS_DECODER in DECODERS
+    PROMETHEUS_RESPONSE_DECODER = get_decoder(PROMETHEUS_DECODER)
+except AssertionError:
+    raise ImproperlyConfigured(f"setting PROMETHEUS_DECODER is one of 'auto', {', '.join(repr(name) for name in DECODERS)}")
+except ValueError as e:
+    raise ImproperlyConfigured(f"setting PROMETHEUS_DECODER is 'orjson' but {e}")
+
+# both connections share the policy, so either one's failures open the circuit breaker for both
+PROMETHEUS_CONNECTION = PrometheusSession(base_url=PROMETHEUS_URL, username=PROMETHEUS_USERNAME, password=PROMETHEUS_PASSWORD, verify=PROMETHEUS_VERIFY_SSL, decoder=PROMETHEUS_RESPONSE_DECODER, policy=PROMETHEUS_QUERY_POLICY, default_timeout=PROMETHEUS_QUERY_TIMEOUT, post_threshold=PROMETHEUS_POST_THRESHOLD)
+PROMETHEUS_ASYNC_CONNECTION = AsyncPrometheusSession(base_url=PROMETHEUS_URL, username=PROMETHEUS_USERNAME, password=PROMETHEUS_PASSWORD, verify=PROMETHEUS_VERIFY_SSL, decoder=PROMETHEUS_RESPONSE_DECODER, max_connections=PROMETHEUS_QUERY_WORKERS, policy=PROMETHEUS_QUERY_POLICY, default_timeout=PROMETHEUS_QUERY_TIMEOUT, post_threshold=PROMETHEUS_POST_THRESHOLD)
 
 ########## WARDEN SETTINGS ##########
 
@@ -192,6 +305,12 @@ except AttributeError:
 except AssertionError:
     raise ImproperlyConfigured("setting WARDEN_JOB is a string")
 
+try:
+    WARDEN_INVENTORY_REFRESH = getattr(settings, "WARDEN_INVENTORY_REFRESH", 0)
+    assert isinstance(WARDEN_INVENTORY_REFRESH, int) and WARDEN_INVENTORY_REFRESH >= 0
+except AssertionError:
+    raise ImproperlyConfigured("setting WARDEN_INVENTORY_REFRESH is a non-negative integer")
+
 try:
     WARDEN_PORT = settings.WARDEN_PORT
     assert isinstance(WARDEN_PORT, int)
@@ -232,3 +351,33 @@ except AttributeError:
     raise ImproperlyConfigured("setting WARDEN_RUNTIME is required")
 except AssertionError:
     raise ImproperlyConfigured("setting WARDEN_RUNTIME is a bool")
+
+try:
+    WARDEN_BATCH_SIZE = getattr(settings, "WARDEN_BATCH_SIZE", 0)
+    assert isinstance(WARDEN_BATCH_SIZE, int) and WARDEN_BATCH_SIZE >= 0
+except AssertionError:
+    raise ImproperlyConfigured("setting WARDEN_BATCH_SIZE is a non-negative integer")
+
+try:
+    WARDEN_MAX_CONNECTIONS = getattr(settings, "WARDEN_MAX_CONNECTIONS", 100)
+    assert isinstance(WARDEN_MAX_CONNECTIONS, int) and WARDEN_MAX_CONNECTIONS > 0
+except AssertionError:
+    raise ImproperlyConfigured("setting WARDEN_MAX_CONNECTIONS is a positive integer")
+
+try:
+    WARDEN_CONNECTIONS_PER_HOST = getattr(settings, "WARDEN_CONNECTIONS_PER_HOST", 4)
+    assert isinstance(WARDEN_CONNECTIONS_PER_HOST, int) and WARDEN_CONNECTIONS_PER_HOST > 0
+except AssertionError:
+    raise ImproperlyConfigured("setting WARDEN_CONNECTIONS_PER_HOST is a positive integer")
+
+try:
+    WARDEN_KEEPALIVE_TIMEOUT = getattr(settings, "WARDEN_KEEPALIVE_TIMEOUT", 120)
+    assert isinstance(WARDEN_KEEPALIVE_TIMEOUT, int) and WARDEN_KEEPALIVE_TIMEOUT >= 0
+except AssertionError:
+    raise ImproperlyConfigured("setting WARDEN_KEEPALIVE_TIMEOUT is a non-negative integer")
+
+try:
+    WARDEN_DNS_CACHE_TTL = getattr(settings, "WARDEN_DNS_CACHE_TTL", 300)
+    assert isinstance(WARDEN_DNS_CACHE_TTL, int) and WARDEN_DNS_CACHE_TTL >= 0
+except AssertionError:
+    raise ImproperlyConfigured("setting WARDEN_DNS_CACHE_TTL is a non-negative integer")
@@ -8,6 +8,7 @@ from plotly.graph_objects import Figure
 
 from arbiter3.arbiter.models import Violation
 from arbiter3.arbiter import plots
+from arbiter3.arbiter.render import FIGURE_RENDERER
 from arbiter3.arbiter.conf import ARBITER_USER_LOOKUP, ARBITER_ADMIN_EMAILS, ARBITER_NOTIFY_USERS, ARBITER_FROM_EMAIL, ARBITER_EMAIL_TEMPLATE_DIR
 from arbiter3.arbiter.utils import bytes_to_gib, usec_to_cores 
 
@@ -39,23 +40,34 @@ def convert_to_local_timezone(utctime):
     return utctime.astimezone(timezone.get_current_timezone())
 
 
-def send_email(recipients: list[str], figures: dict[str, Figure], context: dict[str,str]) -> str:
+def render_images(figures: list[Figure]) -> list[bytes]:
+    return FIGURE_RENDERER.render_many(figures)
+
+
+def build_email(recipients: list[str], figures: dict[str, Figure], context: dict[str,str]) -> EmailMultiAlternatives:
     subject = subject_template.render(**context)
     body = body_template.render(figures=figures, **context)
     message = EmailMultiAlternatives(subject, body, ARBITER_FROM_EMAIL, recipients, bcc=ARBITER_ADMIN_EMAILS)
 
-    for name, figure in figures.items():
-        fig_bytes = figure.to_image(format="png", width=600, height=350, scale=2)
-        image = MIMEImage(fig_bytes)
+    for name, png in zip(figures, render_images(list(figures.values()))):
+        image = MIMEImage(png)
         image.add_header("Content-ID", f"<{name}>")
         message.attach(image)
 
     message.attach_alternative(body, "text/html")
     message.mixed_subtype = "related"
-    message.send(fail_silently=False)
+    return message
 
 
-def send_violation_email(violation: Violation | None) -> str:
+def send_email(recipients: list[str], figures: dict[str, Figure], context: dict[str,str]) -> str:
+    build_email(recipients, figures, context).send(fail_silently=False)
+
+
+def violation_email(violation: Violation) -> EmailMultiAlternatives:
+    """
+    Renders the email for a violation. Raises plots.QueryError if the usage
+    figures cannot be generated.
+    """
     username, realname, email = user_lookup(violation.target.username)
 
     recipients = []
@@ -65,15 +77,9 @@ def send_violation_email(violation: Violation | None) -> str:
     if not recipients and ARBITER_NOTIFY_USERS:
         logger.warning(f"Could not find email for {violation.target.username}")
 
-    try:
-        cpu = plots.violation_cpu_usage_figure(violation)
-        mem = plots.violation_mem_usage_figure(violation)
-    except plots.QueryError as e:
-        return f'Could not send email to {recipients}: error generating figures: {e}'
-
+    cpu = plots.violation_cpu_usage_figure(violation)
+    mem = plots.violation_mem_usage_figure(violation)
     figures = dict(cpu_chart=cpu, mem_chart=mem)
-    if not figures:
-        return f'Could not send email to {recipients}: no figures generated'
 
     context = dict(
         username=username,
@@ -84,9 +90,18 @@ def send_violation_email(violation: Violation | None) -> str:
         expiration=convert_to_local_timezone(violation.expiration),
     )
 
+    return build_email(recipients, figures, context)
+
+
+def send_violation_email(violation: Violation | None) -> str:
+    try:
+        message = violation_email(violation)
+    except plots.QueryError as e:
+        return f'Could not send email for {violation}: error generating figures: {e}'
+
     try:
-        send_email(recipients, figures, context)
+        message.send(fail_silently=False)
     except Exception as e:
-        return f'Could not send email to {recipients}: {e}'
+        return f'Could not send email to {message.to}: {e}'
     
-    return f"Sent mail to {recipients} successfully"
+    return f"Sent mail to {message.to} successfully"
@@ -1,27 +1,38 @@
 import http
 import asyncio
-import aiohttp
 import logging
 import re
 import json
+from datetime import datetime
+from typing import NamedTuple
 
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Q, Count, Max
 from django.utils import timezone
 
 from prometheus_api_client import PrometheusApiClientException
 
 from arbiter3.arbiter.utils import split_port, get_uid
-from arbiter3.arbiter.models import Target, Violation, Policy, Limits, Event, UNSET_LIMIT
-from arbiter3.arbiter.email import send_violation_email
+from arbiter3.arbiter.models import Target, Violation, Policy, Limits, Event, UsageSnapshot, UNSET_LIMIT, USER_SLICES
+from arbiter3.arbiter.query import Q as PromQ
+from arbiter3.arbiter.notify import enqueue_notifications
+from arbiter3.arbiter.snapshot import capture_snapshots
+from arbiter3.arbiter.inventory import HOST_INVENTORY
+from arbiter3.arbiter.warden import WARDEN_CLIENT
 from arbiter3.arbiter.prop import CPU_QUOTA, MEMORY_MAX
+from arbiter3.arbiter.promclient import transfer_stats
+from arbiter3.arbiter.querycache import QUERY_CACHE
+from arbiter3.arbiter.planner import QueryPlan
+from arbiter3.arbiter.window import WindowEngine
+from arbiter3.arbiter.localeval import LocalEvaluator
 from arbiter3.arbiter.conf import (
     PROMETHEUS_CONNECTION,
-    WARDEN_JOB,
+    PROMETHEUS_ASYNC_CONNECTION,
+    PROMETHEUS_QUERY_POLICY,
+    PROMETHEUS_QUERY_TIMEOUT,
     ARBITER_MIN_UID,
-    WARDEN_VERIFY_SSL,
-    WARDEN_USE_TLS,
-    WARDEN_BEARER,
     WARDEN_RUNTIME,
+    WARDEN_BATCH_SIZE,
 )
 
 logger = logging.getLogger(__name__)
@@ -32,86 +43,128 @@ def refresh_limits(policy: Policy):
         refresh_limits_mem(policy.domain)
     
 
+def user_slice_query(metric: str, domain: str) -> str:
+    return str(PromQ(metric).like(instance=domain, cgroup=USER_SLICES))
+
+
 def refresh_limits_cpu(domain):
-    return refresh_limit(limit_query=f'cgroup_warden_cpu_quota{{instance=~"{domain}"}}', limit_name=CPU_QUOTA)
+    return refresh_limit(limit_query=user_slice_query('cgroup_warden_cpu_quota', domain), limit_name=CPU_QUOTA)
 
 
 def refresh_limits_mem(domain):
-    return refresh_limit(limit_query=f'cgroup_warden_memory_max{{instance=~"{domain}"}}', limit_name=MEMORY_MAX)
+    return refresh_limit(limit_query=user_slice_query('cgroup_warden_memory_max', domain), limit_name=MEMORY_MAX)
 
 
-def refresh_limit(limit_query: str, limit_name: str) -> list[Target]:
-    invalid_targets = []
+def limit_queries(policy: Policy) -> list[tuple[str, str]]:
+    """
+    The (query, limit name) pairs refresh_limits sends for the policy, for sending them along with other queries.
+    """
+    if not policy.active or policy.watcher_mode:
+        return []
+    return [
+        (user_slice_query('cgroup_warden_cpu_quota', policy.domain), CPU_QUOTA),
+        (user_slice_query('cgroup_warden_memory_max', policy.domain), MEMORY_MAX),
+    ]
 
+
+def refresh_limit(limit_query: str, limit_name: str) -> list[Target]:
     try: 
-        response = PROMETHEUS_CONNECTION.query(limit_query)
+        response = QUERY_CACHE.query(PROMETHEUS_CONNECTION, limit_query)
     except Exception as e:
         logger.error(f"Unable to assert limits set: {e}")
         return []
 
-    for result in response:
-        cgroup = result.metric['cgroup']
-        matches = re.findall(r"^/user.slice/(user-\d+.slice)$", cgroup)
-        if len(matches) < 1:
-            logger.warning(f"invalid cgroup: {cgroup}")
-            continue
-        unit = matches[0]
-        host, port = split_port(result.metric["instance"])
-        username = result.metric["username"]
-        value = int(result.value.value)
+    return check_limits(response, limit_name)
 
-        if get_uid(unit) < ARBITER_MIN_UID:
+
+def check_limits(response: list, limit_name: str) -> list[Target]:
+    """
+    Stores the limits the wardens reported where they differ from what arbiter expected.
+    """
+    invalid_targets = []
+    values = {}
+    for result in response:
+        if not (labels := parse_target_labels(result)):
             continue
+        host, username, _, _ = labels
+        values[(host, username)] = int(result.value.value)
 
-        target = Target.objects.filter(host=host, username=username).first()
-        if not target:
+    hosts = {host for host, _ in values}
+    usernames = {username for _, username in values}
+    for target in Target.objects.filter(host__in=hosts, username__in=usernames):
+        if (value := values.get((target.host, target.username))) is None:
             continue
 
         expected = target.limits.get(limit_name, -1) 
         if expected != value:
             logger.warning(f"{target.username}@{target.host} {limit_name} is set to an unexpected value: expected {expected}, actual: {value}")
             target.limits[limit_name] = value
-            target.save()
+            invalid_targets.append(target)
 
+    save_limits(invalid_targets)
     return invalid_targets
 
 
-async def set_property(target: Target, session: aiohttp.ClientSession, name: str, value: any) -> tuple[http.HTTPStatus, str]:
-    if WARDEN_USE_TLS:
-        endpoint = f"https://{target.endpoint}/control"
-    else:
-        endpoint = f"http://{target.endpoint}/control"
+def save_limits(targets: list[Target]):
+    # one transaction for the whole cycle, rather than a write lock per target
+    with transaction.atomic():
+        Target.objects.bulk_update(targets, ["limits"], batch_size=500)
+
 
+async def set_property(target: Target, name: str, value: any) -> tuple[http.HTTPStatus, str]:
     payload = {"unit": target.unit, "property": {'name': name, 'value': value}, "runtime": WARDEN_RUNTIME}
 
-    if WARDEN_BEARER:
-        auth_header = {"Authorization": "Bearer " + WARDEN_BEARER}
-    else:
-        auth_header = None
+    # might need larger timeout, when MemMax is set systemd tries to swap excess memory to disk which takes forever
+    return await WARDEN_CLIENT.post(target.endpoint, "control", payload, timeout=10)
 
-    try:
-        async with session.post(
-            url=endpoint,
-            json=payload,
-            timeout=10, # might need larger timeout, when MemMax is set systemd tries to swap excess memory to disk which takes forever
-            headers=auth_header,
-            ssl=WARDEN_VERIFY_SSL,
-        ) as response:
-            status = response.status
-            message = await response.text()
 
-    except Exception as e:
-        status = http.HTTPStatus.SERVICE_UNAVAILABLE
-        message = f"Service Unavailable : {e}"
+# statuses from a warden that predates /control/batch
+UNBATCHED_STATUSES = {http.HTTPStatus.NOT_FOUND, http.HTTPStatus.METHOD_NOT_ALLOWED, http.HTTPStatus.NOT_IMPLEMENTED}
+
 
-    return status, message
+async def set_properties(endpoint: str, units: list[tuple[Target, Limits]]) -> tuple[http.HTTPStatus, str]:
+    payload = {
+        "units": [
+            {"unit": target.unit, "properties": [{'name': name, 'value': value} for name, value in limits.items()]}
+            for target, limits in units
+        ],
+        "runtime": WARDEN_RUNTIME,
+    }
 
+    # the warden sets each property in turn, so give a batch more time than a single request
+    return await WARDEN_CLIENT.post(endpoint, "control/batch", payload, timeout=30)
 
-def create_violation(target: Target, policy: Policy) -> Violation:
-    unit_violations = Violation.objects.filter(policy=policy, target=target)
+
+class ViolationHistory(NamedTuple):
+    last_expiration: datetime | None
+    offense_count: int
+
+
+def violation_history(policy: Policy, now: datetime) -> dict[int, ViolationHistory]:
+    """
+    Returns the history of each target that has violated the policy, keyed by target id,
+    using a single aggregate query. For usage policies, only violations that can still
+    affect a new violation (in the grace period or the repeated offense lookback) are
+    considered.
+    """
+    violations = Violation.objects.filter(policy=policy)
+
+    if policy.is_base_policy:
+        offenses = Count("id")
+    else:
+        recent = Q(timestamp__gte=now - policy.repeated_offense_lookback)
+        violations = violations.filter(Q(expiration__gte=now - policy.grace_period) | recent)
+        offenses = Count("id", filter=recent)
+
+    rows = violations.values("target_id").annotate(last_expiration=Max("expiration"), offense_count=offenses)
+    return {row["target_id"]: ViolationHistory(row["last_expiration"], row["offense_count"]) for row in rows}
+
+
+def create_violation(target: Target, policy: Policy, history: dict[int, ViolationHistory], now: datetime) -> Violation:
+    previous = history.get(target.id)
 
     if policy.is_base_policy:
-        if unit_violations.exists():
+        if previous:
             return None
         return Violation(
             target=target,
@@ -121,13 +174,11 @@ def create_violation(target: Target, policy: Policy) -> Violation:
             is_base_status=True,
         )
 
-    in_grace = unit_violations.filter(
-        expiration__gte=timezone.now() - policy.grace_period).exists()
+    in_grace = previous and previous.last_expiration and previous.last_expiration >= now - policy.grace_period
 
     if not in_grace:
-        num_offense = unit_violations.filter(
-            timestamp__gte=timezone.now() - policy.repeated_offense_lookback).count()
-        expiration = timezone.now() + policy.penalty_duration * \
+        num_offense = previous.offense_count if previous else 0
+        expiration = now + policy.penalty_duration * \
             (1 + policy.repeated_offense_scalar * num_offense)
         offense_count = num_offense + 1
         return Violation(
@@ -140,43 +191,155 @@ def create_violation(target: Target, policy: Policy) -> Violation:
     return None
 
 
+async def gather_queries(queries: list[str]) -> list[list | Exception]:
+    """
+    Sends the queries to prometheus together, at most PROMETHEUS_QUERY_WORKERS
+    at a time. Results are in query order, with the exception of a failed query
+    in place of its result. Within an evaluation cycle, a query is only sent
+    once however many times it's asked.
+    """
+    return await asyncio.gather(
+        *(QUERY_CACHE.aquery(PROMETHEUS_ASYNC_CONNECTION, query, timeout=PROMETHEUS_QUERY_TIMEOUT) for query in queries),
+        return_exceptions=True,
+    )
+
+
+def run_queries(queries: list[str]) -> list[list | Exception]:
+    """
+    Runs gather_queries on the event loop the warden requests are made on.
+    """
+    if not queries:
+        return []
+    return WARDEN_CLIENT.run(gather_queries(queries))
+
+
+def query_policies(policies: list[Policy]) -> list[tuple[Policy, list]]:
+    """
+    Sends the queries of all the given policies to prometheus at once, those
+    sharing a domain and lookback as one query. Results are returned in policy
+    order; a policy whose query fails or times out is logged and left out.
+    """
+    plan = QueryPlan(policies)
+    return plan.demultiplex(run_queries(plan.queries), retry=run_queries)
+
+
+def evaluate_locally(engine: WindowEngine | LocalEvaluator, policies: list[Policy], results: list[list | Exception], now: datetime) -> list[tuple[Policy, list]]:
+    """
+    Evaluates the policies with the engine, once the results of its queries
+    are loaded into it. If any of its queries failed, the policies are queried
+    from prometheus instead.
+    """
+    if failed := [result for result in results if isinstance(result, Exception)]:
+        logger.error(f"Unable to load usage for local evaluation, querying policies directly: {failed[0]}")
+        return query_policies(policies)
+    engine.load(policies, results, now.timestamp())
+    return engine.evaluate(policies, now.timestamp())
+
+
+def parse_target_labels(result) -> tuple[str, str, int | None, str] | None:
+    """
+    Returns the (host, username, port, unit) of a result, or None if the
+    result is not for a user slice arbiter manages.
+    """
+    cgroup = result.metric['cgroup']
+    matches = re.findall(r"^/user.slice/(user-\d+.slice)$", cgroup)
+    if len(matches) < 1:
+        logger.warning(f"invalid cgroup: {cgroup}")
+        return None
+    unit = matches[0]
+    host, port = split_port(result.metric["instance"])
+    username = result.metric["username"]
+
+    if get_uid(unit) < ARBITER_MIN_UID:
+        return None
+
+    return host, username, port, unit
+
+
+def resolve_targets(identities: dict[tuple[str, str], tuple[int | None, str]]) -> dict[tuple[str, str], Target]:
+    """
+    Maps (host, username) to its Target, given the (port, unit) last seen for it.
+    Existing targets are loaded in one query, and the missing or stale ones are
+    written with bulk_create and bulk_update, so the number of statements does
+    not grow with the number of targets.
+    """
+    if not identities:
+        return {}
+
+    hosts = {host for host, _ in identities}
+    usernames = {username for _, username in identities}
+    existing = Target.objects.filter(host__in=hosts, username__in=usernames)
+    targets = {(t.host, t.username): t for t in existing if (t.host, t.username) in identities}
+
+    missing = []
+    stale = []
+    for (host, username), (port, unit) in identities.items():
+        target = targets.get((host, username))
+        if target is None:
+            missing.append(Target(host=host, username=username, port=port, unit=unit))
+        elif target.port != port or target.unit != unit:
+            target.port = port
+            target.unit = unit
+            stale.append(target)
+
+    with transaction.atomic():
+        if stale:
+            Target.objects.bulk_update(stale, ["port", "unit"], batch_size=500)
+        if missing:
+            # a target may have been created elsewhere (e.g. the dashboard) since it was loaded
+            Target.objects.bulk_create(missing, batch_size=500, ignore_conflicts=True)
+            created = Target.objects.filter(host__in={t.host for t in missing}, username__in={t.username for t in missing})
+            for target in created:
+                key = (target.host, target.username)
+                if key in identities and key not in targets:
+                    targets[key] = target
+                    logger.info(f"new target {target}")
+
+    return targets
+
+
 def query_violations(policies: list[Policy]) -> list[Violation]:
-    violations = []
-    for policy in policies:
+    return find_violations(query_policies(policies))
 
-        try:
-            response = PROMETHEUS_CONNECTION.query(policy.query)
-        except Exception as e:
-            logger.error(f"Unable to query violations: {e}")
-            return violations
 
+def find_violations(policy_results: list[tuple[Policy, list]]) -> list[Violation]:
+    responses = []
+    identities = {}
+    discarded = 0
+    for policy, response in policy_results:
+        keys = []
         for result in response:
-            cgroup = result.metric['cgroup']
-            matches = re.findall(r"^/user.slice/(user-\d+.slice)$", cgroup)
-            if len(matches) < 1:
-                logger.warning(f"invalid cgroup: {cgroup}")
+            if not (labels := parse_target_labels(result)):
+                discarded += 1
                 continue
-            unit = matches[0]
-            host, port = split_port(result.metric["instance"])
-            username = result.metric["username"]
+            host, username, port, unit = labels
+            identities[(host, username)] = (port, unit)
+            keys.append((host, username))
+        # a target the query returned several series for still violates the policy once
+        responses.append((policy, list(dict.fromkeys(keys))))
 
-            if get_uid(unit) < ARBITER_MIN_UID:
-                continue
+    # queries built by arbiter only return managed user slices, these came from raw queries
+    if discarded:
+        logger.info(f"{discarded} policy results were not for user slices arbiter manages")
 
-            target, created = Target.objects.update_or_create(
-                host=host, username=username, defaults=dict(port=port, unit=unit))
-            if created:
-                logger.info(f"new target {target}")
+    targets = resolve_targets(identities)
 
-            if violation := create_violation(target, policy):
+    violations = []
+    now = timezone.now()
+    for policy, keys in responses:
+        history = violation_history(policy, now)
+        for key in keys:
+            if not (target := targets.get(key)):
+                continue
+            if violation := create_violation(target, policy, history, now):
                 violations.append(violation)
                 logger.info(f"New violation of '{policy}' by '{target}'")
 
     return violations
 
 
-async def _apply_and_verify_limit(target: Target, session : aiohttp.ClientSession, name : str, value: any):
-        status, message = await set_property(target, session, name, value)
+async def _apply_and_verify_limit(target: Target, name : str, value: any):
+        status, message = await set_property(target, name, value)
         if status == http.HTTPStatus.OK:
             try:
                 response: dict = json.loads(message)
@@ -198,11 +361,11 @@ async def _apply_and_verify_limit(target: Target, session : aiohttp.ClientSessio
             return None, False
 
 
-async def apply_limits(limits: Limits, target: Target, session: aiohttp.ClientSession) -> tuple[Target, Limits]:
+async def apply_limits(limits: Limits, target: Target) -> tuple[Target, Limits]:
     applied: Limits = {} 
 
     for name, value in limits.items():
-        applied_limit, successful = await _apply_and_verify_limit(target, session, name, value)
+        applied_limit, successful = await _apply_and_verify_limit(target, name, value)
 
         if successful:
             applied[name] = applied_limit
@@ -210,6 +373,61 @@ async def apply_limits(limits: Limits, target: Target, session: aiohttp.ClientSe
     return target, applied
 
 
+async def apply_limits_batch(endpoint: str, units: list[tuple[Target, Limits]]) -> list[tuple[Target, Limits]] | None:
+    """
+    Applies the limits of several targets on the same host in one request.
+    Returns None if the warden does not support batches.
+    """
+    status, message = await set_properties(endpoint, units)
+    if status in UNBATCHED_STATUSES:
+        WARDEN_CLIENT.mark_unbatched(endpoint)
+        return None
+
+    applications = [(target, {}) for target, _ in units]
+    if status != http.HTTPStatus.OK:
+        logger.warning(f"could not apply limits to {len(units)} targets on {endpoint}: {message}")
+        return applications
+
+    try:
+        response: dict = json.loads(message)
+        results = {unit["unit"]: unit.get("properties", []) for unit in response["units"]}
+    except (json.JSONDecodeError, KeyError, TypeError):
+        logger.warning(f"malformed batch response from {endpoint}: {message}")
+        return applications
+
+    for target, applied in applications:
+        for result in results.get(target.unit, []):
+            name = result.get("name")
+            if error := result.get("error"):
+                logger.warning(f"could not apply {name} to {target}: {error}")
+                continue
+            if warning := result.get("warning"):
+                logger.warning(f"recieved warning from {target.host}: {warning}")
+            if name is None or "value" not in result:
+                logger.warning(f"malformed response : {result}")
+                continue
+
+            applied[name] = result["value"]
+            logger.info(f"successfully applied limit {name} = {result['value']} to {target}")
+
+    return applications
+
+
+async def apply_host_limits(endpoint: str, units: list[tuple[Target, Limits]]) -> list[tuple[Target, Limits]]:
+    applications = []
+    if WARDEN_BATCH_SIZE and WARDEN_CLIENT.supports_batch(endpoint):
+        while units:
+            batch = await apply_limits_batch(endpoint, units[:WARDEN_BATCH_SIZE])
+            if batch is None:
+                break
+            applications.extend(batch)
+            units = units[WARDEN_BATCH_SIZE:]
+
+    # single property requests, for wardens without batch support
+    applications.extend(await asyncio.gather(*(apply_limits(limits, target) for target, limits in units)))
+    return applications
+
+
 def reduce_limits(limits_list: list[Limits]) -> Limits:
     reduced: Limits = {}
     for limits in limits_list:
@@ -235,27 +453,47 @@ def resolve_limits(target: Target, limits: Limits) -> Limits:
 
 
 async def reduce_and_apply_limits(applicable: dict[Target, list[Limits]]):
-    async with aiohttp.ClientSession() as session, asyncio.TaskGroup() as tg:
+    """
+    Applies the reduced limits of each target that differ from its current limits.
+    Targets with nothing to change are left out of the result.
+    """
+    hosts: dict[str, list[tuple[Target, Limits]]] = {}
+    for target, limits_list in applicable.items():
+        reduced: Limits = reduce_limits(limits_list)
+        resolved: Limits = resolve_limits(target, reduced)
+        if not resolved:
+            continue
+        hosts.setdefault(target.endpoint, []).append((target, resolved))
+
+    async with asyncio.TaskGroup() as tg:
         tasks = []
-        for target, limits_list in applicable.items():
-            reduced: Limits = reduce_limits(limits_list)
-            resolved: Limits = resolve_limits(target, reduced)
+        for endpoint, units in hosts.items():
             tasks.append(tg.create_task(
-                apply_limits(resolved, target, session)))
+                apply_host_limits(endpoint, units)))
 
     final_applications = {}
     for task in tasks:
-        target, applications = task.result()
-        final_applications[target] = applications
-        if not applications:
-            continue
-        target.update_limits(applications)
-        await target.asave()
+        for target, applications in task.result():
+            final_applications[target] = applications
 
     return final_applications
 
 
-def create_event_for_eval(violations):
+def count_applications(final_applications: dict[Target, Limits], total: int) -> dict[str, int]:
+    counts = {"changed": 0, "released": 0, "failed": 0}
+    for applications in final_applications.values():
+        if not applications:
+            counts["failed"] += 1
+        elif all(value == UNSET_LIMIT for value in applications.values()):
+            counts["released"] += 1
+        else:
+            counts["changed"] += 1
+
+    counts["skipped"] = total - len(final_applications)
+    return counts
+
+
+def create_event_for_eval(violations, targets: dict[str, int]):
     violations_json = []
     for violation in violations:
         violations_json.append(
@@ -267,44 +505,106 @@ def create_event_for_eval(violations):
         )
 
     Event.objects.create(
-        type=Event.EventTypes.EVALUATION, data={"violations": violations_json}
+        type=Event.EventTypes.EVALUATION, data={"violations": violations_json, "targets": targets}
     )
 
 
-def evaluate(policies=None):
+def evaluate(policies=None, refresh=False, engine: WindowEngine | LocalEvaluator | None = None):
+    """
+    Runs an evaluation cycle. With `refresh`, the limits the wardens report are
+    checked first, as refresh_limits does. With an `engine`, the policies it
+    supports are evaluated locally from its usage instead of their queries.
+    """
     policies = policies or Policy.objects.all()
     policies = [p for p in policies if p.active]
 
-    violations = query_violations(policies)
-    Violation.objects.bulk_create(violations, ignore_conflicts=True)
-
-
-    unexpired = Violation.objects.filter(Q(expiration__gt=timezone.now()) | Q(expiration__isnull=True), policy__active=True)
-    unexpired = unexpired.prefetch_related("policy")
-
-    targets = Target.objects.all()
-    applicable_limits = {target: [] for target in targets}
-    for v in unexpired:
-        for host, port in v.policy.affected_hosts:
-            target, _ = targets.update_or_create(host=host, username=v.target.username, defaults=dict(port=port, unit=v.target.unit))
-
-            if target not in applicable_limits:
-                applicable_limits[target] = []
-
-            if not v.policy.watcher_mode:
-                applicable_limits[target].append(v.limits)
-
-    create_event_for_eval(violations)
-
-    for violation in violations:
-        if not violation.is_base_status:
-            message = send_violation_email(violation)
-            logger.info(message)
+    # every query of the cycle is evaluated at the same moment, and sent once
+    now = timezone.now()
+    with QUERY_CACHE.cycle(now):
+        # the policy, limit refresh and inventory queries are sent to prometheus together
+        local = [policy for policy in policies if engine.supports(policy)] if engine else []
+        plan = QueryPlan([policy for policy in policies if policy not in local])
+        local_queries = engine.queries(local, now.timestamp()) if local else []
+        refreshed = [pair for policy in policies for pair in limit_queries(policy)] if refresh else []
+        queries = plan.queries + local_queries + [query for query, _ in refreshed]
+        if refresh_inventory := HOST_INVENTORY.stale:
+            queries.append(HOST_INVENTORY.query)
+        results = run_queries(queries)
+
+        if refresh_inventory:
+            if isinstance(result := results.pop(), Exception):
+                logger.error(f"Unable to refresh host inventory, using last known hosts: {result}")
+            else:
+                HOST_INVENTORY.load(result)
+
+        local_start = len(plan.groups)
+        local_end = local_start + len(local_queries)
+        for (_, limit_name), result in zip(refreshed, results[local_end:]):
+            if isinstance(result, Exception):
+                logger.error(f"Unable to assert limits set: {result}")
+            else:
+                check_limits(result, limit_name)
+
+        policy_results = plan.demultiplex(results[:local_start], retry=run_queries)
+        if local:
+            policy_results += evaluate_locally(engine, local, results[local_start:local_end], now)
+            order = {policy.pk: i for i, policy in enumerate(policies)}
+            policy_results.sort(key=lambda pair: order[pair[0].pk])
+        violations = find_violations(policy_results)
+        Violation.objects.bulk_create(violations)
+
+        unexpired = Violation.objects.filter(Q(expiration__gt=timezone.now()) | Q(expiration__isnull=True), policy__active=True)
+        unexpired = unexpired.select_related("policy", "target")
+
+        # a violation applies to its user on every host in the policy's domain
+        identities = {}
+        affected = []
+        for v in unexpired:
+            keys = []
+            for host, port in v.policy.affected_hosts:
+                identities[(host, v.target.username)] = (port, v.target.unit)
+                keys.append((host, v.target.username))
+            affected.append((v, keys))
+
+        resolved = resolve_targets(identities)
+
+        # targets without limits or violations have nothing to change, only limited targets may need releasing
+        applicable_limits = {target: [] for target in Target.objects.exclude(limits={})}
+        for v, keys in affected:
+            if v.policy.watcher_mode:
+                continue
+            for key in keys:
+                if target := resolved.get(key):
+                    applicable_limits.setdefault(target, []).append(v.limits)
 
-    try:
-        asyncio.run(reduce_and_apply_limits(applicable_limits))
-    except ExceptionGroup as eg:
-        for e in eg.exceptions:
-            logger.error(f"{e} ")
+        try:
+            final_applications = WARDEN_CLIENT.run(reduce_and_apply_limits(applicable_limits))
+        except ExceptionGroup as eg:
+            final_applications = {}
+            for e in eg.exceptions:
+                logger.error(f"{e} ")
+
+        updated = []
+        for target, applications in final_applications.items():
+            if applications:
+                target.update_limits(applications)
+                updated.append(target)
+        save_limits(updated)
+
+        # the usage behind new violations is captured once limits are applied, so its queries don't hold up
+        # enforcement; its window ends at the cycle's moment however long that took
+        snapshots = capture_snapshots(violations, now)
+    UsageSnapshot.objects.bulk_create(snapshots)
+
+    # emails are rendered and sent by the send_notifications worker, after their snapshots are saved
+    enqueue_notifications(violations)
+
+    targets = count_applications(final_applications, Target.objects.count())
+    create_event_for_eval(violations, targets)
+    logger.info(f"targets changed, released, failed and skipped: {targets}")
+
+    logger.info(f"warden connection pool: {WARDEN_CLIENT.stats()}")
+    logger.info(f"prometheus queries: {PROMETHEUS_QUERY_POLICY.stats()}")
+    logger.info(f"prometheus transfer: {transfer_stats(PROMETHEUS_CONNECTION, PROMETHEUS_ASYNC_CONNECTION)}")
 
     # assert_cpu_limits_set()
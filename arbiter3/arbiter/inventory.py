@@ -0,0 +1,74 @@
+import re
+import logging
+from time import monotonic
+
+from arbiter3.arbiter.utils import split_port
+from arbiter3.arbiter.conf import PROMETHEUS_CONNECTION, WARDEN_JOB, WARDEN_INVENTORY_REFRESH
+from arbiter3.arbiter.querycache import QUERY_CACHE
+
+logger = logging.getLogger(__name__)
+
+
+class HostInventory:
+    """
+    The up/down state of every cgroup-warden instance scraped by prometheus.
+    The state is fetched with a single `up` query and kept in memory, so that
+    resolving which hosts a policy's domain covers does not require a query.
+    """
+
+    def __init__(self, job: str, max_age: int):
+        self.job = job
+        self.max_age = max_age
+        self._instances: dict[str, bool] = {}
+        self._refreshed: float | None = None
+        self._patterns: dict[str, re.Pattern] = {}
+
+    @property
+    def loaded(self) -> bool:
+        return self._refreshed is not None
+
+    @property
+    def stale(self) -> bool:
+        return not self.loaded or monotonic() - self._refreshed >= self.max_age
+
+    @property
+    def query(self) -> str:
+        return f'up{{job=~"{self.job}"}}'
+
+    def refresh(self, timeout=None):
+        self.load(QUERY_CACHE.query(PROMETHEUS_CONNECTION, self.query, timeout=timeout))
+
+    def load(self, result: list):
+        """
+        Replaces the inventory with the result of its query, for callers that sent it themselves.
+        """
+        self._instances = {r.metric["instance"]: float(r.value.value) > 0 for r in result}
+        self._refreshed = monotonic()
+        logger.debug(f"refreshed host inventory: {len(self._instances)} instances")
+
+    def refresh_if_stale(self, timeout=None):
+        if self.stale:
+            self.refresh(timeout=timeout)
+
+    def _pattern(self, domain: str) -> re.Pattern:
+        # prometheus regex matchers are fully anchored
+        if not (pattern := self._patterns.get(domain)):
+            pattern = self._patterns[domain] = re.compile(domain)
+        return pattern
+
+    def instances(self, domain: str | None = None, up: bool = True) -> list[str]:
+        if not self.loaded:
+            self.refresh()
+
+        instances = [instance for instance, is_up in self._instances.items() if is_up or not up]
+        if domain is None:
+            return instances
+
+        pattern = self._pattern(domain)
+        return [instance for instance in instances if pattern.fullmatch(instance)]
+
+    def hosts(self, domain: str | None = None) -> list[tuple[str, int | None]]:
+        return [split_port(instance) for instance in self.instances(domain)]
+
+
+HOST_INVENTORY = HostInventory(job=WARDEN_JOB, max_age=WARDEN_INVENTORY_REFRESH)
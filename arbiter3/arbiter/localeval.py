@@ -0,0 +1,215 @@
+import re
+from collections import defaultdict
+from typing import Callable
+
+import numpy as np
+
+from arbiter3.arbiter.models import Policy, QueryData, USER_SLICES
+from arbiter3.arbiter.planner import combinable
+from arbiter3.arbiter.promclient import Vector, Series
+from arbiter3.arbiter.query import Q, increase, sum_over_time
+from arbiter3.arbiter.rules import CPU_METRIC, cpu_metric, mem_metric
+
+# the labels memory usage is summed by in QueryData.build_query
+TARGET_LABELS = ("username", "instance", "cgroup", "job")
+
+# usage(kind, lookback, proc_whitelist), a users × hosts array of usage
+UsageSource = Callable[[str, int, str | None], np.ndarray]
+
+
+def fullmatches(pattern: str, values: np.ndarray) -> np.ndarray:
+    """
+    Which of the values the prometheus regex matches, which is fully anchored.
+    """
+    if not len(values):
+        return np.zeros(0, dtype=bool)
+    unique, inverse = np.unique(values, return_inverse=True)
+    compiled = re.compile(pattern)
+    return np.array([compiled.fullmatch(value) is not None for value in unique.tolist()], dtype=bool)[inverse]
+
+
+def policy_params(policy: Policy) -> dict:
+    return policy.query_data.get("params") or {}
+
+
+class UsageGrid:
+    """
+    The users × hosts grid the usage of a cycle is evaluated on. Each cell is a
+    user's slice on a host, and series are reduced to the cell they are for.
+    Policies are evaluated on the whole grid at once, their domains as masks
+    over its hosts and their user whitelists as masks over its users.
+
+    Like the queries of QueryData.build_query, it assumes a user has one slice
+    per host.
+    """
+
+    def __init__(self, metrics: list[dict[str, str]]):
+        self.users: dict[str, int] = {}
+        self.hosts: dict[str, int] = {}
+        self.labels: dict[tuple[int, int], dict[str, str]] = {}
+        for metric in metrics:
+            cell = self.users.setdefault(metric.get("username", ""), len(self.users)), self.hosts.setdefault(metric.get("instance", ""), len(self.hosts))
+            self.labels.setdefault(cell, {name: metric[name] for name in TARGET_LABELS if name in metric})
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        return len(self.users), len(self.hosts)
+
+    def cells(self, metrics: list[dict[str, str]]) -> tuple[np.ndarray, np.ndarray]:
+        users = np.fromiter((self.users[metric.get("username", "")] for metric in metrics), np.intp, len(metrics))
+        hosts = np.fromiter((self.hosts[metric.get("instance", "")] for metric in metrics), np.intp, len(metrics))
+        return users, hosts
+
+    def maximum(self, metrics: list[dict[str, str]], values: np.ndarray) -> np.ndarray:
+        """
+        The largest value of each cell's series, NaN for cells without any.
+        A threshold on each series is exceeded in a cell when its maximum exceeds it.
+        """
+        grid = np.full(self.shape, np.nan)
+        np.fmax.at(grid, self.cells(metrics), values)
+        return grid
+
+    def total(self, metrics: list[dict[str, str]], values: np.ndarray) -> np.ndarray:
+        """
+        The sum of each cell's series, ignoring NaN, NaN for cells without any.
+        """
+        cells = self.cells(metrics)
+        present = ~np.isnan(values)
+        grid, counts = np.zeros(self.shape), np.zeros(self.shape, dtype=np.int64)
+        np.add.at(grid, (cells[0][present], cells[1][present]), values[present])
+        np.add.at(counts, (cells[0][present], cells[1][present]), 1)
+        return np.where(counts > 0, grid, np.nan)
+
+    def present(self, metrics: list[dict[str, str]]) -> np.ndarray:
+        grid = np.zeros(self.shape, dtype=bool)
+        grid[self.cells(metrics)] = True
+        return grid
+
+    def _masks(self, index: dict[str, int], patterns: list[str | None], default: bool) -> np.ndarray:
+        values = np.array(list(index), dtype=object)
+        masks = np.full((len(patterns), len(values)), default)
+        computed = {}
+        for i, pattern in enumerate(patterns):
+            if pattern:
+                if pattern not in computed:
+                    computed[pattern] = fullmatches(pattern, values)
+                masks[i] = computed[pattern]
+        return masks
+
+    def host_masks(self, domains: list[str]) -> np.ndarray:
+        return self._masks(self.hosts, domains, True)
+
+    def user_masks(self, whitelists: list[str | None]) -> np.ndarray:
+        return self._masks(self.users, whitelists, False)
+
+    def evaluate(self, policies: list[Policy], usage: UsageSource, time: float) -> list[tuple[Policy, list[Vector]]]:
+        """
+        The results each policy's query would have, in policy order. Policies
+        sharing a lookback and process whitelist are evaluated together, as one
+        policies × users × hosts array of each of their thresholds.
+        """
+        groups = defaultdict(list)
+        for policy in policies:
+            key = None if policy.is_base_policy else (int(policy.lookback.total_seconds()), policy_params(policy).get("proc_whitelist") or None)
+            groups[key].append(policy)
+
+        results = {}
+        for key, group in groups.items():
+            params = [policy_params(policy) for policy in group]
+            allowed = self.host_masks([policy.domain for policy in group])[:, None, :]
+            allowed = allowed & ~self.user_masks([p.get("user_whitelist") for p in params])[:, :, None]
+
+            if key is None:
+                violating = allowed & usage("present", 0, None)[None]
+                values = np.ones(violating.shape)
+            else:
+                lookback, proc_whitelist = key
+                violating = np.zeros(allowed.shape, dtype=bool)
+                values = np.full(allowed.shape, np.nan)
+                # an unset or zero threshold is left out of the query, as in build_query
+                for kind, name in (("mem", "mem_threshold"), ("cpu", "cpu_threshold")):
+                    thresholds = np.array([p.get(name) or np.inf for p in params], dtype=float)
+                    if np.isinf(thresholds).all():
+                        continue
+                    grid = usage(kind, lookback, proc_whitelist)[None]
+                    exceeded = grid > thresholds[:, None, None]
+                    values = np.where(exceeded, grid, values)
+                    violating |= exceeded
+                violating &= allowed
+
+            for policy, cells, cell_values in zip(group, violating, values):
+                results[policy.pk] = [
+                    Vector(self.labels[(user, host)], Series(time, str(cell_values[user, host])))
+                    for user, host in zip(*(index.tolist() for index in np.nonzero(cells)))
+                ]
+
+        return [(policy, results[policy.pk]) for policy in policies]
+
+
+class LocalEvaluator:
+    """
+    Evaluates policies from one bulk query per usage metric and lookback,
+    instead of a query per policy. The queries return the usage of every
+    cgroup (and of each of their processes, for process whitelists), which is
+    thresholded in a UsageGrid; the results are the same as the policies'
+    own queries would have.
+    """
+
+    supports = staticmethod(combinable)
+
+    @staticmethod
+    def keys(policies: list[Policy]) -> list[tuple]:
+        keys = {}
+        for policy in policies:
+            if policy.is_base_policy:
+                keys[("present", 0, False)] = None
+                continue
+            params = policy_params(policy)
+            lookback = int(policy.lookback.total_seconds())
+            proc = bool(params.get("proc_whitelist"))
+            if params.get("cpu_threshold"):
+                keys[("cpu", lookback, proc)] = None
+            if params.get("mem_threshold"):
+                keys[("mem", lookback, proc)] = None
+        return list(keys)
+
+    @staticmethod
+    def query(key: tuple) -> str:
+        kind, lookback, proc = key
+        if kind == "present":
+            return str(Q(CPU_METRIC).like(cgroup=USER_SLICES))
+        if kind == "cpu":
+            return str(increase(Q(cpu_metric(proc)).like(cgroup=USER_SLICES).over(f"{lookback}s")))
+        mem_range, _ = QueryData.mem_range(lookback)
+        return str(sum_over_time(Q(mem_metric(proc)).like(cgroup=USER_SLICES).over(mem_range)))
+
+    def queries(self, policies: list[Policy], now: float) -> list[str]:
+        return [self.query(key) for key in self.keys(policies)]
+
+    def load(self, policies: list[Policy], results: list[list], now: float):
+        self.results = dict(zip(self.keys(policies), results))
+
+    def evaluate(self, policies: list[Policy], now: float) -> list[tuple[Policy, list[Vector]]]:
+        series = {key: ([vector.metric for vector in result], result) for key, result in self.results.items()}
+        grid = UsageGrid([metric for metrics, _ in series.values() for metric in metrics])
+        computed = {}
+
+        def usage(kind: str, lookback: int, proc_whitelist: str | None) -> np.ndarray:
+            if (kind, lookback, proc_whitelist) in computed:
+                return computed[(kind, lookback, proc_whitelist)]
+
+            metrics, result = series[(kind, lookback, bool(proc_whitelist))]
+            if kind == "present":
+                return computed.setdefault((kind, lookback, proc_whitelist), grid.present(metrics))
+
+            values = np.fromiter((float(vector.value.value) for vector in result), np.float64, len(result))
+            values /= lookback if kind == "cpu" else QueryData.mem_range(lookback)[1]
+            if proc_whitelist:
+                procs = np.array([metric.get("proc", "") for metric in metrics], dtype=object)
+                values[fullmatches(proc_whitelist, procs)] = np.nan
+
+            # cpu is thresholded per series and memory per cgroup, summed over its processes
+            reduce = grid.maximum if kind == "cpu" else grid.total
+            return computed.setdefault((kind, lookback, proc_whitelist), reduce(metrics, values))
+
+        return grid.evaluate(policies, usage, now)
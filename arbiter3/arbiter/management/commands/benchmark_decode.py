@@ -0,0 +1,108 @@
+import json
+import time
+import random
+import statistics
+import tracemalloc
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+
+from arbiter3.arbiter.promclient import DECODERS, orjson, parse_vector_result, parse_matrix_result, parse_matrix_columns
+
+
+class RecordedResponse:
+    """
+    A recorded Prometheus response, served the way requests would serve it.
+    """
+
+    def __init__(self, body: bytes):
+        self.body = body
+
+    @property
+    def content(self) -> bytes:
+        return self.body
+
+    def iter_content(self, chunk_size: int):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i:i + chunk_size]
+
+
+def vector_response(series: int) -> bytes:
+    """
+    Shaped like a base policy query across a large cluster, a sample per user per node.
+    """
+    result = [
+        {"metric": {"instance": f"node{i // 40}:2112", "job": "cgroup-warden", "username": f"user{i % 40}", "cgroup": f"/user.slice/user-{2000 + i % 40}.slice"}, "value": [time.time(), str(random.uniform(0, 64))]}
+        for i in range(series)
+    ]
+    return json.dumps({"status": "success", "data": {"resultType": "vector", "result": result}}).encode()
+
+
+def matrix_response(processes: int, points: int) -> bytes:
+    """
+    Shaped like a long per-process graph query.
+    """
+    start = time.time() - points * 60
+    result = [
+        {"metric": {"instance": "node1:2112", "username": "user1", "proc": f"process{i}"}, "values": [[start + j * 60, str(random.uniform(0, 4))] for j in range(points)]}
+        for i in range(processes)
+    ]
+    return json.dumps({"status": "success", "data": {"resultType": "matrix", "result": result}}).encode()
+
+
+def measure(decoder, body: bytes, parse, repeat: int) -> tuple[float, float]:
+    """
+    The median milliseconds to decode and parse the body, and the peak MiB allocated while doing it.
+    """
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        parse(decoder.decode(RecordedResponse(body))[1])
+        seconds.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    parse(decoder.decode(RecordedResponse(body))[1])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return statistics.median(seconds) * 1000, peak / 2**20
+
+
+class Command(BaseCommand):
+    help = "Compares the speed and memory use of the Prometheus response decoders on synthetic responses"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--series", default=20000, type=int, help="series in the instant query response")
+        parser.add_argument("--processes", default=100, type=int, help="series in the range query response")
+        parser.add_argument("--points", default=400, type=int, help="points per series in the range query response")
+        parser.add_argument("--repeat", default=5, type=int)
+        parser.add_argument("--record", type=Path, help="directory to save the responses to, or load them from if they exist")
+
+    def responses(self, options) -> dict[str, bytes]:
+        responses = {}
+        for name, make in (("vector", lambda: vector_response(options["series"])), ("matrix", lambda: matrix_response(options["processes"], options["points"]))):
+            path = options["record"] / f"{name}.json" if options["record"] else None
+            if path and path.exists():
+                responses[name] = path.read_bytes()
+                continue
+            responses[name] = make()
+            if path:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_bytes(responses[name])
+        return responses
+
+    def handle(self, *args, **options):
+        responses = self.responses(options)
+        cases = [
+            ("vector", "vectors", responses["vector"], parse_vector_result),
+            ("matrix", "matrices", responses["matrix"], parse_matrix_result),
+            ("matrix", "columns", responses["matrix"], parse_matrix_columns),
+        ]
+
+        for response, parsed, body, parse in cases:
+            print(f"{response} response of {len(body) / 2**20:.1f} MiB parsed into {parsed}")
+            for name, decoder in DECODERS.items():
+                if name == "orjson" and orjson is None:
+                    print(f"  {name:<8} not installed")
+                    continue
+                ms, mib = measure(decoder(), body, parse, options["repeat"])
+                print(f"  {name:<8} {ms:8.1f} ms   peak {mib:7.1f} MiB")
@@ -0,0 +1,65 @@
+import time
+import random
+import statistics
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand
+from plotly.graph_objects import Figure, Scatter
+
+from arbiter3.arbiter.render import FigureRenderer
+
+
+def usage_figure(series: int, points: int) -> Figure:
+    """
+    A figure shaped like an email usage graph, a line per process over the violation's lookback.
+    """
+    start = datetime.now() - timedelta(seconds=points * 10)
+    timestamps = [start + timedelta(seconds=i * 10) for i in range(points)]
+
+    figure = Figure()
+    for i in range(series):
+        values = [random.uniform(0, 4) for _ in range(points)]
+        figure.add_trace(Scatter(x=timestamps, y=values, name=f"process{i}", stackgroup="one"))
+    figure.update_layout(title="CPU Usage", xaxis_title="Time", yaxis_title="Cores")
+    return figure
+
+
+def report(name: str, seconds: list[float]):
+    ms = [s * 1000 for s in seconds]
+    print(f"{name:<32} mean {statistics.mean(ms):8.1f} ms   median {statistics.median(ms):8.1f} ms   max {max(ms):8.1f} ms")
+
+
+class Command(BaseCommand):
+    help = "Compares per-figure render latency of figure.to_image with the warm FigureRenderer"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--figures", default=20, type=int)
+        parser.add_argument("--workers", default=2, type=int)
+        parser.add_argument("--series", default=10, type=int)
+        parser.add_argument("--points", default=360, type=int)
+
+    def handle(self, *args, **options):
+        figures = [usage_figure(options["series"], options["points"]) for _ in range(options["figures"])]
+        renderer = FigureRenderer(workers=options["workers"])
+
+        to_image = []
+        for figure in figures:
+            start = time.perf_counter()
+            figure.to_image(**renderer.opts)
+            to_image.append(time.perf_counter() - start)
+        report("figure.to_image", to_image)
+
+        start = time.perf_counter()
+        renderer.render(figures[0])
+        print(f"{'renderer startup':<32} {(time.perf_counter() - start) * 1000:8.1f} ms")
+
+        render = []
+        for figure in figures:
+            start = time.perf_counter()
+            renderer.render(figure)
+            render.append(time.perf_counter() - start)
+        report("renderer.render", render)
+
+        start = time.perf_counter()
+        renderer.render_many(figures)
+        report("renderer.render_many (per fig)", [(time.perf_counter() - start) / len(figures)])
@@ -0,0 +1,66 @@
+import json
+import time
+import zlib
+import random
+import statistics
+
+from django.core.management.base import BaseCommand
+
+from arbiter3.arbiter.codec import encode_matrices, decode_arrays, decode_matrices
+from arbiter3.arbiter.promclient import Matrix, Series, parse_matrix_result
+
+
+def usage_matrices(processes: int, points: int) -> list[Matrix]:
+    """
+    Matrices shaped like a usage snapshot, a series per process at a one minute step.
+    """
+    start = time.time() - points * 60
+    return [
+        Matrix(
+            {"instance": "node1:2112", "username": "user1", "proc": f"process{i}", "resource": "cpu"},
+            [Series(start + j * 60, str(round(random.uniform(0, 4), 6))) for j in range(points)],
+        )
+        for i in range(processes)
+    ]
+
+
+def prometheus_json(matrices: list[Matrix]) -> bytes:
+    result = [{"metric": m.metric, "values": [[s.timestamp, s.value] for s in m.values]} for m in matrices]
+    return json.dumps({"status": "success", "data": {"resultType": "matrix", "result": result}}).encode()
+
+
+def timed(func, repeat: int) -> float:
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+    return statistics.median(seconds) * 1000
+
+
+class Command(BaseCommand):
+    help = "Compares the size and decode speed of the binary snapshot format with Prometheus' JSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", default=50, type=int)
+        parser.add_argument("--points", default=400, type=int)
+        parser.add_argument("--repeat", default=20, type=int)
+
+    def handle(self, *args, **options):
+        matrices = usage_matrices(options["processes"], options["points"])
+        repeat = options["repeat"]
+
+        as_json = prometheus_json(matrices)
+        as_zjson = zlib.compress(as_json)
+        as_binary = encode_matrices(matrices)
+
+        cases = [
+            ("json", as_json, lambda: parse_matrix_result(json.loads(as_json)["data"]["result"])),
+            ("json + zlib", as_zjson, lambda: parse_matrix_result(json.loads(zlib.decompress(as_zjson))["data"]["result"])),
+            ("binary to arrays", as_binary, lambda: decode_arrays(as_binary)),
+            ("binary to matrices", as_binary, lambda: decode_matrices(as_binary)),
+        ]
+
+        print(f"{options['processes']} processes x {options['points']} points")
+        for name, data, decode in cases:
+            print(f"{name:<20} {len(data) / 1024:8.1f} KiB   decode {timed(decode, repeat):8.2f} ms")
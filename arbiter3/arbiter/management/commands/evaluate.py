@@ -1,9 +1,12 @@
 from django.core.management.base import BaseCommand
-from arbiter3.arbiter.eval import evaluate, refresh_limits, logger
+from arbiter3.arbiter.eval import evaluate, logger
 from django.utils import timezone
 from django.db.utils import OperationalError
 from arbiter3.arbiter.models import Policy
 from arbiter3.arbiter.utils import promtime_to_sec
+from arbiter3.arbiter.window import WindowEngine
+from arbiter3.arbiter.localeval import LocalEvaluator
+from arbiter3.arbiter.conf import WARDEN_JOB
 from time import sleep
 
 class Command(BaseCommand):
@@ -15,6 +18,17 @@ class Command(BaseCommand):
         parser.add_argument("-M", "--minutes", default=0, type=int)
         parser.add_argument("-H", "--hours", default=0, type=int)
         parser.add_argument("--refresh-interval", default="10m", type=str)
+        engines = parser.add_mutually_exclusive_group()
+        engines.add_argument(
+            "--window",
+            action="store_true",
+            help="keep recent usage in memory and only fetch the samples since the last cycle",
+        )
+        engines.add_argument(
+            "--local",
+            action="store_true",
+            help="fetch the usage of every cgroup once per metric and evaluate the policies locally",
+        )
 
     def handle(self, *args, **options):
         seconds = options["seconds"]
@@ -25,6 +39,15 @@ class Command(BaseCommand):
         refresh_time = promtime_to_sec(options["refresh_interval"])
 
         seconds_since_last_refresh = refresh_time
+        engine = None
+        if options["window"]:
+            engine = WindowEngine(WARDEN_JOB)
+        elif options["local"]:
+            engine = LocalEvaluator()
+
+        # stored queries keep the settings they were built with, e.g. the user slices of ARBITER_MIN_UID
+        if outdated := [policy.name for policy in Policy.objects.all() if (query := policy.rebuilt_query()) and query.query != policy.query]:
+            logger.warning(f"the queries of {', '.join(outdated)} were built with other settings, rebuild them with the refresh_queries command")
 
         while True:
             try:
@@ -34,12 +57,11 @@ class Command(BaseCommand):
                     policies = Policy.objects.all()
                 
                 seconds_since_last_refresh += cycle_time
-                if seconds_since_last_refresh >= refresh_time:
+                refresh = seconds_since_last_refresh >= refresh_time
+                if refresh:
                     seconds_since_last_refresh = 0
-                    for policy in policies:
-                        refresh_limits(policy)
                 
-                evaluate(policies)
+                evaluate(policies, refresh=refresh, engine=engine)
                 sleep(cycle_time)
                 if cycle_time == 0:
                     break
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from arbiter3.arbiter.models import UsagePolicy
+from arbiter3.arbiter.rules import recording_rules, rules_yaml
+
+
+class Command(BaseCommand):
+    help = "Writes the Prometheus recording rules that policies using recording rules look up"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true", help="include every active usage policy, not just those using recording rules, so the rules can be loaded before policies switch to them")
+        parser.add_argument("--interval", type=str, help="how often Prometheus evaluates the rules, e.g. 30s. Defaults to its global evaluation interval")
+        parser.add_argument("--group", type=str, default="arbiter", help="name of the rule group")
+        parser.add_argument("--output", "-o", type=str, help="file to write the rules to instead of stdout")
+
+    def handle(self, *args, **options):
+        policies = [
+            policy for policy in UsagePolicy.objects.filter(active=True).order_by("name")
+            if options["all"] or (policy.query_data.get("params") or {}).get("use_recording_rules")
+        ]
+        rules = recording_rules(policies)
+        rules_file = rules_yaml(rules, group=options["group"], interval=options["interval"])
+
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(rules_file)
+        else:
+            self.stdout.write(rules_file, ending="")
+        self.stderr.write(f"{len(rules)} recording rules for {len(policies)} policies")
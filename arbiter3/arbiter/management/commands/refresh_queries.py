@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from arbiter3.arbiter.models import Policy
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the stored queries of policies with the current settings, e.g. after ARBITER_MIN_UID changed"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="only list the policies whose queries are out of date")
+
+    def handle(self, *args, **options):
+        refreshed = 0
+        for policy in Policy.objects.order_by("name"):
+            query = policy.rebuilt_query()
+            if query is None or query.query == policy.query:
+                continue
+
+            self.stdout.write(f"{policy.name}: {policy.query} -> {query.query}")
+            refreshed += 1
+            if not options["dry_run"]:
+                policy.query_data = query.json()
+                policy.save()
+
+        self.stderr.write(f"{refreshed} policies {'are out of date' if options['dry_run'] else 'refreshed'}")
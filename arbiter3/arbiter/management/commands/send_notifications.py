@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from django.db.utils import OperationalError
+from arbiter3.arbiter.notify import send_notifications, logger
+from time import sleep
+
+class Command(BaseCommand):
+    help = "Sends the violation emails queued by the evaluation loop"
+
+    def add_arguments(self, parser):
+        parser.add_argument("-S", "--seconds", default=0, type=int)
+        parser.add_argument("-M", "--minutes", default=0, type=int)
+        parser.add_argument("-H", "--hours", default=0, type=int)
+        parser.add_argument("--batch-size", default=100, type=int)
+
+    def handle(self, *args, **options):
+        seconds = options["seconds"]
+        minutes = options["minutes"]
+        hours = options["hours"]
+
+        cycle_time = timezone.timedelta(seconds=seconds, minutes=minutes, hours=hours).total_seconds()
+
+        while True:
+            try:
+                counts = send_notifications(options["batch_size"])
+                if counts["sent"] or counts["failed"]:
+                    logger.info(f"notifications sent: {counts['sent']}, failed: {counts['failed']}")
+
+                sleep(cycle_time)
+                if cycle_time == 0:
+                    break
+
+            except OperationalError:
+                logger.warning('send_notifications loop failed to complete on operation error, likely an issue with concurency with sqlite locking the database')
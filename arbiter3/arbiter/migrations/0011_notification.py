@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:33
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("arbiter", "0010_alter_policy_options"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Notification",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                ("attempts", models.IntegerField(default=0)),
+                ("next_attempt", models.DateTimeField(default=django.utils.timezone.now)),
+                ("sent", models.DateTimeField(null=True)),
+                ("error", models.TextField(blank=True, default="")),
+                ("violation", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to="arbiter.violation")),
+            ],
+            options={
+                "indexes": [models.Index(fields=["sent", "next_attempt"], name="arbiter_not_sent_178b19_idx")],
+            },
+        ),
+    ]
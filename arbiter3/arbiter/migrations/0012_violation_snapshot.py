@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("arbiter", "0011_notification"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="violation",
+            name="snapshot",
+            field=models.JSONField(blank=True, editable=False, help_text="Usage of the target when the violation was created, see snapshot.py", null=True),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:42
+
+import django.db.models.deletion
+from django.db import migrations, models
+from arbiter3.arbiter.codec import encode_matrices
+from arbiter3.arbiter.promclient import Matrix, Series
+
+def snapshot_to_matrices(snapshot: dict) -> list[Matrix]:
+    start, step = snapshot["start"], snapshot["step"]
+    matrices = []
+    for resource in ("cpu", "mem"):
+        for proc, values in snapshot[resource]:
+            series = [Series(start + i * step, value) for i, value in enumerate(values) if value is not None]
+            matrices.append(Matrix({"proc": proc, "resource": resource}, series))
+
+    end = start + step * (len(snapshot["cpu"][0][1]) - 1 if snapshot["cpu"] else 0)
+    for proc, count in snapshot["counts"].items():
+        matrices.append(Matrix({"proc": proc, "resource": "count"}, [Series(end, count)]))
+    return matrices
+
+
+def encode_snapshots(apps, schema_editor):
+    Violation = apps.get_model("arbiter", "Violation")
+    UsageSnapshot = apps.get_model("arbiter", "UsageSnapshot")
+
+    snapshots = []
+    for violation in Violation.objects.filter(snapshot__isnull=False).only("id", "snapshot").iterator():
+        data = encode_matrices(snapshot_to_matrices(violation.snapshot))
+        snapshots.append(UsageSnapshot(violation_id=violation.id, data=data))
+    UsageSnapshot.objects.bulk_create(snapshots, batch_size=500)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("arbiter", "0012_violation_snapshot"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UsageSnapshot",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("data", models.BinaryField()),
+                ("violation", models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name="usage", to="arbiter.violation")),
+            ],
+        ),
+        migrations.RunPython(encode_snapshots, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name="violation",
+            name="snapshot",
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:15
+
+from django.db import migrations
+from arbiter3.arbiter.models import Policy, QueryData, QueryParameters
+
+
+def refresh_policy_queries(apps, schema_editor):
+    """
+    Rebuilds the stored queries, so that they only match the cgroups of user slices arbiter manages.
+    """
+    for policy in Policy.objects.all():
+        if policy.is_base_policy:
+            policy.query_data = QueryData.base_query(policy).json()
+            policy.save()
+            continue
+
+        query_params = policy.query_data.get("params", None)
+        if policy.query_data.get("is_raw_query", False) or not query_params:
+            continue
+
+        params = QueryParameters(
+            cpu_threshold=query_params.get("cpu_threshold", None),
+            mem_threshold=query_params.get("mem_threshold", None),
+            user_whitelist=query_params.get("user_whitelist", None),
+            proc_whitelist=query_params.get("proc_whitelist", None),
+            use_pss_metric=query_params.get("use_pss_metric", False),
+            use_recording_rules=query_params.get("use_recording_rules", False),
+        )
+
+        policy.query_data = QueryData.build_query(
+            lookback=policy.lookback,
+            domain=policy.domain,
+            params=params
+        ).json()
+
+        policy.save()
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("arbiter", "0013_usagesnapshot"),
+    ]
+
+    operations = [
+        migrations.RunPython(refresh_policy_queries, migrations.RunPython.noop)
+    ]
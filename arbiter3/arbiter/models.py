@@ -4,15 +4,23 @@ from dataclasses import dataclass, asdict
 from django.db import models
 from django.utils import timezone
 from django.contrib.auth.models import User
+from django.utils.functional import cached_property
 
-from arbiter3.arbiter.utils import get_uid, split_port
+from arbiter3.arbiter.utils import get_uid, user_slice_regex
 from arbiter3.arbiter.query import Q, increase, sum_by, sum_over_time
-from arbiter3.arbiter.conf import WARDEN_PORT, PROMETHEUS_CONNECTION, WARDEN_JOB
+from arbiter3.arbiter.rules import DOMAIN_LABEL, cpu_metric, mem_metric, cpu_rate_record, mem_average_record
+from arbiter3.arbiter.conf import WARDEN_PORT, ARBITER_MIN_UID
+from arbiter3.arbiter.inventory import HOST_INVENTORY
 from arbiter3.arbiter.prop import CPU_QUOTA, MEMORY_MAX
+from arbiter3.arbiter.promclient import Matrix
+from arbiter3.arbiter.codec import decode_matrices
 
 Limits = dict[str, any]
 UNSET_LIMIT = -1
 
+# the cgroups of the user slices arbiter manages, so that prometheus only returns their series
+USER_SLICES = user_slice_regex(ARBITER_MIN_UID)
+
 
 
 @dataclass
@@ -22,6 +30,7 @@ class QueryParameters:
     proc_whitelist: str | None = None  # prom matcher regex
     user_whitelist: str | None = None  # prom matcher regex
     use_pss_metric : bool = False
+    use_recording_rules: bool = False  # look up the series of generate_recording_rules
 
     def json(self):
         return asdict(self)
@@ -45,7 +54,7 @@ class QueryData:
     @staticmethod
     def base_query(base_policy) -> "QueryData":
 
-        query = Q('cgroup_warden_cpu_usage_seconds').like(instance=base_policy.domain)
+        query = Q('cgroup_warden_cpu_usage_seconds').like(instance=base_policy.domain, cgroup=USER_SLICES)
         params = None
         
         if stored_params := base_policy.query_data.get("params"):
@@ -73,7 +82,10 @@ class QueryData:
         We do not want to whitelist memory usage, as that cannot be 'taken' back.  
         """
 
-        like_filters = {'instance':domain}
+        if params.use_recording_rules:
+            return QueryData.recorded_query(lookback, domain, params)
+
+        like_filters = {'instance':domain, 'cgroup':USER_SLICES}
         notlike_filters = dict()
 
         lookback = int(lookback.total_seconds())
@@ -92,15 +104,7 @@ class QueryData:
         else:
             cpu_query = increase(Q('cgroup_warden_cpu_usage_seconds').like(**like_filters).not_like(**notlike_filters).over(f'{lookback}s')) / lookback > params.cpu_threshold
 
-        granularity = 30
-
-        datapoints = lookback // granularity
-
-        if datapoints:
-            mem_range = f'{lookback}s:{granularity}s'
-        else:
-            datapoints = lookback
-            mem_range = f'{lookback}s:1s'
+        mem_range, datapoints = QueryData.mem_range(lookback)
 
         if params.proc_whitelist:
             mem_metric = 'cgroup_warden_proc_memory_pss_bytes' #if params.use_pss_metric else 'cgroup_warden_proc_memory_usage_bytes'
@@ -125,6 +129,50 @@ class QueryData:
 
         return QueryData(query=str(query), params=params, is_raw_query=False)
 
+    @staticmethod
+    def mem_range(lookback: int) -> tuple[str, int]:
+        """
+        The subquery range memory usage is averaged over, sampled every 30 seconds
+        (or every second for shorter lookbacks), and the number of samples in it.
+        """
+        granularity = 30
+
+        datapoints = lookback // granularity
+
+        if datapoints:
+            return f'{lookback}s:{granularity}s', datapoints
+        return f'{lookback}s:1s', lookback
+
+    @staticmethod
+    def recorded_query(lookback: timedelta, domain: str, params: QueryParameters) -> "QueryData":
+        """
+        The query of build_query as instant lookups of the series recorded by the
+        rules of generate_recording_rules, which must be loaded into prometheus.
+        """
+        lookback = int(lookback.total_seconds())
+
+        notlike_filters = dict()
+        if params.user_whitelist:
+            notlike_filters['username'] = params.user_whitelist
+        if params.proc_whitelist:
+            notlike_filters['proc'] = params.proc_whitelist
+
+        def recorded(record: str) -> Q:
+            return Q(record).matches(**{DOMAIN_LABEL: domain}).like(cgroup=USER_SLICES).not_like(**notlike_filters)
+
+        queries = []
+        if params.cpu_threshold:
+            cpu_usage = recorded(cpu_rate_record(cpu_metric(params.proc_whitelist), lookback)) > params.cpu_threshold
+            # as in build_query, the threshold applies to each process before they are summed. Summing also
+            # drops the record's name and domain label, so the memory side's results have the same labels
+            queries.append(sum_by(cpu_usage, "username", "instance", "cgroup", "job"))
+        if params.mem_threshold:
+            mem_usage = recorded(mem_average_record(mem_metric(params.proc_whitelist), lookback))
+            queries.append(sum_by(mem_usage, "username", "instance", "cgroup", "job") > params.mem_threshold)
+
+        query = queries[0].lor(queries[1]) if len(queries) == 2 else (queries[0] if queries else None)
+        return QueryData(query=str(query), params=params, is_raw_query=False)
+
 
 class Policy(models.Model):
     class Meta:
@@ -188,9 +236,30 @@ class Policy(models.Model):
 
     @property
     def affected_hosts(self):
-        up_query = f"up{{job=~'{WARDEN_JOB}', instance=~'{self.domain}'}} > 0"
-        result = PROMETHEUS_CONNECTION.query(up_query)
-        return [split_port(r.metric["instance"]) for r in result]
+        return HOST_INVENTORY.hosts(self.domain)
+
+    def rebuilt_query(self) -> "QueryData | None":
+        """
+        The query arbiter builds for the policy with the current settings, or
+        None for raw queries. It differs from the stored query once e.g.
+        ARBITER_MIN_UID changed, until the policy is saved again.
+        """
+        if self.is_base_policy:
+            return QueryData.base_query(self)
+
+        query_params = self.query_data.get("params", None)
+        if self.query_data.get("is_raw_query", False) or not query_params:
+            return None
+
+        params = QueryParameters(
+            cpu_threshold=query_params.get("cpu_threshold", None),
+            mem_threshold=query_params.get("mem_threshold", None),
+            user_whitelist=query_params.get("user_whitelist", None),
+            proc_whitelist=query_params.get("proc_whitelist", None),
+            use_pss_metric=query_params.get("use_pss_metric", False),
+            use_recording_rules=query_params.get("use_recording_rules", False),
+        )
+        return QueryData.build_query(lookback=self.lookback, domain=self.domain, params=params)
 
 
 class BasePolicy(Policy):
@@ -305,6 +374,34 @@ class Violation(models.Model):
         return f'{self.target} - {self.policy}'
 
 
+class UsageSnapshot(models.Model):
+    """
+    Usage of a violation's target when the violation was created, see snapshot.py.
+    Stored as matrices in the format of codec.py.
+    """
+    violation = models.OneToOneField(Violation, on_delete=models.CASCADE, related_name="usage")
+    data = models.BinaryField()
+
+    @cached_property
+    def matrices(self) -> list[Matrix]:
+        return decode_matrices(self.data)
+
+
+class Notification(models.Model):
+    class Meta:
+        indexes = [models.Index(fields=["sent", "next_attempt"])]
+
+    violation = models.ForeignKey(Violation, on_delete=models.CASCADE)
+    created = models.DateTimeField(auto_now_add=True)
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    sent = models.DateTimeField(null=True)
+    error = models.TextField(blank=True, default="")
+
+    def __str__(self):
+        return f"{self.violation} ({'sent' if self.sent else f'{self.attempts} attempts'})"
+
+
 class Event(models.Model):
     class EventTypes(models.TextChoices):
         APPLY = ("Apply", "Limit Applied on a Target")
@@ -0,0 +1,125 @@
+import time
+import logging
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.mail import get_connection, EmailMultiAlternatives
+from django.utils import timezone
+
+from arbiter3.arbiter.models import Notification, Violation
+from arbiter3.arbiter.email import violation_email
+from arbiter3.arbiter.inventory import HOST_INVENTORY
+from arbiter3.arbiter.conf import (
+    PROMETHEUS_QUERY_TIMEOUT,
+    ARBITER_NOTIFICATION_WORKERS,
+    ARBITER_NOTIFICATION_RATE,
+    ARBITER_NOTIFICATION_RETRIES,
+)
+
+logger = logging.getLogger(__name__)
+
+# delay before the first retry of a failed notification, doubled on each further attempt
+RETRY_BACKOFF = timedelta(minutes=1)
+
+
+class RateLimiter:
+    """
+    Spaces out calls to `wait` so no more than `rate` happen per minute.
+    """
+
+    def __init__(self, rate: int):
+        self.interval = 60 / rate if rate else 0
+        self.last = None
+
+    def wait(self):
+        if self.interval and self.last is not None:
+            time.sleep(max(0, self.last + self.interval - time.monotonic()))
+        self.last = time.monotonic()
+
+
+RATE_LIMITER = RateLimiter(ARBITER_NOTIFICATION_RATE)
+
+
+def enqueue_notifications(violations: list[Violation]) -> list[Notification]:
+    """
+    Queues an email for each violation that is not a base status, to be sent by the send_notifications worker.
+    """
+    return Notification.objects.bulk_create(
+        [Notification(violation=violation) for violation in violations if not violation.is_base_status]
+    )
+
+
+def pending_notifications(limit: int) -> list[Notification]:
+    pending = Notification.objects.filter(
+        sent__isnull=True,
+        next_attempt__lte=timezone.now(),
+        attempts__lt=ARBITER_NOTIFICATION_RETRIES,
+    )
+    pending = pending.select_related("violation__target", "violation__policy", "violation__usage").order_by("next_attempt")
+    return list(pending[:limit])
+
+
+def render(notification: Notification) -> tuple[EmailMultiAlternatives | None, str]:
+    try:
+        return violation_email(notification.violation), ""
+    except Exception as e:
+        return None, f"error generating email: {e}"
+
+
+def record_failure(notification: Notification, error: str, now):
+    notification.attempts += 1
+    notification.error = error
+    notification.next_attempt = now + RETRY_BACKOFF * 2 ** (notification.attempts - 1)
+    if notification.attempts >= ARBITER_NOTIFICATION_RETRIES:
+        logger.error(f"Giving up on email for {notification.violation} after {notification.attempts} attempts: {error}")
+    else:
+        logger.warning(f"Could not send email for {notification.violation}, will retry: {error}")
+
+
+def send_notifications(limit: int = 100) -> dict[str, int]:
+    """
+    Renders the due notifications in parallel and sends them over a single
+    connection to the mail server, no faster than ARBITER_NOTIFICATION_RATE.
+    """
+    notifications = pending_notifications(limit)
+    counts = {"sent": 0, "failed": 0}
+    if not notifications:
+        return counts
+
+    # emails list the policy's hosts, look them up once rather than in every render
+    try:
+        HOST_INVENTORY.refresh_if_stale(timeout=PROMETHEUS_QUERY_TIMEOUT)
+    except Exception as e:
+        logger.error(f"Unable to refresh host inventory, using last known hosts: {e}")
+
+    with ThreadPoolExecutor(max_workers=min(ARBITER_NOTIFICATION_WORKERS, len(notifications))) as executor:
+        rendered = list(executor.map(render, notifications))
+    errors = [error for _, error in rendered]
+
+    try:
+        with get_connection(fail_silently=False) as connection:
+            for i, (notification, (message, _)) in enumerate(zip(notifications, rendered)):
+                if message is None:
+                    continue
+                RATE_LIMITER.wait()
+                try:
+                    connection.send_messages([message])
+                    notification.sent = timezone.now()
+                    logger.info(f"Sent mail to {message.to} for {notification.violation}")
+                except Exception as e:
+                    errors[i] = str(e)
+    except Exception as e:
+        # the connection itself failed, everything not yet sent is retried
+        logger.error(f"Unable to connect to mail server: {e}")
+        errors = [error or str(e) for error in errors]
+
+    now = timezone.now()
+    for notification, error in zip(notifications, errors):
+        if notification.sent:
+            counts["sent"] += 1
+        else:
+            record_failure(notification, error, now)
+            counts["failed"] += 1
+
+    Notification.objects.bulk_update(notifications, ["attempts", "next_attempt", "sent", "error"])
+    return counts
@@ -0,0 +1,94 @@
+import logging
+from collections import defaultdict
+from typing import Callable
+
+from arbiter3.arbiter.models import Policy
+from arbiter3.arbiter.promclient import Vector
+
+logger = logging.getLogger(__name__)
+
+# added to each policy's results in a combined query, and removed again before they are used
+POLICY_LABEL = "arbiter_policy"
+
+
+def label_replace(query: str, label: str, value: str) -> str:
+    # an empty source regex matches every series, setting the label unconditionally
+    return f'label_replace(({query}), "{label}", "{value}", "", "")'
+
+
+def combinable(policy: Policy) -> bool:
+    """
+    Whether the policy's query was built by arbiter, so it is known to return an instant vector.
+    """
+    return policy.is_base_policy or not policy.query_data.get("is_raw_query")
+
+
+class QueryPlan:
+    """
+    The queries to send to prometheus for a set of policies. Policies covering
+    the same domain over the same lookback are sent as a single query, each
+    policy's part tagged with its id in POLICY_LABEL and the parts joined with
+    `or`. As no two parts share a label set, `or` keeps every part's results.
+
+    Base policies are always sent on their own, so that a usage policy whose
+    query prometheus rejects can't hold up the base limits of its domain.
+    """
+
+    def __init__(self, policies: list[Policy]):
+        self.policies = policies
+        groups = defaultdict(list)
+        for policy in policies:
+            key = (policy.domain, policy.lookback) if combinable(policy) and not policy.is_base_policy else ("single", policy.pk)
+            groups[key].append(policy)
+        self.groups: list[list[Policy]] = list(groups.values())
+
+    @property
+    def queries(self) -> list[str]:
+        return [self.query(group) for group in self.groups]
+
+    @staticmethod
+    def query(group: list[Policy]) -> str:
+        if len(group) == 1:
+            return group[0].query
+        return " or ".join(label_replace(policy.query, POLICY_LABEL, str(policy.pk)) for policy in group)
+
+    def demultiplex(self, results: list[list | Exception], retry: Callable[[list[str]], list] | None = None) -> list[tuple[Policy, list]]:
+        """
+        Splits the results of the plan's queries into the results of each
+        policy, in policy order. When a combined query fails, its policies'
+        own queries are sent again with `retry`, such as run_queries, so only
+        a policy whose own query fails is lost. Those are logged and left out.
+        """
+        by_policy = {}
+        failed = [group for group, result in zip(self.groups, results) if isinstance(result, Exception) and len(group) > 1]
+        retried = iter(retry([policy.query for group in failed for policy in group]) if retry and failed else [])
+
+        for group, result in zip(self.groups, results):
+            if isinstance(result, Exception) and len(group) > 1 and retry:
+                logger.warning(f"combined query of {len(group)} policies failed, querying them one at a time: {result}")
+                for policy in group:
+                    if isinstance(own := next(retried), Exception):
+                        logger.error(f"Unable to query violations of '{policy}': {own}")
+                    else:
+                        by_policy[policy.pk] = own
+                continue
+
+            if isinstance(result, Exception):
+                for policy in group:
+                    logger.error(f"Unable to query violations of '{policy}': {result}")
+                continue
+
+            if len(group) == 1:
+                by_policy[group[0].pk] = result
+                continue
+
+            for policy in group:
+                by_policy[policy.pk] = []
+            for vector in result:
+                metric = dict(vector.metric)
+                if (pk := metric.pop(POLICY_LABEL, None)) is None or int(pk) not in by_policy:
+                    logger.warning(f"result of a combined policy query without a known policy: {vector.metric}")
+                    continue
+                by_policy[int(pk)].append(Vector(metric, vector.value))
+
+        return [(policy, by_policy[policy.pk]) for policy in self.policies if policy.pk in by_policy]
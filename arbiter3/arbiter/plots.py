@@ -1,33 +1,86 @@
 import logging
+import hashlib
 from datetime import datetime, timedelta, timezone
 import re
 
 from plotly.graph_objects import Figure, Scatter
 
+from django.core.cache import caches
 from django.utils.timezone import get_current_timezone, localtime
 
-from arbiter3.arbiter.models import Violation
+from arbiter3.arbiter.models import Violation, UsageSnapshot
 from arbiter3.arbiter.utils import bytes_to_gib, BYTES_PER_GIB
-from arbiter3.arbiter.conf import PROMETHEUS_CONNECTION
-from arbiter3.arbiter.promclient import sort_matrices_by_avg, combine_last_matrices, Matrix
+from arbiter3.arbiter.codec import encode_matrices, decode_columns
+from arbiter3.arbiter.conf import PROMETHEUS_CONNECTION, ARBITER_GRAPH_CACHE, ARBITER_GRAPH_CACHE_TTL, ARBITER_GRAPH_CACHE_HISTORICAL_TTL
+from arbiter3.arbiter.promclient import sort_matrices_by_avg, combine_last_matrices, Matrix, ColumnarMatrix, Vector, Series
 from arbiter3.arbiter.query import Q, rate, sum_by, max_over_time, avg_over_time
 
 logger = logging.getLogger(__name__)
 
 
+# samples this recent may not have been scraped yet, so graphs reaching them are only cached briefly
+RECENT_WINDOW = timedelta(minutes=5)
+
+
 class QueryError(Exception):
     pass
 
 
+def _graph_cache_key(kind: str, query: str, start: datetime, end: datetime, step: str) -> str:
+    # hashed, as some cache backends limit the length and characters of keys
+    digest = hashlib.sha256(f"{kind}|{query}|{start.timestamp()}|{end.timestamp()}|{step}".encode()).hexdigest()
+    return f"arbiter:graph:{digest}"
+
+
+def _graph_cache_ttl(end: datetime) -> int:
+    if end >= datetime.now(timezone.utc) - RECENT_WINDOW:
+        return ARBITER_GRAPH_CACHE_TTL
+    return ARBITER_GRAPH_CACHE_HISTORICAL_TTL
+
+
+def cached_query_range(query: str, start: datetime, end: datetime, step: str) -> list[ColumnarMatrix]:
+    """
+    query_range over the window aligned to the step, with the result kept in
+    ARBITER_GRAPH_CACHE. Windows are aligned so that graphs of the same range
+    drawn moments apart make the same query.
+    """
+    start, end = align_to_step(start, end, step)
+    key = _graph_cache_key("range", query, start, end, step)
+    cache = caches[ARBITER_GRAPH_CACHE]
+    if (data := cache.get(key)) is not None:
+        return decode_columns(data)
+
+    matrices = PROMETHEUS_CONNECTION.query_range(query=query, start=start.timestamp(), end=end.timestamp(), step=step, columnar=True)
+    if ttl := _graph_cache_ttl(end):
+        cache.set(key, encode_matrices(matrices), ttl)
+    return matrices
+
+
+def cached_query(query: str, time: datetime, step: str) -> list[Vector]:
+    """
+    An instant query at `time` aligned to the step, cached like cached_query_range.
+    """
+    _, time = align_to_step(time, time, step)
+    key = _graph_cache_key("instant", query, time, time, step)
+    cache = caches[ARBITER_GRAPH_CACHE]
+    if (data := cache.get(key)) is not None:
+        return [Vector(metric, Series(timestamp, value)) for metric, timestamp, value in data]
+
+    result = PROMETHEUS_CONNECTION.query(query=query, time=time.timestamp())
+    if ttl := _graph_cache_ttl(time):
+        cache.set(key, [(vector.metric, vector.value.timestamp, vector.value.value) for vector in result], ttl)
+    return result
+
+
 def _usage_graph_data(
         query: str, 
         start: datetime, 
         end: datetime, 
         step: str, 
-    ) -> list[Matrix]:
+    ) -> list[ColumnarMatrix]:
 
     try:
-        matrices = PROMETHEUS_CONNECTION.query_range(query=query, start=start.timestamp(), end=end.timestamp(), step=step)
+        matrices = cached_query_range(query, start, end, step)
     except Exception as e:
         raise QueryError(f'Could not run query: {e}')
 
@@ -39,12 +92,13 @@ def _usage_graph_data(
     return matrices
 
 
-def _graph_from_matrices(matrices: list[Matrix], color_by: str, threshold: float | int | None, whitelist: str | None = None, counts : dict| None = None) -> Figure:
+def _graph_from_matrices(matrices: list[Matrix | ColumnarMatrix], color_by: str, threshold: float | int | None, whitelist: str | None = None, counts : dict| None = None) -> Figure:
     fig = Figure()
 
     for result_matrix in reversed(matrices):
-        timestamps = [datetime.fromtimestamp(point.timestamp) for point in result_matrix.values]
-        values = [float(point.value) for point in result_matrix.values]
+        columns = ColumnarMatrix.from_matrix(result_matrix)
+        timestamps = [datetime.fromtimestamp(timestamp) for timestamp in columns.timestamps.tolist()]
+        values = columns.samples
         
         name = result_matrix.metric[color_by]
         display_name = name
@@ -84,11 +138,13 @@ def proc_usage_graph(
         unreported_query: Q = None,
     ) -> Figure:
 
+    # the process counts cover the same window as the cached usage
+    start, end = align_to_step(start, end, step)
     matrices = _usage_graph_data(str(query), start, end, step)
     
     if unreported_query:
         try:
-            unreported_matrix = PROMETHEUS_CONNECTION.query_range(query=str(unreported_query), start=start.timestamp(), end=end.timestamp(), step=step)
+            unreported_matrix = cached_query_range(str(unreported_query), start, end, step)
         except Exception as e:
             raise QueryError(f'Could not run unreported query: {e}')
         
@@ -105,7 +161,7 @@ def proc_usage_graph(
         proc_counts_query = max_over_time(Q('cgroup_warden_proc_count').over(window))
         proc_counts_query._matchers = query._matchers
 
-        proc_counts = {result.metric['proc']: int(result.value.value) for result in PROMETHEUS_CONNECTION.query(query=str(proc_counts_query))}
+        proc_counts = {result.metric['proc']: int(result.value.value) for result in cached_query(str(proc_counts_query), end, step)}
     except Exception as e:
         raise QueryError(f'Could not run unreported query: {e}')
     
@@ -171,6 +227,26 @@ def mem_usage_figure(host: str, start: datetime, end: datetime, step="30s", user
     return figure
 
 
+def violation_snapshot(violation: Violation) -> list[Matrix] | None:
+    try:
+        return violation.usage.matrices
+    except UsageSnapshot.DoesNotExist:
+        return None
+
+
+def snapshot_figure(snapshot: list[Matrix], resource: str, threshold: float | int | None, whitelist: str | None = None) -> Figure:
+    """
+    The process usage graph stored with a violation, drawn without querying Prometheus.
+    """
+    return _graph_from_matrices(
+        [matrix for matrix in snapshot if matrix.metric["resource"] == resource],
+        color_by='proc',
+        threshold=threshold,
+        whitelist=whitelist,
+        counts={matrix.metric["proc"]: int(matrix.values[0].value) for matrix in snapshot if matrix.metric["resource"] == "count"},
+    )
+
+
 def violation_cpu_usage_figure(violation: Violation, step: str = "1m") -> Figure | None:
     username = violation.target.username
     host = violation.target.instance
@@ -178,6 +254,10 @@ def violation_cpu_usage_figure(violation: Violation, step: str = "1m") -> Figure
     end = violation.timestamp
     step = align_with_prom_limit(start, end, step)
 
+    if snapshot := violation_snapshot(violation):
+        figure = snapshot_figure(snapshot, "cpu", violation.policy.cpu_threshold, violation.policy.proc_whitelist)
+        figure.update_layout(title=f"CPU usage for {username} on {host}", yaxis_title="Cores")
+        return figure
 
     figure = cpu_usage_figure(
         host=host,
@@ -204,6 +284,11 @@ def violation_mem_usage_figure(violation: Violation, step: str = "1m") -> Figure
     if threshold := violation.policy.mem_threshold:
         threshold = bytes_to_gib(threshold)
 
+    if snapshot := violation_snapshot(violation):
+        figure = snapshot_figure(snapshot, "mem", threshold, violation.policy.proc_whitelist)
+        figure.update_layout(title=f"Memory usage for {username} on {host}", yaxis_title="GiB")
+        return figure
+
     figure = mem_usage_figure(
         host=host,
         start=start,
@@ -226,13 +311,13 @@ def time_aligned_and_local(start: datetime, end: datetime, step: datetime) -> tu
 
 
 def align_to_step(start: datetime, end: datetime, step: str = "15s") -> tuple[datetime, datetime]:
-    start_seconds = int(start.astimezone(timezone.utc).timestamp())
-    end_seconds = int(start.astimezone(timezone.utc).timestamp())
+    """
+    Rounds start and end down to a multiple of the step since the epoch, dropping fractions of a second.
+    """
+    step_seconds = _step_seconds(step)
 
-    if step[-1] == "s":
-        step_seconds = int(step[:-1])
-    elif step[-1] == "m":
-        step_seconds = int(step[:-1]) * 60
+    start_seconds = start.timestamp()
+    end_seconds = end.timestamp()
 
     start_delta = timedelta(seconds=(start_seconds % step_seconds))
     end_delta = timedelta(seconds=(end_seconds % step_seconds))
@@ -240,13 +325,19 @@ def align_to_step(start: datetime, end: datetime, step: str = "15s") -> tuple[da
     return start - start_delta, end - end_delta
 
 
-def align_with_prom_limit(start: datetime, end: datetime, step: str) -> str:
-    total_range_seconds = (end - start).total_seconds()
-
+def _step_seconds(step: str) -> int:
     if step[-1] == "s":
-        step_seconds = int(step[:-1])
+        return int(step[:-1])
     elif step[-1] == "m":
-        step_seconds = int(step[:-1]) * 60
+        return int(step[:-1]) * 60
+    elif step[-1] == "h":
+        return int(step[:-1]) * 60 * 60
+    raise ValueError(f"unsupported step {step}")
+
+
+def align_with_prom_limit(start: datetime, end: datetime, step: str) -> str:
+    total_range_seconds = (end - start).total_seconds()
+    step_seconds = _step_seconds(step)
 
     if total_range_seconds / step_seconds >= 400:
         return f"{int(total_range_seconds // 400)}s"
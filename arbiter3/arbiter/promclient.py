@@ -1,7 +1,22 @@
+import re
+import json
+import zlib
+import codecs
+import asyncio
+import weakref
+import aiohttp
 import requests
-from urllib.parse import urljoin
-from collections import defaultdict
-from typing import NamedTuple
+import numpy as np
+from collections import Counter
+from urllib.parse import urljoin, urlencode
+from typing import NamedTuple, Iterator, Iterable
+
+from arbiter3.arbiter.resilience import QueryPolicy
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 class Series(NamedTuple):
     timestamp: int
@@ -17,6 +32,63 @@ class Matrix(NamedTuple):
     metric: dict[str, str]
     values: list[Series]
 
+class ColumnarMatrix:
+    """
+    A range query series as float64 arrays of timestamps and samples. `values`
+    is a Series view of them for code written against Matrix.
+    """
+    __slots__ = ("metric", "timestamps", "samples", "_values")
+
+    def __init__(self, metric: dict[str, str], timestamps: np.ndarray, samples: np.ndarray):
+        self.metric = metric
+        self.timestamps = timestamps
+        self.samples = samples
+        self._values = None
+
+    @classmethod
+    def from_matrix(cls, matrix: "Matrix | ColumnarMatrix") -> "ColumnarMatrix":
+        if isinstance(matrix, ColumnarMatrix):
+            return matrix
+        timestamps = np.fromiter((float(s.timestamp) for s in matrix.values), np.float64, len(matrix.values))
+        samples = np.fromiter((float(s.value) for s in matrix.values), np.float64, len(matrix.values))
+        return cls(matrix.metric, timestamps, samples)
+
+    @property
+    def values(self) -> list[Series]:
+        if self._values is None:
+            self._values = [Series(t, v) for t, v in zip(self.timestamps.tolist(), self.samples.tolist())]
+        return self._values
+
+    def __len__(self) -> int:
+        return len(self.samples)
+
+    def __repr__(self) -> str:
+        return f"ColumnarMatrix(metric={self.metric}, points={len(self)})"
+
+
+class ColumnarVectors:
+    """
+    An instant query result as one float64 array of samples across all series.
+    Iterates as Vector views for code written against list[Vector].
+    """
+    __slots__ = ("metrics", "timestamps", "samples")
+
+    def __init__(self, metrics: list[dict[str, str]], timestamps: np.ndarray, samples: np.ndarray):
+        self.metrics = metrics
+        self.timestamps = timestamps
+        self.samples = samples
+
+    def __getitem__(self, i: int) -> Vector:
+        return Vector(self.metrics[i], Series(float(self.timestamps[i]), float(self.samples[i])))
+
+    def __iter__(self) -> Iterator[Vector]:
+        for metric, timestamp, sample in zip(self.metrics, self.timestamps.tolist(), self.samples.tolist()):
+            yield Vector(metric, Series(timestamp, sample))
+
+    def __len__(self) -> int:
+        return len(self.metrics)
+
+
 def parse_vector_result(result: dict[str, str]) -> list[Vector]:
     vectors = []
     for r in result:
@@ -38,11 +110,189 @@ def parse_matrix_result(result: dict[str, str]) -> list[Matrix]:
     return matrices
 
 
+def parse_vector_columns(result: dict[str, str]) -> ColumnarVectors:
+    metrics, values = [], []
+    for r in result:
+        metrics.append(r["metric"])
+        values.append(r["value"])
+    points = np.array(values, dtype=np.float64).reshape(-1, 2)
+    return ColumnarVectors(metrics, points[:, 0], points[:, 1])
+
+
+def parse_matrix_columns(result: dict[str, str]) -> list[ColumnarMatrix]:
+    matrices = []
+    for r in result:
+        points = np.array(r["values"], dtype=np.float64).reshape(-1, 2)
+        matrices.append(ColumnarMatrix(r["metric"], points[:, 0], points[:, 1]))
+    return matrices
+
+
+class ResponseDecoder:
+    """
+    Decodes a query response into its result type and its results, with the standard library.
+    """
+    # whether the response body is read as it arrives instead of up front
+    stream = False
+    chunk_size = 64 * 1024
+
+    def loads(self, content: bytes) -> dict:
+        return json.loads(content)
+
+    def decode(self, response: requests.Response) -> tuple[str, Iterable[dict]]:
+        return self.decode_chunks(response.iter_content(self.chunk_size))
+
+    def decode_chunks(self, chunks: Iterable[bytes]) -> tuple[str, Iterable[dict]]:
+        return self.decode_content(b"".join(chunks))
+
+    def decode_content(self, content: bytes) -> tuple[str, Iterable[dict]]:
+        data = self.loads(content)["data"]
+        return data["resultType"], data["result"]
+
+
+class OrjsonDecoder(ResponseDecoder):
+    """
+    Decodes the whole response with orjson, several times faster than the standard library.
+    """
+
+    def loads(self, content: bytes) -> dict:
+        return orjson.loads(content)
+
+
+class StreamingDecoder(ResponseDecoder):
+    """
+    Decodes the results one at a time as the response arrives, so neither the whole
+    body nor all of the decoded results need to be held at once.
+    """
+    stream = True
+
+    HEADER = re.compile(r'"resultType"\s*:\s*"(\w+)"\s*,\s*"result"\s*:\s*\[')
+    SEPARATORS = re.compile(r"[\s,]*")
+    DECODER = json.JSONDecoder()
+
+    def __init__(self, chunk_size: int = 64 * 1024):
+        self.chunk_size = chunk_size
+
+    def decode_content(self, content: bytes) -> tuple[str, Iterable[dict]]:
+        # a body that has already been read still isn't decoded into one tree
+        return self.decode_chunks(content[i:i + self.chunk_size] for i in range(0, len(content), self.chunk_size))
+
+    def decode_chunks(self, chunks: Iterable[bytes]) -> tuple[str, Iterable[dict]]:
+        chunks = iter(chunks)
+        text = codecs.getincrementaldecoder("utf-8")()
+
+        buffer = ""
+        for chunk in chunks:
+            buffer += text.decode(chunk)
+            if match := self.HEADER.search(buffer):
+                return match.group(1), self._results(buffer[match.end():], chunks, text)
+
+        # laid out differently than Prometheus does, decode it whole
+        data = json.loads(buffer + text.decode(b"", final=True))["data"]
+        return data["resultType"], data["result"]
+
+    def _results(self, buffer: str, chunks: Iterator[bytes], text: codecs.IncrementalDecoder) -> Iterator[dict]:
+        position = 0
+        while True:
+            position = self.SEPARATORS.match(buffer, position).end()
+            if position < len(buffer) and buffer[position] == "]":
+                return
+
+            try:
+                result, position = self.DECODER.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # the result continues in the next chunk, drop what has been decoded
+                chunk = next(chunks, None)
+                if chunk is None:
+                    raise
+                buffer = buffer[position:] + text.decode(chunk)
+                position = 0
+                continue
+
+            yield result
+
+
+DECODERS = {
+    "json": ResponseDecoder,
+    "orjson": OrjsonDecoder,
+    "stream": StreamingDecoder,
+}
+
+
+def get_decoder(name: str = "auto") -> ResponseDecoder:
+    """
+    'auto' is orjson when it is installed, otherwise the streaming decoder.
+    """
+    if name == "auto":
+        name = "orjson" if orjson else "stream"
+    if name == "orjson" and orjson is None:
+        raise ValueError("the orjson decoder needs orjson installed")
+    return DECODERS[name]()
+
+
+def parse_result(result_type: str, result: Iterable[dict], columnar: bool = False) -> list[Vector] | list[Matrix] | ColumnarVectors | list[ColumnarMatrix]:
+    match result_type:
+        case 'matrix':
+            return parse_matrix_columns(result) if columnar else parse_matrix_result(result)
+        case 'vector':
+            return parse_vector_columns(result) if columnar else parse_vector_result(result)
+        case _:
+            raise NotImplementedError
+
+
+# queries whose url encoded parameters are longer than this are sent as a form
+# POST, as prometheus or a proxy in front of it may cut off or refuse long urls
+POST_THRESHOLD = 2048
+
+# the encodings decompress() understands
+ACCEPT_ENCODING = "gzip, deflate"
+
+FORM_HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
+
+TRANSFER_COUNTERS = ("requests", "posts", "compressed", "wire_bytes", "body_bytes")
+
+
+def use_post(params: dict, post_threshold: int | None) -> bool:
+    return post_threshold is not None and len(urlencode(params)) > post_threshold
+
+
+def decompress(body: bytes, encoding: str | None) -> bytes:
+    """
+    Decodes a gzip or deflate Content-Encoding, which some servers send as a
+    bare deflate stream rather than zlib wrapped.
+    """
+    if encoding not in ("gzip", "x-gzip", "deflate"):
+        return body
+    try:
+        # detects a gzip or zlib header
+        return zlib.decompress(body, zlib.MAX_WBITS | 32)
+    except zlib.error:
+        if encoding != "deflate":
+            raise
+        return zlib.decompress(body, -zlib.MAX_WBITS)
+
+
+def transfer_stats(*sessions) -> dict[str, int]:
+    """
+    Transfer counters summed across sessions, wire_bytes being what was
+    received from prometheus and body_bytes what that decompressed to.
+    """
+    stats = {name: sum(session.transfer[name] for session in sessions) for name in TRANSFER_COUNTERS}
+    stats["saved_bytes"] = stats["body_bytes"] - stats["wire_bytes"]
+    return stats
+
+
 class PrometheusSession(requests.Session):
-    def __init__(self, base_url, username=None, password=None, verify=True, *args, **kwargs):
+    def __init__(self, base_url, username=None, password=None, verify=True, decoder: ResponseDecoder | None = None, policy: QueryPolicy | None = None, default_timeout: float | None = None, post_threshold: int | None = POST_THRESHOLD, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.decoder = decoder or get_decoder()
+        self.policy = policy
+        # for queries made without a timeout, so a slow prometheus can't hold up a caller indefinitely
+        self.default_timeout = default_timeout
+        # None always sends GET requests
+        self.post_threshold = post_threshold
+        self.transfer = Counter()
         self.base_url = base_url if base_url.endswith("/") else base_url + "/"
-        self.headers.update({"Content-Type": "application/json"})
+        self.headers.update({"Content-Type": "application/json", "Accept-Encoding": ACCEPT_ENCODING})
         if username and password:
             self.auth = requests.auth.HTTPBasicAuth(username, password)
         self.verify = verify
@@ -52,14 +302,57 @@ class PrometheusSession(requests.Session):
         return super().get(urljoin(self.base_url, path), *args, **kwargs)
 
 
-    def validate_response(self, response: requests.Response):
+    def post(self, path, *args, **kwargs):
+        return super().post(urljoin(self.base_url, path), *args, **kwargs)
+
+
+    def send_query(self, path: str, params: dict, **kwargs) -> requests.Response:
+        """
+        GETs the query, or POSTs it as a form if its parameters are too long for a url.
+        """
+        self.transfer["requests"] += 1
+        if use_post(params, self.post_threshold):
+            self.transfer["posts"] += 1
+            return self.post(path, data=params, headers=FORM_HEADERS, **kwargs)
+        return self.get(path, params=params, **kwargs)
+
+
+    def counted(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        for chunk in chunks:
+            self.transfer["body_bytes"] += len(chunk)
+            yield chunk
+
+
+    def decode_response(self, response: requests.Response) -> tuple[str, Iterable[dict]]:
         response.raise_for_status()
-        return response.json()
+        # urllib3 decompresses the body as it is read
+        return self.decoder.decode_chunks(self.counted(response.iter_content(self.decoder.chunk_size)))
+
+
+    def fetch(self, path: str, params: dict, timeout=None, columnar=False, result_types=("matrix", "vector")):
+        """
+        Sends a query, under the session's policy if it has one, and parses its result.
+        """
+        def attempt():
+            # results are parsed before the response is closed, as a streaming decoder reads them from it
+            with self.send_query(path, params, timeout=timeout or self.default_timeout, stream=self.decoder.stream) as response:
+                result_type, result = self.decode_response(response)
+                if result_type not in result_types:
+                    raise NotImplementedError
+                parsed = parse_result(result_type, result, columnar=columnar)
+                # the raw stream counts the bytes read off the connection, before decompression
+                self.transfer["wire_bytes"] += response.raw.tell()
+                self.transfer["compressed"] += response.headers.get("Content-Encoding") in ("gzip", "x-gzip", "deflate")
+                return parsed
+
+        return self.policy.call(attempt) if self.policy else attempt()
 
 
-    def query(self, query, time=None, timeout=None) -> list[Vector] | list[Matrix]:
+    def query(self, query, time=None, timeout=None, columnar=False) -> list[Vector] | list[Matrix] | ColumnarVectors | list[ColumnarMatrix]:
         """
         https://prometheus.io/docs/prometheus/latest/querying/api/#instant-queries
+
+        With `columnar` the samples are parsed into NumPy arrays instead of Series.
         """
         
         params = {"query": query}
@@ -70,20 +363,14 @@ class PrometheusSession(requests.Session):
         if timeout:
             params["timeout"] = timeout
 
-        response = self.get("api/v1/query", params=params, timeout=timeout)
-        data = self.validate_response(response)['data']
-        match data['resultType']:
-            case 'matrix':
-                return parse_matrix_result(data['result'])
-            case 'vector':
-                return parse_vector_result(data['result'])
-            case _:
-                raise NotImplementedError
+        return self.fetch("api/v1/query", params, timeout=timeout, columnar=columnar)
 
 
-    def query_range(self, query, start, end, step, timeout=None) -> list[Matrix]:
+    def query_range(self, query, start, end, step, timeout=None, columnar=False) -> list[Matrix] | list[ColumnarMatrix]:
         """
         https://prometheus.io/docs/prometheus/latest/querying/api/#range-queries
+
+        With `columnar` the samples are parsed into NumPy arrays instead of Series.
         """
 
         params = {
@@ -96,42 +383,160 @@ class PrometheusSession(requests.Session):
         if timeout:
             params['timeout'] = timeout
 
-        response = self.get("api/v1/query_range", params=params, timeout=timeout)
-        data = self.validate_response(response)['data']
-        match data['resultType']:
-            case 'matrix':
-                return parse_matrix_result(data['result'])
-            case _:
-                raise NotImplementedError 
+        return self.fetch("api/v1/query_range", params, timeout=timeout, columnar=columnar, result_types=("matrix",))
             
 
-def sort_matrices_by_avg(matrices: list[Matrix]) -> list[Matrix]:
-    averages = []
-    for m in matrices:
-        total = sum([float(s.value) for s in m.values])
-        count = len(m.values)
-        if count == 0:
-            continue
-        average = total / count
-        averages.append( (average, m) )
-    averages = sorted(averages, key=lambda a: a[0], reverse=True)
-    return [r[1] for r in averages]
+class AsyncPrometheusSession:
+    """
+    The query API of PrometheusSession for coroutines, over a pooled aiohttp session.
+    aiohttp sessions belong to the loop they were made on, so each loop the
+    client is used from gets its own, kept for the life of the loop.
+    """
+
+    def __init__(self, base_url, username=None, password=None, verify=True, decoder: ResponseDecoder | None = None, max_connections: int = 8, policy: QueryPolicy | None = None, default_timeout: float | None = None, post_threshold: int | None = POST_THRESHOLD):
+        self.base_url = base_url if base_url.endswith("/") else base_url + "/"
+        self.policy = policy
+        self.default_timeout = default_timeout
+        self.post_threshold = post_threshold
+        self.transfer = Counter()
+        self.auth = aiohttp.BasicAuth(username, password) if username and password else None
+        self.ssl = None if verify else False
+        self.decoder = decoder or get_decoder()
+        self.max_connections = max_connections
+        self._sessions: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aiohttp.ClientSession] = weakref.WeakKeyDictionary()
+
+    def session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            # the connection limit also bounds how many queries run at once
+            connector = aiohttp.TCPConnector(limit=self.max_connections, ssl=self.ssl)
+            # bodies are decompressed by decompress() so their size on the wire can be counted
+            session = self._sessions[loop] = aiohttp.ClientSession(
+                connector=connector,
+                auth=self.auth,
+                headers={"Accept-Encoding": ACCEPT_ENCODING},
+                auto_decompress=False,
+            )
+        return session
+
+    async def close(self):
+        """
+        Closes the running loop's session.
+        """
+        if session := self._sessions.pop(asyncio.get_running_loop(), None):
+            await session.close()
+
+    async def get(self, path, params: dict, timeout=None) -> tuple[str, Iterable[dict]]:
+        """
+        GETs the query, or POSTs it as a form if its parameters are too long for a url.
+        """
+        params = {name: str(value) for name, value in params.items()}
+        self.transfer["requests"] += 1
+        if post := use_post(params, self.post_threshold):
+            self.transfer["posts"] += 1
+
+        async with self.session().request(
+            "POST" if post else "GET",
+            urljoin(self.base_url, path),
+            params=None if post else params,
+            data=params if post else None,
+            timeout=aiohttp.ClientTimeout(total=timeout or self.default_timeout),
+        ) as response:
+            response.raise_for_status()
+            wire = await response.read()
+            encoding = response.headers.get("Content-Encoding")
+
+        body = decompress(wire, encoding)
+        self.transfer["wire_bytes"] += len(wire)
+        self.transfer["body_bytes"] += len(body)
+        self.transfer["compressed"] += body is not wire
+        return self.decoder.decode_content(body)
+
+    async def fetch(self, path: str, params: dict, timeout=None, columnar=False, result_types=("matrix", "vector")):
+        """
+        Sends a query, under the session's policy if it has one, and parses its result.
+        """
+        async def attempt():
+            result_type, result = await self.get(path, params, timeout=timeout)
+            if result_type not in result_types:
+                raise NotImplementedError
+            return parse_result(result_type, result, columnar=columnar)
+
+        return await self.policy.acall(attempt) if self.policy else await attempt()
+
+    async def query(self, query, time=None, timeout=None, columnar=False) -> list[Vector] | list[Matrix] | ColumnarVectors | list[ColumnarMatrix]:
+        """
+        https://prometheus.io/docs/prometheus/latest/querying/api/#instant-queries
+        """
+        params = {"query": query}
+
+        if time:
+            params["time"] = time
+
+        if timeout:
+            params["timeout"] = timeout
 
+        return await self.fetch("api/v1/query", params, timeout=timeout, columnar=columnar)
 
-def combine_last_matrices(matrices: list[Matrix], n: int) -> list[Matrix]:
+    async def query_range(self, query, start, end, step, timeout=None, columnar=False) -> list[Matrix] | list[ColumnarMatrix]:
+        """
+        https://prometheus.io/docs/prometheus/latest/querying/api/#range-queries
+        """
+        params = {
+            "query": query,
+            "start": start,
+            "end": end,
+            "step": step,
+        }
+
+        if timeout:
+            params["timeout"] = timeout
+
+        return await self.fetch("api/v1/query_range", params, timeout=timeout, columnar=columnar, result_types=("matrix",))
+
+
+def sum_matrices(matrices: list[Matrix | ColumnarMatrix]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    The sum of the matrices at each timestamp any of them has a sample at, as sorted timestamps and sums.
+    """
+    columns = [ColumnarMatrix.from_matrix(m) for m in matrices]
+    if not columns:
+        return np.empty(0), np.empty(0)
+    timestamps, index = np.unique(np.concatenate([c.timestamps for c in columns]), return_inverse=True)
+    sums = np.bincount(index, weights=np.concatenate([c.samples for c in columns]), minlength=len(timestamps))
+    return timestamps, sums
+
+
+def sort_matrices_by_avg(matrices: list[Matrix | ColumnarMatrix]) -> list[Matrix | ColumnarMatrix]:
+    """
+    Sorts the matrices by their average sample, highest first, and drops empty ones.
+    """
+    columns = [ColumnarMatrix.from_matrix(m) for m in matrices]
+    matrices = [m for m, c in zip(matrices, columns) if len(c)]
+    columns = [c for c in columns if len(c)]
+    if not columns:
+        return []
+
+    counts = np.array([len(c) for c in columns])
+    offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    averages = np.add.reduceat(np.concatenate([c.samples for c in columns]), offsets) / counts
+
+    # stable, so ties keep their order as sorted(..., reverse=True) did
+    return [matrices[i] for i in np.argsort(-averages, kind="stable")]
+
+
+def combine_last_matrices(matrices: list[Matrix | ColumnarMatrix], n: int) -> list[Matrix | ColumnarMatrix]:
+    """
+    Keeps the first n matrices and sums the rest into an 'other**' process, if it has any usage.
+    """
     if len(matrices) < n:
         return matrices
     keep = matrices[:n]
-    combine = matrices[n:]
-    other_sums = defaultdict(int)
-    for m in combine:
-        for ts, v in m.values:
-            other_sums[ts] += float(v)
-    
-    if sum(other_sums.values()) == 0:
+    timestamps, sums = sum_matrices(matrices[n:])
+
+    if sums.sum() == 0:
         return keep
-    other_values = [Series(ts, v) for ts, v in other_sums.items()]
-    other_matrix = Matrix(metric=dict(proc='other**'), values=other_values)
 
-    keep.append(other_matrix)
-    return keep
\ No newline at end of file
+    keep.append(ColumnarMatrix(dict(proc='other**'), timestamps, sums))
+    return keep
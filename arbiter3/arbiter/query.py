@@ -11,7 +11,8 @@ class Q:
         s = self._selector
 
         if self._matchers:
-            s += '{' + ','.join([str(m) for m in self._matchers]) + '}'
+            # sorted, as the matchers are a set, so the same query always renders the same
+            s += '{' + ','.join(sorted(str(m) for m in self._matchers)) + '}'
 
         if self._over:
             s += f'[{self._over}]'
@@ -0,0 +1,141 @@
+import re
+import asyncio
+import logging
+import threading
+from datetime import datetime
+from collections import Counter
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# string literals, whose whitespace is part of the query
+RE_PROMQL_STRING = re.compile(r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|`[^`]*`')
+RE_SPACE = re.compile(r"\s+")
+RE_SPACE_AROUND_PUNCTUATION = re.compile(r" ?([(){}\[\],=!~<>+\-*/%^]) ?")
+
+
+def canonical_query(query: str) -> str:
+    """
+    The query with insignificant whitespace removed, so that queries differing
+    only in formatting share a cache entry.
+    """
+    parts, end = [], 0
+    for match in RE_PROMQL_STRING.finditer(query):
+        parts.append(_canonical_code(query[end:match.start()]))
+        parts.append(match.group())
+        end = match.end()
+    parts.append(_canonical_code(query[end:]))
+    return "".join(parts).strip()
+
+
+def _canonical_code(code: str) -> str:
+    return RE_SPACE_AROUND_PUNCTUATION.sub(r"\1", RE_SPACE.sub(" ", code))
+
+
+class CycleQueryCache:
+    """
+    Memoizes the instant queries of one evaluation cycle. Within a cycle every
+    query is evaluated at the cycle's timestamp, so all of its queries see the
+    same moment and sending one again can only return the same result. Outside
+    a cycle queries are passed through as they are.
+
+    Only results are kept, a failed query is sent again the next time it's asked.
+    """
+
+    def __init__(self):
+        self.time: float | None = None
+        self.counters = Counter()
+        self._results: dict[tuple, list] = {}
+        self._pending: dict[tuple, asyncio.Future] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def active(self) -> bool:
+        return self.time is not None
+
+    @contextmanager
+    def cycle(self, now: datetime):
+        """
+        Pins the queries made within the block to `now`, and forgets their results after it.
+        """
+        with self._lock:
+            self.time = now.timestamp()
+            self.counters.clear()
+            self._results.clear()
+            self._pending.clear()
+        try:
+            yield self
+        finally:
+            logger.info(f"prometheus query cache: {self.stats()}")
+            with self._lock:
+                self.time = None
+                self._results.clear()
+                self._pending.clear()
+
+    def key(self, query: str, options: dict) -> tuple:
+        # options such as `columnar` change the shape of the result
+        return canonical_query(query), self.time, tuple(sorted(options.items()))
+
+    def _cached(self, key: tuple):
+        with self._lock:
+            if key in self._results:
+                self.counters["hits"] += 1
+                return True, self._results[key]
+            return False, None
+
+    def _store(self, key: tuple, result: list):
+        with self._lock:
+            # a result of a cycle that has since ended is not kept
+            if key[1] == self.time:
+                self._results[key] = result
+
+    def query(self, session, query: str, time=None, timeout=None, **kwargs) -> list:
+        """
+        Queries prometheus through `session`, a PrometheusSession, or returns
+        the result the cycle already has for the query. Within a cycle `time`
+        is replaced by the cycle's.
+        """
+        if not self.active:
+            return session.query(query, time=time, timeout=timeout, **kwargs)
+
+        key = self.key(query, kwargs)
+        hit, result = self._cached(key)
+        if hit:
+            return result
+
+        self.counters["misses"] += 1
+        result = session.query(query, time=self.time, timeout=timeout, **kwargs)
+        self._store(key, result)
+        return result
+
+    async def aquery(self, session, query: str, time=None, timeout=None, **kwargs) -> list:
+        """
+        Like query, through an AsyncPrometheusSession. Identical queries sent
+        at the same time share a single request.
+        """
+        if not self.active:
+            return await session.query(query, time=time, timeout=timeout, **kwargs)
+
+        key = self.key(query, kwargs)
+        hit, result = self._cached(key)
+        if hit:
+            return result
+
+        if pending := self._pending.get(key):
+            self.counters["hits"] += 1
+            return await asyncio.shield(pending)
+
+        self.counters["misses"] += 1
+        pending = self._pending[key] = asyncio.ensure_future(session.query(query, time=self.time, timeout=timeout, **kwargs))
+        try:
+            result = await asyncio.shield(pending)
+        finally:
+            self._pending.pop(key, None)
+        self._store(key, result)
+        return result
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.counters["hits"], "misses": self.counters["misses"], "queries": len(self._results)}
+
+
+QUERY_CACHE = CycleQueryCache()
@@ -0,0 +1,117 @@
+import os
+import queue
+import asyncio
+import logging
+import threading
+from importlib.metadata import version, PackageNotFoundError
+from concurrent.futures import ThreadPoolExecutor
+
+from plotly.graph_objects import Figure
+
+from arbiter3.arbiter.conf import ARBITER_RENDER_WORKERS
+
+logger = logging.getLogger(__name__)
+
+
+class _ScopePool:
+    """
+    kaleido < 1.0: each PlotlyScope owns a chromium subprocess that stays up
+    between transforms, but handles one figure at a time.
+    """
+
+    def __init__(self, workers: int):
+        from kaleido.scopes.plotly import PlotlyScope
+
+        self.scopes = queue.Queue()
+        for _ in range(workers):
+            self.scopes.put(PlotlyScope())
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="kaleido")
+
+    def _render(self, figure: Figure, opts: dict) -> bytes:
+        scope = self.scopes.get()
+        try:
+            return scope.transform(figure.to_dict(), **opts)
+        finally:
+            self.scopes.put(scope)
+
+    def render_many(self, figures: list[Figure], opts: dict) -> list[bytes]:
+        return list(self.executor.map(lambda figure: self._render(figure, opts), figures))
+
+
+class _BrowserPool:
+    """
+    kaleido >= 1.0: one chromium with a tab per worker, driven from an event
+    loop on a background thread.
+    """
+
+    def __init__(self, workers: int):
+        import kaleido
+
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name="kaleido", daemon=True).start()
+        self.kaleido = kaleido.Kaleido(n=workers)
+        asyncio.run_coroutine_threadsafe(self.kaleido.open(), self.loop).result()
+
+    async def _render_many(self, figures: list[Figure], opts: dict) -> list[bytes]:
+        return await asyncio.gather(*(self.kaleido.calc_fig(figure, opts=opts) for figure in figures))
+
+    def render_many(self, figures: list[Figure], opts: dict) -> list[bytes]:
+        return asyncio.run_coroutine_threadsafe(self._render_many(figures, opts), self.loop).result()
+
+
+class _ToImage:
+    """
+    Without kaleido installed plotly raises a helpful error from to_image.
+    """
+
+    def __init__(self, workers: int):
+        pass
+
+    def render_many(self, figures: list[Figure], opts: dict) -> list[bytes]:
+        return [figure.to_image(**opts) for figure in figures]
+
+
+class FigureRenderer:
+    """
+    Renders plotly figures to images, keeping kaleido's chromium workers running
+    between renders instead of paying for their startup on every figure.
+    Workers are started on the first render.
+    """
+
+    def __init__(self, workers: int, format: str = "png", width: int = 600, height: int = 350, scale: int = 2):
+        self.workers = workers
+        self.opts = dict(format=format, width=width, height=height, scale=scale)
+        self._pid = None
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _pool_class():
+        try:
+            major = int(version("kaleido").split(".")[0])
+        except PackageNotFoundError:
+            return _ToImage
+        return _BrowserPool if major >= 1 else _ScopePool
+
+    @property
+    def pool(self):
+        with self._lock:
+            # a forked process cannot talk to its parent's chromium
+            if self._pool is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._pool = self._pool_class()(self.workers)
+            return self._pool
+
+    def render_many(self, figures: list[Figure]) -> list[bytes]:
+        """
+        Renders the figures on the warm workers, in parallel up to the number of workers.
+        """
+        if not figures:
+            return []
+        return self.pool.render_many(figures, self.opts)
+
+    def render(self, figure: Figure) -> bytes:
+        return self.render_many([figure])[0]
+
+
+FIGURE_RENDERER = FigureRenderer(workers=ARBITER_RENDER_WORKERS)
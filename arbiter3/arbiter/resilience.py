@@ -0,0 +1,284 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import aiohttp
+import requests
+
+logger = logging.getLogger(__name__)
+
+# responses from a prometheus that is overloaded or restarting, rather than to a bad query
+TRANSIENT_STATUSES = {429, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of querying prometheus while it is considered unhealthy.
+    """
+
+
+def is_transient(error: BaseException) -> bool:
+    """
+    Whether the error says prometheus is unhealthy, so the same query may succeed later.
+    """
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and error.response.status_code in TRANSIENT_STATUSES
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status in TRANSIENT_STATUSES
+    return isinstance(error, (requests.ConnectionError, requests.Timeout, aiohttp.ClientConnectionError, TimeoutError, asyncio.TimeoutError))
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive transient failures, failing calls fast
+    for `reset_timeout` seconds. Then a single trial call is let through: its
+    success closes the breaker again, its failure reopens it.
+    """
+
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if self.trial or time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def before_call(self) -> bool:
+        """
+        Raises CircuitOpenError if the call may not go ahead, and returns whether it is the trial call.
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return False
+            if self.trial or time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(f"prometheus failed {self.failures} times in a row, not querying it for up to {self.reset_timeout}s")
+            self.trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info("prometheus recovered, closing circuit breaker")
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def abandon_trial(self):
+        """
+        Lets another trial call through, when the trial call ended without an answer, e.g. cancelled.
+        """
+        with self._lock:
+            self.trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial or (self.opened_at is None and self.failures >= self.threshold):
+                logger.warning(f"prometheus failed {self.failures} times in a row, opening circuit breaker for {self.reset_timeout}s")
+                self.opened_at = time.monotonic()
+            self.trial = False
+
+
+class QueryPolicy:
+    """
+    Retries, hedging and circuit breaking for prometheus queries, which are
+    idempotent reads so they can be sent again freely.
+
+    A call that fails transiently is retried up to `retries` times after a
+    jittered exponential backoff. With `hedge_percentile`, a call that takes
+    longer than that percentile of recent latencies is sent a second time and
+    whichever finishes first wins. Calls fail fast with CircuitOpenError while
+    the breaker is open.
+    """
+
+    def __init__(
+            self,
+            retries: int = 2,
+            backoff: float = 0.5,
+            hedge_percentile: float | None = None,
+            breaker: CircuitBreaker | None = None,
+            max_backoff: float = 10,
+            hedge_workers: int = 8,
+            hedge_min_samples: int = 20,
+        ):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_percentile = hedge_percentile
+        self.hedge_workers = hedge_workers
+        self.hedge_min_samples = hedge_min_samples
+        self.breaker = breaker or CircuitBreaker(threshold=5, reset_timeout=30)
+
+        self.counters = Counter()
+        self.latencies = deque(maxlen=500)
+        self._pid = None
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            # a forked process does not have its parent's threads
+            if self._executor is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._executor = ThreadPoolExecutor(max_workers=self.hedge_workers, thread_name_prefix="prometheus-hedge")
+            return self._executor
+
+    def delay(self, attempt: int) -> float:
+        # "full jitter", so clients retrying after the same outage spread out
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def percentile(self, percentile: float) -> float | None:
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(percentile / 100 * len(latencies)))]
+
+    def hedge_after(self) -> float | None:
+        if self.hedge_percentile is None or len(self.latencies) < self.hedge_min_samples:
+            return None
+        return self.percentile(self.hedge_percentile)
+
+    def _before(self) -> bool:
+        try:
+            trial = self.breaker.before_call()
+        except CircuitOpenError:
+            self.counters["rejected"] += 1
+            raise
+        self.counters["calls"] += 1
+        return trial
+
+    def _after(self, start: float, error: BaseException | None, attempt: int) -> bool:
+        """
+        Records the outcome of an attempt, and returns whether to retry it.
+        """
+        if error is None:
+            self.breaker.record_success()
+            self.latencies.append(time.monotonic() - start)
+            self.counters["successes"] += 1
+            return False
+
+        if not is_transient(error):
+            # prometheus answered, the query itself is at fault
+            self.breaker.record_success()
+            self.counters["errors"] += 1
+            return False
+
+        self.breaker.record_failure()
+        self.counters["failures"] += 1
+        if attempt == self.retries:
+            return False
+        self.counters["retries"] += 1
+        return True
+
+    def call(self, func):
+        """
+        Calls `func`, a function making one query, under the policy.
+        """
+        for attempt in range(self.retries + 1):
+            trial = self._before()
+            start = time.monotonic()
+            try:
+                result = self._hedged(func)
+            except Exception as e:
+                if not self._after(start, e, attempt):
+                    raise
+                time.sleep(self.delay(attempt))
+            except BaseException:
+                if trial:
+                    self.breaker.abandon_trial()
+                raise
+            else:
+                self._after(start, None, attempt)
+                return result
+
+    def _hedged(self, func):
+        if (after := self.hedge_after()) is None:
+            return func()
+
+        first = self.executor.submit(func)
+        if wait([first], timeout=after).done:
+            return first.result()
+
+        self.counters["hedges"] += 1
+        hedge = self.executor.submit(func)
+        pending, error = {first, hedge}, None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        self.counters["hedge_wins"] += 1
+                    return future.result()
+                error = error or future.exception()
+        raise error
+
+    async def acall(self, func):
+        """
+        Awaits `func`, a coroutine function making one query, under the policy.
+        """
+        for attempt in range(self.retries + 1):
+            trial = self._before()
+            start = time.monotonic()
+            try:
+                result = await self._ahedged(func)
+            except Exception as e:
+                if not self._after(start, e, attempt):
+                    raise
+                await asyncio.sleep(self.delay(attempt))
+            except BaseException:
+                # cancelled or interrupted, the breaker would otherwise wait on this trial forever.
+                # a call that started before the breaker opened leaves another call's trial alone
+                if trial:
+                    self.breaker.abandon_trial()
+                raise
+            else:
+                self._after(start, None, attempt)
+                return result
+
+    async def _ahedged(self, func):
+        if (after := self.hedge_after()) is None:
+            return await func()
+
+        first = asyncio.ensure_future(func())
+        done, _ = await asyncio.wait({first}, timeout=after)
+        if done:
+            return first.result()
+
+        self.counters["hedges"] += 1
+        hedge = asyncio.ensure_future(func())
+        pending, error = {first, hedge}, None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None:
+                        if future is hedge:
+                            self.counters["hedge_wins"] += 1
+                        return future.result()
+                    error = error or future.exception()
+            raise error
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def stats(self) -> dict[str, int | float | str | None]:
+        stats = {name: self.counters[name] for name in ("calls", "successes", "errors", "failures", "retries", "rejected", "hedges", "hedge_wins")}
+        stats["breaker"] = self.breaker.state
+        stats["latency_p50"] = self.percentile(50)
+        stats["latency_p95"] = self.percentile(95)
+        stats["hedge_after"] = self.hedge_after()
+        return stats
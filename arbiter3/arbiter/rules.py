@@ -0,0 +1,96 @@
+"""
+Prometheus recording rules for policy queries.
+
+A policy with `use_recording_rules` looks up precomputed series instead of
+computing its CPU rate and memory average over the whole lookback every
+cycle. Each rule records one metric over one lookback for one domain,
+tagged with the domain in DOMAIN_LABEL so that rules for overlapping
+domains don't produce the same series.
+"""
+
+import json
+from typing import NamedTuple
+
+from arbiter3.arbiter.query import Q, rate, avg_over_time
+
+DOMAIN_LABEL = "arbiter_domain"
+
+CPU_METRIC = "cgroup_warden_cpu_usage_seconds"
+PROC_CPU_METRIC = "cgroup_warden_proc_cpu_usage_seconds"
+MEM_METRIC = "cgroup_warden_memory_usage_bytes"
+PROC_MEM_METRIC = "cgroup_warden_proc_memory_pss_bytes"
+
+
+class RecordingRule(NamedTuple):
+    record: str
+    expr: str
+    labels: dict[str, str]
+
+
+def cpu_metric(proc_whitelist: str | None) -> str:
+    # with a process whitelist, usage is summed from the processes that aren't whitelisted
+    return PROC_CPU_METRIC if proc_whitelist else CPU_METRIC
+
+
+def mem_metric(proc_whitelist: str | None) -> str:
+    return PROC_MEM_METRIC if proc_whitelist else MEM_METRIC
+
+
+def cpu_rate_record(metric: str, lookback: int) -> str:
+    return f"arbiter:{metric}:rate{lookback}s"
+
+
+def mem_average_record(metric: str, lookback: int) -> str:
+    return f"arbiter:{metric}:avg_over_time{lookback}s"
+
+
+def cpu_rate_rule(domain: str, lookback: int, metric: str) -> RecordingRule:
+    expr = rate(Q(metric).like(instance=domain).over(f"{lookback}s"))
+    return RecordingRule(cpu_rate_record(metric, lookback), str(expr), {DOMAIN_LABEL: domain})
+
+
+def mem_average_rule(domain: str, lookback: int, metric: str) -> RecordingRule:
+    expr = avg_over_time(Q(metric).like(instance=domain).over(f"{lookback}s"))
+    return RecordingRule(mem_average_record(metric, lookback), str(expr), {DOMAIN_LABEL: domain})
+
+
+def policy_rules(policy) -> list[RecordingRule]:
+    """
+    The rules a usage policy's query needs, for the thresholds it has.
+    """
+    params = policy.query_data.get("params") or {}
+    lookback = int(policy.lookback.total_seconds())
+    rules = []
+    if params.get("cpu_threshold"):
+        rules.append(cpu_rate_rule(policy.domain, lookback, cpu_metric(params.get("proc_whitelist"))))
+    if params.get("mem_threshold"):
+        rules.append(mem_average_rule(policy.domain, lookback, mem_metric(params.get("proc_whitelist"))))
+    return rules
+
+
+def recording_rules(policies) -> list[RecordingRule]:
+    """
+    The rules of the policies, each distinct (domain, lookback, metric) once.
+    """
+    rules = {}
+    for policy in policies:
+        for rule in policy_rules(policy):
+            rules.setdefault((rule.record, rule.labels[DOMAIN_LABEL]), rule)
+    return list(rules.values())
+
+
+def rules_yaml(rules: list[RecordingRule], group: str = "arbiter", interval: str | None = None) -> str:
+    """
+    A Prometheus rules file with the rules in one group. Strings are written
+    JSON quoted, which YAML reads as double quoted scalars.
+    """
+    lines = ["groups:", f"  - name: {json.dumps(group)}"]
+    if interval:
+        lines.append(f"    interval: {interval}")
+    lines.append("    rules:" if rules else "    rules: []")
+    for rule in rules:
+        lines.append(f"      - record: {json.dumps(rule.record)}")
+        lines.append(f"        expr: {json.dumps(rule.expr)}")
+        lines.append("        labels:")
+        lines.extend(f"          {name}: {json.dumps(value)}" for name, value in rule.labels.items())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,130 @@
+import re
+import asyncio
+import logging
+from datetime import datetime
+from collections import defaultdict
+
+import numpy as np
+
+from arbiter3.arbiter.conf import PROMETHEUS_ASYNC_CONNECTION, PROMETHEUS_QUERY_TIMEOUT
+from arbiter3.arbiter.codec import encode_matrices
+from arbiter3.arbiter.models import Violation, Policy, Target, UsageSnapshot
+from arbiter3.arbiter.plots import align_with_prom_limit
+from arbiter3.arbiter.promclient import Matrix, ColumnarMatrix, sort_matrices_by_avg, combine_last_matrices, sum_matrices
+from arbiter3.arbiter.querycache import QUERY_CACHE
+from arbiter3.arbiter.query import Q, rate, sum_by, avg_over_time, max_over_time
+from arbiter3.arbiter.utils import BYTES_PER_GIB
+from arbiter3.arbiter.warden import WARDEN_CLIENT
+
+logger = logging.getLogger(__name__)
+
+# processes drawn on their own in violation graphs, the rest are summed into 'other**'
+TOP_PROCESSES = 7
+
+
+def _alternation(values: set[str]) -> str:
+    return "|".join(re.escape(value) for value in sorted(values))
+
+
+def _by_target(matrices: list) -> dict[tuple[str, str], list]:
+    grouped = defaultdict(list)
+    for matrix in matrices:
+        grouped[(matrix.metric["instance"], matrix.metric["username"])].append(matrix)
+    return grouped
+
+
+def _unreported(procs: list[ColumnarMatrix], totals: list[ColumnarMatrix]) -> ColumnarMatrix | None:
+    """
+    Usage of the target not attributed to any process, as the graphs' `(sum(total) - sum(procs)) > 0`.
+    """
+    if not totals:
+        return None
+
+    total = ColumnarMatrix.from_matrix(totals[0])
+    timestamps, reported = sum_matrices(procs)
+    _, at_total, at_reported = np.intersect1d(total.timestamps, timestamps, return_indices=True)
+    unreported = total.samples[at_total] - reported[at_reported]
+    positive = unreported > 0
+
+    return ColumnarMatrix({}, total.timestamps[at_total][positive], unreported[positive]) if positive.any() else None
+
+
+def _folded(procs: list[ColumnarMatrix], totals: list[ColumnarMatrix], resource: str) -> list[ColumnarMatrix]:
+    """
+    The graph's lines, sorted and folded as plots.proc_usage_graph does, labeled
+    with their process and resource.
+    """
+    matrices = sort_matrices_by_avg(procs)
+    if unreported := _unreported(procs, totals):
+        matrices.append(unreported)
+
+    matrices = combine_last_matrices(matrices, TOP_PROCESSES if len(matrices) > TOP_PROCESSES else len(matrices) - 1)
+    return [ColumnarMatrix({"proc": matrix.metric.get("proc", "other**"), "resource": resource}, matrix.timestamps, matrix.samples) for matrix in map(ColumnarMatrix.from_matrix, matrices)]
+
+
+def policy_snapshots(policy: Policy, targets: list[Target], end: datetime) -> dict[tuple[str, str], list[Matrix | ColumnarMatrix]]:
+    """
+    The usage of each target over the policy's lookback, from one set of concurrent queries for all of them.
+    Keyed by (instance, username). Process counts are single points at `end` labeled with resource 'count'.
+    """
+    start = end - policy.lookback
+    step = align_with_prom_limit(start, end, "1m")
+    window = f"{int((end - start).total_seconds())}s"
+
+    matchers = dict(
+        instance=_alternation({target.instance for target in targets}),
+        username=_alternation({target.username for target in targets}),
+    )
+
+    def query_range(query: Q):
+        return PROMETHEUS_ASYNC_CONNECTION.query_range(str(query), start.timestamp(), end.timestamp(), step, timeout=PROMETHEUS_QUERY_TIMEOUT, columnar=True)
+
+    async def queries():
+        counts_query = max_over_time(Q("cgroup_warden_proc_count").like(**matchers).over(window))
+        return await asyncio.gather(
+            query_range(rate(Q("cgroup_warden_proc_cpu_usage_seconds").like(**matchers).over(step))),
+            query_range(sum_by(rate(Q("cgroup_warden_cpu_usage_seconds").like(**matchers).over(step)), "instance", "username")),
+            query_range(avg_over_time(Q("cgroup_warden_proc_memory_pss_bytes").like(**matchers).over(step)) / BYTES_PER_GIB),
+            query_range(sum_by(avg_over_time(Q("cgroup_warden_memory_usage_bytes").like(**matchers).over(step)), "instance", "username") / BYTES_PER_GIB),
+            QUERY_CACHE.aquery(PROMETHEUS_ASYNC_CONNECTION, str(counts_query), time=end.timestamp(), timeout=PROMETHEUS_QUERY_TIMEOUT),
+        )
+
+    cpu_procs, cpu_totals, mem_procs, mem_totals, counts = WARDEN_CLIENT.run(queries())
+
+    cpu_procs, cpu_totals = _by_target(cpu_procs), _by_target(cpu_totals)
+    mem_procs, mem_totals = _by_target(mem_procs), _by_target(mem_totals)
+    counts = _by_target(counts)
+
+    snapshots = {}
+    for key in cpu_procs.keys() | mem_procs.keys():
+        snapshots[key] = [
+            *_folded(cpu_procs[key], cpu_totals[key], "cpu"),
+            *_folded(mem_procs[key], mem_totals[key], "mem"),
+            *(Matrix({"proc": result.metric["proc"], "resource": "count"}, [result.value]) for result in counts[key]),
+        ]
+    return snapshots
+
+
+def capture_snapshots(violations: list[Violation], end: datetime) -> list[UsageSnapshot]:
+    """
+    Captures the usage that led to each new violation, so its emails and graphs
+    don't query Prometheus again. Base statuses are not graphed. The snapshots
+    are saved once their violations are.
+    """
+    by_policy = defaultdict(list)
+    for violation in violations:
+        if not violation.is_base_status:
+            by_policy[violation.policy].append(violation)
+
+    captured = []
+    for policy, group in by_policy.items():
+        try:
+            snapshots = policy_snapshots(policy, [violation.target for violation in group], end)
+        except Exception as e:
+            logger.error(f"Unable to capture usage of '{policy}' violations, their graphs will query prometheus: {e}")
+            continue
+
+        for violation in group:
+            if matrices := snapshots.get((violation.target.instance, violation.target.username)):
+                captured.append(UsageSnapshot(violation=violation, data=encode_matrices(matrices)))
+    return captured
@@ -29,6 +29,30 @@ def get_uid(unit: str) -> int | None:
     return int(match.group(1))
 
 
+def uid_regex(min_uid: int) -> str:
+    """
+    A regex matching the decimal uids of at least `min_uid`: any longer number,
+    or one as long that is greater or equal digit by digit.
+    """
+    if min_uid <= 0:
+        return r"\d+"
+    digits = str(min_uid)
+    alternatives = [rf"[1-9]\d{{{len(digits)},}}", digits]
+    for i, digit in enumerate(digits):
+        if digit == "9":
+            continue
+        rest = len(digits) - i - 1
+        alternatives.append(digits[:i] + f"[{int(digit) + 1}-9]" + (rf"\d{{{rest}}}" if rest > 1 else r"\d" * rest))
+    return "|".join(alternatives)
+
+
+def user_slice_regex(min_uid: int) -> str:
+    """
+    A prometheus regex for the cgroups of user slices arbiter manages, those with a uid of at least `min_uid`.
+    """
+    return rf"/user\.slice/user-(?:{uid_regex(min_uid)})\.slice"
+
+
 def default_user_lookup(username: str) -> tuple[str, str, str]:
     realname = default_realname_lookup(username=username)
     email = default_email_lookup(username=username)
@@ -1,6 +1,4 @@
 import logging
-import asyncio
-import aiohttp
 import http
 
 from django.shortcuts import render
@@ -10,10 +8,11 @@ from django.core.management.base import CommandError
 from django.contrib.auth.decorators import permission_required
 from django.contrib import messages
 
-from arbiter3.arbiter.conf import PROMETHEUS_CONNECTION, WARDEN_JOB
+from arbiter3.arbiter.inventory import HOST_INVENTORY
 from arbiter3.arbiter.utils import split_port, cores_to_usec, gib_to_bytes
 from arbiter3.arbiter.models import Violation, Event, Target
 from arbiter3.arbiter.eval import set_property
+from arbiter3.arbiter.warden import WARDEN_CLIENT
 from arbiter3.arbiter.prop import CPU_QUOTA, MEMORY_MAX, MEMORY_SWAP_MAX
 
 from .nav import navbar
@@ -29,8 +28,8 @@ def message_http(message: str, status: str = "success"):
 def view_dashboard(request):
     agents = []
     try:
-        result = PROMETHEUS_CONNECTION.query(f'up{{job="{WARDEN_JOB}"}} == 1', timeout=3)
-        agents = [r.metric['instance'] for r in result]
+        HOST_INVENTORY.refresh_if_stale(timeout=3)
+        agents = HOST_INVENTORY.instances()
     except Exception as e:
         messages.warning(request, "Warning: Unable to connect to prometheus instance to query cgroup-warden instances")
         LOGGER.error(
@@ -59,10 +58,6 @@ def apply(request):
     if not can_run: 
         return message_http("You do not have permissions to apply limits", status="error")
 
-    async def apply_single_property(target: Target, name, value):
-        async with aiohttp.ClientSession() as session:
-            return await set_property(target, session, name, value)
-
     if request.method == "POST":
         if not (username := request.POST.get("username")):
             return message_http("Username is required.", 'error')
@@ -90,7 +85,7 @@ def apply(request):
         else:
             return message_http(f'Invalid property "{prop}"', 'error')
 
-        status, message = asyncio.run(apply_single_property(target, prop, v))
+        status, message = WARDEN_CLIENT.run(set_property(target, prop, v))
         if status == http.HTTPStatus.OK:
             target.update_limit(prop, v)
             target.save()
@@ -3,6 +3,8 @@ from django.db.models import Count
 from django.utils import timezone
 
 from arbiter3.arbiter.models import Violation
+from arbiter3.arbiter.conf import PROMETHEUS_QUERY_POLICY, PROMETHEUS_CONNECTION, PROMETHEUS_ASYNC_CONNECTION
+from arbiter3.arbiter.promclient import transfer_stats
 
 
 #Export metrics of the format: "arbiter_violation{host=..., user=..., policy=...} = offense tier"
@@ -19,4 +21,50 @@ def violation_metrics_scrape(request):
         labels = f'policy="{violation.policy.name}", host="{violation.target.host}", user="{violation.target.username}"'
         exported_str += f'{metric_name}{{{labels}}} {violation.penalty_tier + 1}\n'
 
-    return HttpResponse(exported_str, content_type="text")
\ No newline at end of file
+    exported_str += prometheus_client_metrics()
+
+    return HttpResponse(exported_str, content_type="text")
+
+
+#Export how this process's queries to prometheus have fared, see resilience.py
+def prometheus_client_metrics() -> str:
+    stats = PROMETHEUS_QUERY_POLICY.stats()
+    counters = {
+        "calls": "Queries sent to prometheus, including retries",
+        "successes": "Queries prometheus answered",
+        "errors": "Queries prometheus rejected",
+        "failures": "Queries that failed because prometheus was unavailable or overloaded",
+        "retries": "Failed queries that were retried",
+        "rejected": "Queries failed without being sent while the circuit breaker was open",
+        "hedges": "Slow queries that were sent a second time",
+        "hedge_wins": "Hedged queries answered first by their second request",
+    }
+
+    exported_str = ""
+    for name, help in counters.items():
+        metric_name = f"arbiter_prometheus_{name}_total"
+        exported_str += f"# HELP {metric_name} {help}\n# TYPE {metric_name} counter\n{metric_name} {stats[name]}\n"
+
+    metric_name = "arbiter_prometheus_circuit_open"
+    exported_str += f"# HELP {metric_name} Whether the circuit breaker is failing queries to prometheus, 0.5 while checking for recovery\n# TYPE {metric_name} gauge\n"
+    exported_str += f"{metric_name} {dict(closed=0, half_open=0.5, open=1)[stats['breaker']]}\n"
+
+    metric_name = "arbiter_prometheus_latency_seconds"
+    exported_str += f"# HELP {metric_name} Latency of recent successful queries\n# TYPE {metric_name} summary\n"
+    for quantile in ("50", "95"):
+        if (latency := stats[f"latency_p{quantile}"]) is not None:
+            exported_str += f'{metric_name}{{quantile="0.{quantile}"}} {latency}\n'
+
+    transfer = transfer_stats(PROMETHEUS_CONNECTION, PROMETHEUS_ASYNC_CONNECTION)
+    counters = {
+        "requests": "HTTP requests sent to prometheus",
+        "post_requests": "Queries sent as a form POST because they were too long for a url",
+        "compressed_responses": "Responses prometheus sent compressed",
+        "wire_bytes": "Bytes of response body received from prometheus, as sent",
+        "body_bytes": "Bytes of response body received from prometheus, after decompression",
+    }
+    for name, stat in zip(counters, ("requests", "posts", "compressed", "wire_bytes", "body_bytes")):
+        metric_name = f"arbiter_prometheus_{name}_total"
+        exported_str += f"# HELP {metric_name} {counters[name]}\n# TYPE {metric_name} counter\n{metric_name} {transfer[stat]}\n"
+
+    return exported_str
\ No newline at end of file
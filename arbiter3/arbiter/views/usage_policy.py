@@ -101,6 +101,11 @@ class UsagePolicyForm(forms.ModelForm):
         required=False,
         help_text="Threshold in GiB, that when above is considered bad usage"
         )
+    use_recording_rules = forms.BooleanField(
+        label="Use Recording Rules",
+        required=False,
+        help_text="Evaluate this policy from series precomputed by Prometheus recording rules, which is much cheaper for long lookbacks. The rules must first be generated with <code>manage.py generate_recording_rules</code> and loaded into Prometheus."
+        )
     #use_pss = forms.BooleanField(label="Use PSS memory", required=False, help_text="Use PSS (proprtional shared size) for memory usage evaluation. If disabled, uses RSS (default)")
 
     class Meta:
@@ -137,6 +142,7 @@ class UsagePolicyForm(forms.ModelForm):
             #     self.fields['use_pss'].initial = use_pss
             self.fields['proc_whitelist'].initial = query_data["params"]["proc_whitelist"]
             self.fields['user_whitelist'].initial = query_data["params"]["user_whitelist"]
+            self.fields['use_recording_rules'].initial = query_data["params"].get("use_recording_rules", False)
 
         if disabled:
             for field in self.fields.values():
@@ -201,6 +207,7 @@ class UsagePolicyForm(forms.ModelForm):
             user_whitelist=self.cleaned_data["user_whitelist"],
             proc_whitelist=self.cleaned_data["proc_whitelist"],
             use_pss_metric=True,
+            use_recording_rules=self.cleaned_data["use_recording_rules"],
         )
 
         policy.query_data = QueryData.build_query(
@@ -0,0 +1,166 @@
+import os
+import ssl
+import http
+import time
+import asyncio
+import logging
+import threading
+from collections import Counter
+
+import aiohttp
+
+from arbiter3.arbiter.conf import (
+    WARDEN_USE_TLS,
+    WARDEN_VERIFY_SSL,
+    WARDEN_BEARER,
+    WARDEN_MAX_CONNECTIONS,
+    WARDEN_CONNECTIONS_PER_HOST,
+    WARDEN_KEEPALIVE_TIMEOUT,
+    WARDEN_DNS_CACHE_TTL,
+)
+
+logger = logging.getLogger(__name__)
+
+# seconds before a warden without batch support is offered a batch again, in case it was upgraded
+UNBATCHED_RECHECK = 3600
+
+
+class WardenClient:
+    """
+    A long-lived HTTP client for the cgroup-wardens.
+
+    Requests run on an event loop owned by a background thread, so a single pooled
+    aiohttp session (and its kept-alive connections) outlives each evaluation cycle
+    and is shared with the views. Synchronous code submits coroutines with `run`.
+    """
+
+    def __init__(self, use_tls: bool, verify_ssl: bool, bearer: str | None, max_connections: int, connections_per_host: int, keepalive_timeout: int, dns_cache_ttl: int):
+        self.scheme = "https" if use_tls else "http"
+        self.headers = {"Authorization": f"Bearer {bearer}"} if bearer else {}
+        self.max_connections = max_connections
+        self.connections_per_host = connections_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.ssl_context = self._create_ssl_context(verify_ssl) if use_tls else None
+
+        self.counters = Counter()
+        self._pid = None
+        self._loop = None
+        self._session = None
+        self._lock = threading.Lock()
+        self._unbatched: dict[str, float] = {}
+
+    @staticmethod
+    def _create_ssl_context(verify: bool) -> ssl.SSLContext:
+        # one context for every connection, instead of loading the CA bundle per session
+        context = ssl.create_default_context()
+        if not verify:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        return context
+
+    def _trace_config(self) -> aiohttp.TraceConfig:
+        trace = aiohttp.TraceConfig()
+
+        async def on_request_start(session, context, params):
+            self.counters["requests"] += 1
+
+        async def on_connection_create_end(session, context, params):
+            self.counters["connections_created"] += 1
+
+        async def on_connection_reuseconn(session, context, params):
+            self.counters["connections_reused"] += 1
+
+        async def on_dns_cache_miss(session, context, params):
+            self.counters["dns_lookups"] += 1
+
+        trace.on_request_start.append(on_request_start)
+        trace.on_connection_create_end.append(on_connection_create_end)
+        trace.on_connection_reuseconn.append(on_connection_reuseconn)
+        trace.on_dns_cache_miss.append(on_dns_cache_miss)
+        return trace
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            # a forked process (e.g. a gunicorn worker) cannot use its parent's loop thread
+            if self._loop is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._session = None
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="warden-client", daemon=True).start()
+            return self._loop
+
+    def run(self, coro, timeout: float | None = None):
+        """
+        Runs the coroutine on the client's event loop and waits for its result.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def session(self) -> aiohttp.ClientSession:
+        """
+        The pooled session. Must be called from a coroutine running on the client's loop.
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                limit_per_host=self.connections_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.dns_cache_ttl,
+                ssl=self.ssl_context if self.ssl_context else False,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, headers=self.headers, trace_configs=[self._trace_config()])
+        return self._session
+
+    def close(self):
+        """
+        Closes the pooled session and its connections.
+        """
+        if self._session is not None and self._loop is not None and self._pid == os.getpid():
+            self.run(self._session.close())
+        self._session = None
+
+    def url(self, endpoint: str, path: str) -> str:
+        return f"{self.scheme}://{endpoint}/{path}"
+
+    async def post(self, endpoint: str, path: str, payload: dict, timeout: float = 10) -> tuple[http.HTTPStatus, str]:
+        try:
+            async with self.session().post(
+                url=self.url(endpoint, path),
+                json=payload,
+                timeout=aiohttp.ClientTimeout(total=timeout),
+            ) as response:
+                status = response.status
+                message = await response.text()
+
+        except Exception as e:
+            self.counters["failures"] += 1
+            status = http.HTTPStatus.SERVICE_UNAVAILABLE
+            message = f"Service Unavailable : {e}"
+
+        return status, message
+
+    def supports_batch(self, endpoint: str) -> bool:
+        marked = self._unbatched.get(endpoint)
+        return marked is None or time.monotonic() - marked > UNBATCHED_RECHECK
+
+    def mark_unbatched(self, endpoint: str):
+        logger.info(f"warden at {endpoint} does not support batches, falling back to single requests")
+        self._unbatched[endpoint] = time.monotonic()
+
+    def stats(self) -> dict[str, int | float]:
+        stats = {name: self.counters[name] for name in ("requests", "connections_created", "connections_reused", "dns_lookups", "failures")}
+        connections = stats["connections_created"] + stats["connections_reused"]
+        stats["reuse_rate"] = round(stats["connections_reused"] / connections, 3) if connections else 0.0
+        return stats
+
+
+WARDEN_CLIENT = WardenClient(
+    use_tls=WARDEN_USE_TLS,
+    verify_ssl=WARDEN_VERIFY_SSL,
+    bearer=WARDEN_BEARER,
+    max_connections=WARDEN_MAX_CONNECTIONS,
+    connections_per_host=WARDEN_CONNECTIONS_PER_HOST,
+    keepalive_timeout=WARDEN_KEEPALIVE_TIMEOUT,
+    dns_cache_ttl=WARDEN_DNS_CACHE_TTL,
+)
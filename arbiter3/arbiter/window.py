@@ -0,0 +1,212 @@
+import math
+import logging
+
+import numpy as np
+
+from arbiter3.arbiter.promclient import Matrix, ColumnarMatrix, Vector
+from arbiter3.arbiter.rules import CPU_METRIC, MEM_METRIC
+from arbiter3.arbiter.localeval import UsageGrid
+from arbiter3.arbiter.models import USER_SLICES
+from arbiter3.arbiter.query import Q
+
+logger = logging.getLogger(__name__)
+
+# how long prometheus considers a series present after its last sample, its default lookback delta
+STALENESS = 300
+
+
+class SeriesWindow:
+    """
+    The recent raw samples of one metric, in NumPy ring buffers with a row per
+    series. The buffers grow as needed to hold `span` seconds of samples.
+    """
+
+    def __init__(self, capacity: int = 32, span: float = 0):
+        self.capacity = capacity
+        self.span = span
+        self.labels: list[dict[str, str]] = []
+        self.index: dict[tuple, int] = {}
+        self.times = np.full((0, capacity), np.nan)
+        self.values = np.full((0, capacity), np.nan)
+        # where each row's next sample is written, over its oldest
+        self.heads = np.zeros(0, dtype=np.int64)
+        self.latest = np.zeros(0)
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def _resize(self, rows: int, capacity: int):
+        n = len(self)
+        # unroll the rings oldest first, so their next samples are written after the copied ones
+        order = (self.heads[:n, None] + np.arange(self.capacity)) % self.capacity
+        times, values = np.full((rows, capacity), np.nan), np.full((rows, capacity), np.nan)
+        times[:n, :self.capacity] = np.take_along_axis(self.times[:n], order, axis=1)
+        values[:n, :self.capacity] = np.take_along_axis(self.values[:n], order, axis=1)
+
+        heads = np.zeros(rows, dtype=np.int64)
+        heads[:n] = self.capacity % capacity
+        latest = np.full(rows, -np.inf)
+        latest[:n] = self.latest[:n]
+
+        self.times, self.values, self.heads, self.latest, self.capacity = times, values, heads, latest, capacity
+
+    def _row(self, metric: dict[str, str]) -> int:
+        key = tuple(sorted(metric.items()))
+        if (row := self.index.get(key)) is None:
+            row = len(self.labels)
+            if row >= len(self.times):
+                self._resize(max(16, 2 * len(self.times)), self.capacity)
+            self.index[key] = row
+            self.labels.append(metric)
+        return row
+
+    def add(self, matrices: list[Matrix | ColumnarMatrix]):
+        """
+        Appends the samples of each series newer than the ones it has.
+        """
+        for matrix in matrices:
+            columns = ColumnarMatrix.from_matrix(matrix)
+            row = self._row({name: value for name, value in matrix.metric.items() if name != "__name__"})
+            new = columns.timestamps > self.latest[row]
+            timestamps, samples = columns.timestamps[new], columns.samples[new]
+            if not len(timestamps):
+                continue
+
+            # samples within the span of the newest one must all fit
+            kept = int(np.count_nonzero(self.times[row] >= timestamps[-1] - self.span))
+            if kept + len(timestamps) > self.capacity:
+                self._resize(len(self.times), 1 << (kept + len(timestamps) - 1).bit_length())
+
+            timestamps, samples = timestamps[-self.capacity:], samples[-self.capacity:]
+            positions = (self.heads[row] + np.arange(len(timestamps))) % self.capacity
+            self.times[row, positions] = timestamps
+            self.values[row, positions] = samples
+            self.heads[row] = (self.heads[row] + len(timestamps)) % self.capacity
+            self.latest[row] = timestamps[-1]
+
+    def evict(self, before: float):
+        """
+        Forgets the series without a sample since `before`.
+        """
+        n = len(self)
+        keep = np.flatnonzero(self.latest[:n] >= before)
+        if len(keep) == n:
+            return
+        self.labels = [self.labels[row] for row in keep.tolist()]
+        self.index = {tuple(sorted(metric.items())): row for row, metric in enumerate(self.labels)}
+        self.times, self.values = self.times[keep], self.values[keep]
+        self.heads, self.latest = self.heads[keep], self.latest[keep]
+
+    def _window(self, start: float, end: float) -> np.ndarray:
+        times = self.times[:len(self)]
+        return (times > start) & (times <= end)
+
+    def average(self, start: float, end: float) -> np.ndarray:
+        """
+        The average sample of each series in (start, end], NaN without samples.
+        """
+        window = self._window(start, end)
+        counts = window.sum(axis=1)
+        sums = np.where(window, self.values[:len(self)], 0).sum(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(counts > 0, sums / counts, np.nan)
+
+    def rate(self, start: float, end: float) -> np.ndarray:
+        """
+        The per-second increase of each counter series between its first and
+        last samples in (start, end], allowing for counter resets. NaN for
+        series with fewer than two samples.
+        """
+        n = len(self)
+        window = self._window(start, end)
+        order = np.argsort(np.where(window, self.times[:n], np.inf), axis=1)
+        times = np.take_along_axis(np.where(window, self.times[:n], np.nan), order, axis=1)
+        values = np.take_along_axis(np.where(window, self.values[:n], np.nan), order, axis=1)
+
+        deltas = np.diff(values, axis=1)
+        # a counter that went down was reset, and has counted up from zero since
+        increase = np.nansum(np.where(deltas < 0, values[:, 1:], deltas), axis=1)
+
+        counts = window.sum(axis=1)
+        last = np.take_along_axis(times, np.maximum(counts - 1, 0)[:, None], axis=1)[:, 0]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(counts >= 2, increase / (last - times[:, 0]), np.nan)
+
+
+class WindowEngine:
+    """
+    Evaluates policies from raw cgroup usage kept in memory between cycles.
+    After the first cycle, only the samples scraped since the last one are
+    fetched from prometheus, however long the policies' lookbacks are and
+    however many policies there are.
+
+    Base policies and usage policies without a process whitelist are
+    supported. Usage averages are computed from the raw samples rather than
+    the 30 second steps of QueryData.build_query's memory subquery, so they
+    can differ slightly near the thresholds.
+    """
+
+    def __init__(self, job: str, overlap: float = 60):
+        self.job = job
+        # fetched again each cycle, for samples that were scraped late
+        self.overlap = overlap
+        self.cpu = SeriesWindow()
+        self.mem = SeriesWindow()
+        self.fetched: float | None = None
+        self.span = 0
+
+    @staticmethod
+    def supports(policy) -> bool:
+        if policy.is_base_policy:
+            return True
+        params = policy.query_data.get("params") or {}
+        return not policy.query_data.get("is_raw_query") and not params.get("proc_whitelist")
+
+    @staticmethod
+    def required_span(policies) -> float:
+        return max([STALENESS] + [policy.lookback.total_seconds() for policy in policies if not policy.is_base_policy])
+
+    def queries(self, policies, now: float) -> list[str]:
+        """
+        The range selectors of raw samples that the window is missing for evaluating the policies at `now`.
+        """
+        span = self.required_span(policies)
+        if self.fetched is None or span > self.span or now - self.fetched > self.span:
+            seconds = span + self.overlap
+        else:
+            seconds = now - self.fetched + self.overlap
+
+        seconds = math.ceil(seconds)
+        return [str(Q(metric).like(job=self.job, cgroup=USER_SLICES).over(f"{seconds}s")) for metric in (CPU_METRIC, MEM_METRIC)]
+
+    def load(self, policies, results: list[list], now: float):
+        """
+        Adds the results of the queries to the window.
+        """
+        self.span = max(self.span, self.required_span(policies))
+        for window, result in zip((self.cpu, self.mem), results):
+            window.span = self.span
+            window.add(result)
+            window.evict(now - self.span)
+        self.fetched = now
+        logger.debug(f"usage window: {len(self.cpu)} cpu and {len(self.mem)} memory series over {self.span}s")
+
+    def evaluate(self, policies, now: float) -> list[tuple[object, list[Vector]]]:
+        """
+        The results each policy's query would have at `now`, in policy order.
+        """
+        grid = UsageGrid(self.cpu.labels + self.mem.labels)
+        computed = {}
+
+        def usage(kind: str, lookback: int, proc_whitelist: str | None):
+            if (kind, lookback) not in computed:
+                if kind == "present":
+                    present = self.cpu.latest[:len(self.cpu)] > now - STALENESS
+                    computed[(kind, lookback)] = grid.present([metric for metric, p in zip(self.cpu.labels, present.tolist()) if p])
+                elif kind == "cpu":
+                    computed[(kind, lookback)] = grid.maximum(self.cpu.labels, self.cpu.rate(now - lookback, now))
+                else:
+                    computed[(kind, lookback)] = grid.total(self.mem.labels, self.mem.average(now - lookback, now))
+            return computed[(kind, lookback)]
+
+        return grid.evaluate(policies, usage, now)
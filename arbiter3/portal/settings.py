@@ -28,6 +28,32 @@ PROMETHEUS_USERNAME = None
 
 PROMETHEUS_PASSWORD = None
 
+# arbiter will send at most this many queries to prometheus at once
+PROMETHEUS_QUERY_WORKERS = 8
+
+# arbiter will give up on a single prometheus query after this many seconds
+PROMETHEUS_QUERY_TIMEOUT = 30
+
+# how query responses are decoded: 'orjson', 'stream' to decode results as they arrive,
+# 'json' for the standard library, or 'auto' for orjson when it's installed and 'stream' otherwise
+# PROMETHEUS_DECODER = "auto"
+
+# queries whose url encoded parameters are longer than this many bytes are sent as a form POST,
+# 0 to always POST or None to never
+# PROMETHEUS_POST_THRESHOLD = 2048
+
+# queries that fail because prometheus is unavailable or overloaded are retried this many times,
+# after a random delay of up to PROMETHEUS_RETRY_BACKOFF seconds, doubling with each retry
+# PROMETHEUS_RETRIES = 2
+# PROMETHEUS_RETRY_BACKOFF = 0.5
+
+# send a query a second time when it takes longer than this percentile of recent queries, None to never
+# PROMETHEUS_HEDGE_PERCENTILE = None
+
+# after this many failures in a row, stop querying prometheus for PROMETHEUS_BREAKER_RESET seconds
+# PROMETHEUS_BREAKER_THRESHOLD = 5
+# PROMETHEUS_BREAKER_RESET = 30
+
 # ============================================================
 #                        cgroup-warden
 # ============================================================
@@ -35,6 +61,10 @@ PROMETHEUS_PASSWORD = None
 # the name of the prometheus scrape job, needs to match the `job_name`
 WARDEN_JOB = 'cgroup-warden'
 
+# how many seconds arbiter will reuse the list of up cgroup-wardens before asking prometheus again,
+# if 0 the list is refreshed every evaluation cycle
+WARDEN_INVENTORY_REFRESH = 0
+
 # port the cgroup-wardens are listening on
 WARDEN_PORT = 2112
 
@@ -53,6 +83,22 @@ WARDEN_BEARER = None
 # Arbiter will account for this and sync limits, requiring no action.
 WARDEN_RUNTIME = False
 
+# the most units arbiter will set limits on in a single request to a cgroup-warden, 0 sends one request per limit.
+# cgroup-wardens without batch support are detected and sent one request per limit regardless.
+WARDEN_BATCH_SIZE = 0
+
+# arbiter keeps connections to the cgroup-wardens open between evaluations, up to this many in total
+WARDEN_MAX_CONNECTIONS = 100
+
+# and at most this many to a single cgroup-warden
+WARDEN_CONNECTIONS_PER_HOST = 4
+
+# seconds an idle connection to a cgroup-warden is kept open, should be longer than the evaluation interval
+WARDEN_KEEPALIVE_TIMEOUT = 120
+
+# seconds arbiter caches the address of a cgroup-warden host
+WARDEN_DNS_CACHE_TTL = 300
+
 # ============================================================
 #                           Email
 # ============================================================
@@ -93,6 +139,25 @@ ARBITER_FROM_EMAIL = None
 # ARBITER_EMAIL_TEMPLATE_DIR = str(Path(__file__).resolve().parent / "templates") # sets the path to the "templates" directory located in the same directory of this file
 ARBITER_EMAIL_TEMPLATE_DIR = None
 
+# violation emails are sent by the send_notifications worker, which renders this many emails at once
+ARBITER_NOTIFICATION_WORKERS = 4
+
+# and sends at most this many emails per minute, 0 for no limit
+ARBITER_NOTIFICATION_RATE = 60
+
+# and tries to send an email this many times before giving up
+ARBITER_NOTIFICATION_RETRIES = 5
+
+# email graphs are rendered by this many kaleido workers, which are kept running between emails
+ARBITER_RENDER_WORKERS = 2
+
+# the usage graphs' prometheus results are cached in this cache from CACHES, for ARBITER_GRAPH_CACHE_TTL
+# seconds if the graph reaches the last few minutes, whose data may still change, or for
+# ARBITER_GRAPH_CACHE_HISTORICAL_TTL seconds otherwise. 0 disables either.
+# ARBITER_GRAPH_CACHE = "default"
+# ARBITER_GRAPH_CACHE_TTL = 30
+# ARBITER_GRAPH_CACHE_HISTORICAL_TTL = 86400
+
 # arbiter will route the mail through this mail server
 EMAIL_HOST = 'your.mail.server.edu'
 
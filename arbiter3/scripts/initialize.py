@@ -54,6 +54,7 @@ def initialize_config():
     created_settings = arbiter_conf_dir / "settings.py"
     created_web_service = arbiter_conf_dir / "arbiter-web.service"
     created_eval_service = arbiter_conf_dir / "arbiter-eval.service"
+    created_notify_service = arbiter_conf_dir / "arbiter-notify.service"
 
     # Created email templates
     created_email_body = arbiter_templates_dir / "email_body.html"
@@ -66,6 +67,7 @@ def initialize_config():
     manage_template = arbiter.__file__
     settings_template = settings.__file__
     eval_service_template = jinja_env.get_template("arbiter-eval.service.jinja")
+    notify_service_template = jinja_env.get_template("arbiter-notify.service.jinja")
     web_service_template = jinja_env.get_template("arbiter-web.service.jinja")
     
     # Created email templates
@@ -90,6 +92,14 @@ def initialize_config():
     except FileExistsError:
         print(f"{created_eval_service} already exists")
 
+    try:
+        with open(created_notify_service, "x") as file:
+            file.write(notify_service_template.render(
+                working_dir=arbiter_conf_dir, user=user, python=interpreter_path))
+            print(f"Generated {created_notify_service}")
+    except FileExistsError:
+        print(f"{created_notify_service} already exists")
+
     try:
         with open(created_web_service, "x") as file:
             file.write(web_service_template.render(
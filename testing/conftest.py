@@ -2,7 +2,9 @@ import pytest
 
 from datetime import timedelta
 
-from arbiter3.arbiter.models import Target, Policy, BasePolicy, QueryParameters, QueryData, CPU_QUOTA, MEMORY_MAX, UNSET_LIMIT
+from django.utils import timezone
+
+from arbiter3.arbiter.models import Target, Policy, BasePolicy, Violation, QueryParameters, QueryData, CPU_QUOTA, MEMORY_MAX, UNSET_LIMIT
 from arbiter3.arbiter.utils import BYTES_PER_GIB
 
 from testing.util import unset_limits
@@ -518,4 +520,31 @@ def rss_memory_policy(db, soft_penalty):
         penalty_duration=timedelta(seconds=10),
         repeated_offense_lookback=timedelta(seconds=0),
         grace_period=timedelta(seconds=0),
-    )
\ No newline at end of file
+    )
+
+
+#----------------------------------
+#         Bulk fixtures
+#----------------------------------
+BULK_HOSTS = [f"login{i}" for i in range(4)]
+BULK_USERS = 1000
+
+
+@pytest.fixture
+def bulk_targets(db):
+    targets = [
+        Target(unit=f"user-{2000 + i}.slice", host=bulk_host, username=f"user-{2000 + i}")
+        for bulk_host in BULK_HOSTS
+        for i in range(BULK_USERS)
+    ]
+    return Target.objects.bulk_create(targets)
+
+
+@pytest.fixture
+def bulk_violations(db, bulk_targets, short_low_harsh_policy, base_soft_policy):
+    violations = [Violation(target=target, policy=base_soft_policy, expiration=None, offense_count=None, is_base_status=True) for target in bulk_targets]
+    violations += [
+        Violation(target=target, policy=short_low_harsh_policy, expiration=timezone.now() + timedelta(hours=1), offense_count=1)
+        for target in bulk_targets[::2]
+    ]
+    return Violation.objects.bulk_create(violations)
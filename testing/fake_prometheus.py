@@ -0,0 +1,100 @@
+import asyncio
+import argparse
+import threading
+from collections import deque
+
+from aiohttp import web
+
+
+class FakePrometheusServer:
+    """
+    A local stand-in for prometheus' query API, with injectable latency and
+    errors. Every instant query is answered with `vector` and every range query
+    with `matrix`, after `latency` seconds. Faults queued with `inject` replace
+    the answer to the next requests, one each. Like prometheus, queries are
+    accepted as GET or form POST requests, and answers are compressed when the
+    client accepts it.
+
+    Run `python -m testing.fake_prometheus` to serve one for manual testing.
+    """
+
+    def __init__(self, vector: list | None = None, matrix: list | None = None, latency: float = 0, host: str = "127.0.0.1", port: int = 0):
+        self.vector = vector or []
+        self.matrix = matrix or []
+        self.latency = latency
+        self.host = host
+        self.port = port
+        self.faults: deque[tuple[int | None, float]] = deque()
+        self.requests = 0
+        self.methods: list[str] = []
+        self._loop = None
+        self._runner = None
+
+    def inject(self, status: int | None = None, delay: float = 0, count: int = 1):
+        """
+        Answers the next `count` requests with `status` instead of a result, or
+        after `delay` seconds instead of `latency`.
+        """
+        self.faults.extend([(status, delay)] * count)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        for method in ("GET", "POST"):
+            app.router.add_route(method, "/api/v1/query", self.query)
+            app.router.add_route(method, "/api/v1/query_range", self.query_range)
+        return app
+
+    async def respond(self, request: web.Request, result_type: str, result: list) -> web.Response:
+        self.requests += 1
+        self.methods.append(request.method)
+        # a form POST must carry the query like a GET would
+        if "query" not in (await request.post() if request.method == "POST" else request.query):
+            return web.json_response({"status": "error", "errorType": "bad_data", "error": "missing query"}, status=400)
+        status, delay = self.faults.popleft() if self.faults else (None, self.latency)
+        await asyncio.sleep(delay)
+        if status is not None:
+            return web.json_response({"status": "error", "errorType": "unavailable", "error": f"injected {status}"}, status=status)
+        response = web.json_response({"status": "success", "data": {"resultType": result_type, "result": result}})
+        response.enable_compression()
+        return response
+
+    async def query(self, request: web.Request) -> web.Response:
+        return await self.respond(request, "vector", self.vector)
+
+    async def query_range(self, request: web.Request) -> web.Response:
+        return await self.respond(request, "matrix", self.matrix)
+
+    async def _start(self):
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+
+    def start(self):
+        """
+        Serves prometheus from a background thread until `stop` is called.
+        """
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, name="fake-prometheus", daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self._start(), self._loop).result()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="serve a stand-in prometheus query API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9090)
+    parser.add_argument("--latency", type=float, default=0, help="seconds to wait before answering")
+    args = parser.parse_args()
+
+    prometheus = FakePrometheusServer(latency=args.latency, host=args.host, port=args.port)
+    web.run_app(prometheus.app(), host=args.host, port=args.port)
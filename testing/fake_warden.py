@@ -0,0 +1,89 @@
+import asyncio
+import argparse
+import threading
+
+from aiohttp import web
+
+
+class FakeWarden:
+    """
+    A local stand-in for a cgroup-warden's control endpoints. Properties are
+    recorded in `properties` instead of being set on systemd units. With
+    `batch=False` it behaves like a warden without `/control/batch`.
+
+    Run `python -m testing.fake_warden` to serve one for manual testing.
+    """
+
+    def __init__(self, batch: bool = True, host: str = "127.0.0.1", port: int = 0):
+        self.batch = batch
+        self.host = host
+        self.port = port
+        self.properties: dict[str, dict[str, any]] = {}
+        self.requests: dict[str, int] = {"control": 0, "control/batch": 0}
+        self._loop = None
+        self._runner = None
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/control", self.control)
+        if self.batch:
+            app.router.add_post("/control/batch", self.control_batch)
+        return app
+
+    def set_property(self, unit: str, name: str, value: any) -> dict:
+        if not isinstance(value, (int, float)):
+            return {"name": name, "error": f"invalid value {value!r}"}
+        self.properties.setdefault(unit, {})[name] = value
+        return {"name": name, "value": value}
+
+    async def control(self, request: web.Request) -> web.Response:
+        self.requests["control"] += 1
+        payload = await request.json()
+        result = self.set_property(payload["unit"], payload["property"]["name"], payload["property"]["value"])
+        if error := result.get("error"):
+            return web.Response(status=400, text=error)
+        return web.json_response({"property": result})
+
+    async def control_batch(self, request: web.Request) -> web.Response:
+        self.requests["control/batch"] += 1
+        payload = await request.json()
+        units = []
+        for unit in payload["units"]:
+            properties = [self.set_property(unit["unit"], p["name"], p["value"]) for p in unit["properties"]]
+            units.append({"unit": unit["unit"], "properties": properties})
+        return web.json_response({"units": units})
+
+    async def _start(self):
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+
+    def start(self):
+        """
+        Serves the warden from a background thread until `stop` is called.
+        """
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, name="fake-warden", daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self._start(), self._loop).result()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    @property
+    def endpoint(self) -> str:
+        return f"{self.host}:{self.port}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="serve a stand-in cgroup-warden control endpoint")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2112)
+    parser.add_argument("--no-batch", action="store_true", help="behave like a warden without /control/batch")
+    args = parser.parse_args()
+
+    warden = FakeWarden(batch=not args.no_batch, host=args.host, port=args.port)
+    web.run_app(warden.app(), host=args.host, port=args.port)
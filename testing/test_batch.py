@@ -0,0 +1,70 @@
+import pytest
+
+from arbiter3.arbiter import eval
+from arbiter3.arbiter.eval import reduce_and_apply_limits
+from arbiter3.arbiter.models import Target
+from arbiter3.arbiter.prop import CPU_QUOTA, MEMORY_MAX
+from arbiter3.arbiter.warden import WardenClient
+
+from testing.fake_warden import FakeWarden
+
+
+USERS = 5
+LIMITS = {CPU_QUOTA: 2000000, MEMORY_MAX: 4294967296}
+
+
+@pytest.fixture
+def warden_client(monkeypatch):
+    client = WardenClient(use_tls=False, verify_ssl=False, bearer=None, max_connections=10, connections_per_host=2, keepalive_timeout=30, dns_cache_ttl=0)
+    monkeypatch.setattr(eval, "WARDEN_CLIENT", client)
+    monkeypatch.setattr(eval, "WARDEN_BATCH_SIZE", 2)
+    yield client
+    client.close()
+
+
+@pytest.fixture
+def wardens():
+    # on different hosts, as targets are unique per host and user
+    batched, legacy = FakeWarden(batch=True).start(), FakeWarden(batch=False, host="localhost").start()
+    yield batched, legacy
+    batched.stop()
+    legacy.stop()
+
+
+def targets_on(warden: FakeWarden) -> list[Target]:
+    return [
+        Target.objects.create(username=f"user{uid}", unit=f"user-{uid}.slice", host=warden.host, port=warden.port)
+        for uid in range(2000, 2000 + USERS)
+    ]
+
+
+@pytest.mark.django_db
+def test_batched_and_legacy_wardens(warden_client, wardens):
+    batched, legacy = wardens
+    applicable = {target: [LIMITS] for target in targets_on(batched) + targets_on(legacy)}
+
+    final_applications = warden_client.run(reduce_and_apply_limits(applicable))
+
+    assert final_applications == {target: LIMITS for target in applicable}
+    for warden in wardens:
+        assert warden.properties == {f"user-{uid}.slice": LIMITS for uid in range(2000, 2000 + USERS)}
+
+    # five units in batches of two, and no single requests
+    assert batched.requests == {"control/batch": 3, "control": 0}
+
+    # one rejected batch, then a request per limit
+    assert legacy.requests == {"control/batch": 0, "control": USERS * len(LIMITS)}
+    assert not warden_client.supports_batch(legacy.endpoint)
+    assert warden_client.supports_batch(batched.endpoint)
+
+
+@pytest.mark.django_db
+def test_batch_partial_failure(warden_client, wardens):
+    batched, _ = wardens
+    good, bad = targets_on(batched)[:2]
+    applicable = {good: [LIMITS], bad: [{CPU_QUOTA: "unlimited", MEMORY_MAX: 1024}]}
+
+    final_applications = warden_client.run(reduce_and_apply_limits(applicable))
+
+    # only the property the warden rejected is left out
+    assert final_applications == {good: LIMITS, bad: {MEMORY_MAX: 1024}}
@@ -0,0 +1,211 @@
+import re
+import random
+from datetime import timedelta
+
+import numpy as np
+import pytest
+from django.utils import timezone
+
+from arbiter3.arbiter import eval
+from arbiter3.arbiter.eval import query_violations, find_violations, evaluate_locally, run_queries, parse_target_labels
+from arbiter3.arbiter.localeval import LocalEvaluator, fullmatches
+from arbiter3.arbiter.models import Policy, BasePolicy, QueryData, QueryParameters
+from arbiter3.arbiter.promclient import Vector, Series
+from arbiter3.arbiter.utils import BYTES_PER_GIB
+
+from testing.util import FakePrometheus, AsyncPrometheus
+
+
+HOSTS = [f"node{i}" for i in range(6)] + ["login0", "login1"]
+PROCS = ["bash", "ssh", "python", "sleep", "make"]
+
+SELECTOR = re.compile(r"(cgroup_warden_\w+)(?:\{((?:`[^`]*`|[^`}])*)\})?(?:\[(\d+)s(?::(\d+)s)?\])?")
+MATCHER = re.compile(r"(\w+)(=~|!~)`([^`]*)`")
+RECORD = re.compile(r"(arbiter:(cgroup_warden_\w+):\w+?\d+s)\{((?:`[^`]*`|[^`}])*)\}")
+
+
+class UsageSeries:
+    def __init__(self, labels: dict[str, str], value: float):
+        self.labels = labels
+        # the per-second increase of counters, the value of gauges
+        self.value = value
+
+
+class ReferencePrometheus(FakePrometheus):
+    """
+    Evaluates the queries QueryData.build_query and LocalEvaluator make, and
+    the recorded lookups of use_recording_rules, over usage that is constant
+    over time, a series at a time in plain python.
+    """
+
+    def __init__(self, seed: int = 0):
+        super().__init__(HOSTS)
+        rng = random.Random(seed)
+        self.series = {name: [] for name in (
+            "cgroup_warden_cpu_usage_seconds",
+            "cgroup_warden_memory_usage_bytes",
+            "cgroup_warden_proc_cpu_usage_seconds",
+            "cgroup_warden_proc_memory_pss_bytes",
+        )}
+        for host in HOSTS:
+            slices = [("/system.slice", "root")]
+            slices += [(f"/user.slice/user-{uid}.slice", f"user-{uid}") for uid in range(990, 1012) if rng.random() < 0.6]
+            for cgroup, username in slices:
+                labels = {"cgroup": cgroup, "instance": f"{host}:2112", "username": username, "job": "cgroup-warden"}
+                cpu, mem = 0.0, 0.0
+                for proc in rng.sample(PROCS, rng.randint(1, len(PROCS))):
+                    proc_cpu, proc_mem = rng.uniform(0, 1.2), rng.uniform(0, 1) * BYTES_PER_GIB
+                    self.series["cgroup_warden_proc_cpu_usage_seconds"].append(UsageSeries({**labels, "proc": proc}, proc_cpu))
+                    self.series["cgroup_warden_proc_memory_pss_bytes"].append(UsageSeries({**labels, "proc": proc}, proc_mem))
+                    cpu, mem = cpu + proc_cpu, mem + proc_mem
+                self.series["cgroup_warden_cpu_usage_seconds"].append(UsageSeries(labels, cpu * rng.uniform(1, 1.1)))
+                self.series["cgroup_warden_memory_usage_bytes"].append(UsageSeries(labels, mem * rng.uniform(1, 1.2)))
+
+    def query(self, query, time=None, timeout=None, columnar=False):
+        if query.startswith("up"):
+            return super().query(query, time, timeout, columnar)
+        self.queries.append(query)
+
+        results = {}
+        for part in query.split(" or "):
+            for vector in self.evaluate(part):
+                # `or` keeps the left side's result for a label set both sides have
+                results.setdefault(tuple(sorted(vector.metric.items())), vector)
+        return list(results.values())
+
+    def evaluate(self, part: str) -> list[Vector]:
+        if recorded := RECORD.search(part):
+            # the series of the rules of generate_recording_rules: a rate or average over the lookback
+            record, name, matchers = recorded.groups()
+            lookback = step = None
+        else:
+            name, matchers, lookback, step = SELECTOR.search(part).groups()
+        domain = re.search(r"arbiter_domain=`([^`]*)`", matchers or "")
+        matchers = MATCHER.findall(matchers or "")
+        if domain:
+            matchers.append(("instance", "=~", domain.group(1)))
+        series = [
+            s for s in self.series[name]
+            if all((re.fullmatch(value, s.labels.get(label, "")) is not None) == (op == "=~") for label, op, value in matchers)
+        ]
+
+        if recorded:
+            values = [s.value for s in series]
+        elif "increase(" in part:
+            values = [s.value * int(lookback) for s in series]
+        elif "sum_over_time(" in part:
+            values = [s.value * (int(lookback) // int(step)) for s in series]
+        else:
+            values = [s.value for s in series]
+
+        if divisor := re.search(r"\) / (\d+)\)", part):
+            values = [value / int(divisor.group(1)) for value in values]
+
+        threshold = float(match.group(1)) if (match := re.search(r"> ([0-9.e+]+)", part)) else None
+        summed_first = re.search(r"by \([^)]*\) > ", part) is not None
+
+        if threshold is not None and not summed_first:
+            series, values = zip(*[(s, v) for s, v in zip(series, values) if v > threshold]) if series else ((), ())
+
+        if " by (" in part:
+            sums = {}
+            for s, value in zip(series, values):
+                key = tuple((label, s.labels[label]) for label in ("username", "instance", "cgroup", "job"))
+                sums[key] = sums.get(key, 0) + value
+            vectors = [Vector(dict(key), Series(0, str(value))) for key, value in sums.items()]
+        elif recorded:
+            # recorded series are named after their rule, and carry its domain label
+            labels = {"__name__": record, "arbiter_domain": domain.group(1)}
+            vectors = [Vector({**s.labels, **labels}, Series(0, str(value))) for s, value in zip(series, values)]
+        else:
+            vectors = [Vector(dict(s.labels), Series(0, str(value))) for s, value in zip(series, values)]
+
+        if threshold is not None and summed_first:
+            vectors = [vector for vector in vectors if float(vector.value.value) > threshold]
+        return vectors
+
+
+@pytest.fixture
+def reference_prometheus(monkeypatch):
+    prometheus = ReferencePrometheus()
+    monkeypatch.setattr(eval, "PROMETHEUS_CONNECTION", prometheus)
+    monkeypatch.setattr(eval, "PROMETHEUS_ASYNC_CONNECTION", AsyncPrometheus(prometheus))
+    return prometheus
+
+
+def usage_policy(name: str, domain: str, lookback: timedelta, penalty, **params) -> Policy:
+    query = QueryData.build_query(lookback, domain, QueryParameters(**params))
+    return Policy.objects.create(
+        name=name,
+        domain=domain,
+        description="description",
+        penalty_constraints=penalty,
+        query_data=query.json(),
+        lookback=lookback,
+        repeated_offense_lookback=timedelta(seconds=0),
+        repeated_offense_scalar=0.0,
+        penalty_duration=timedelta(seconds=5),
+        grace_period=timedelta(seconds=0),
+    )
+
+
+@pytest.fixture
+def mixed_policies(db, harsh_penalty):
+    gib = BYTES_PER_GIB
+    base = BasePolicy(name="base", domain="login.*", description="description", penalty_constraints=harsh_penalty)
+    base.query_data = {"params": {"user_whitelist": "user-100[0-4]"}}
+    base.save()
+    return [
+        usage_policy("nodes", "node.*", timedelta(minutes=1), harsh_penalty, cpu_threshold=2.0, mem_threshold=2.5 * gib),
+        usage_policy("some nodes", "node[0-2].*", timedelta(minutes=1, seconds=30), harsh_penalty, cpu_threshold=1.5, mem_threshold=0, user_whitelist="user-100[0-4]"),
+        usage_policy("login", "login.*", timedelta(minutes=2), harsh_penalty, cpu_threshold=0.9, mem_threshold=1.2 * gib, proc_whitelist="ssh|bash"),
+        usage_policy("memory", ".*", timedelta(minutes=5), harsh_penalty, cpu_threshold=0, mem_threshold=1.5 * gib, proc_whitelist="python"),
+        usage_policy("short", "node[3-5].*", timedelta(seconds=10), harsh_penalty, cpu_threshold=2.2, mem_threshold=2 * gib),
+        base,
+    ]
+
+
+def test_fullmatches_anchors_patterns():
+    values = np.array(["node1:2112", "node10:2112", "login1:2112"], dtype=object)
+    assert fullmatches(r"node1:.*", values).tolist() == [True, False, False]
+    assert fullmatches(r"node.*", values).tolist() == [True, True, False]
+
+
+@pytest.mark.django_db
+def test_local_evaluation_matches_policy_queries(reference_prometheus, mixed_policies):
+    expected = {(v.target.host, v.target.username, v.policy.name) for v in query_violations(mixed_policies)}
+
+    evaluator = LocalEvaluator()
+    now = timezone.now()
+    results = run_queries(evaluator.queries(mixed_policies, now.timestamp()))
+    violations = find_violations(evaluate_locally(evaluator, mixed_policies, results, now))
+    actual = {(v.target.host, v.target.username, v.policy.name) for v in violations}
+
+    assert actual == expected
+    # every policy has violations, and targets below ARBITER_MIN_UID are left out by both
+    assert {name for _, _, name in expected} == {policy.name for policy in mixed_policies}
+    assert not any(int(username.split("-")[1]) < 1000 for _, username, _ in expected)
+
+
+@pytest.mark.django_db
+def test_queries_only_return_managed_user_slices(reference_prometheus, mixed_policies):
+    queries = LocalEvaluator().queries(mixed_policies, 0) + [policy.query for policy in mixed_policies]
+
+    returned = [result for query in queries for result in reference_prometheus.query(query)]
+    unfiltered = [result for query in queries for result in reference_prometheus.query(re.sub(r"cgroup=~`[^`]*`,?", "", query))]
+
+    # system slices and accounts below ARBITER_MIN_UID are no longer returned, so the safety net has nothing to drop
+    assert all(parse_target_labels(result) for result in returned)
+    assert len([result for result in unfiltered if parse_target_labels(result)]) == len(returned) < len(unfiltered)
+
+
+@pytest.mark.parametrize("proc_whitelist", [None, "ssh|bash"])
+def test_recorded_queries_match_direct_queries(reference_prometheus, proc_whitelist):
+    def results(use_recording_rules: bool, cpu_threshold: float = 0.9, mem_threshold: float = 1.2 * BYTES_PER_GIB) -> list:
+        params = QueryParameters(cpu_threshold=cpu_threshold, mem_threshold=mem_threshold, proc_whitelist=proc_whitelist, use_recording_rules=use_recording_rules)
+        query = QueryData.build_query(timedelta(minutes=2), "login.*", params).query
+        return sorted(tuple(sorted(r.metric.items())) for r in reference_prometheus.query(query))
+
+    # some users are over both thresholds, and are still returned once
+    assert set(results(False, mem_threshold=0)) & set(results(False, cpu_threshold=0))
+    assert results(True) == results(False)
@@ -0,0 +1,93 @@
+from datetime import timedelta
+
+import pytest
+from django.core import mail
+from django.utils import timezone
+from plotly.graph_objects import Figure
+
+from arbiter3.arbiter import email, inventory, notify, plots
+from arbiter3.arbiter.inventory import HOST_INVENTORY
+from arbiter3.arbiter.models import Notification, Violation
+from arbiter3.arbiter.notify import enqueue_notifications, send_notifications, RateLimiter
+
+from testing.conftest import BULK_HOSTS
+from testing.util import FakePrometheus
+
+
+@pytest.fixture
+def fake_figures(monkeypatch):
+    # figures would query prometheus and be rendered by kaleido
+    failing = set()
+
+    def figure(violation):
+        if violation.pk in failing:
+            raise plots.QueryError("prometheus unavailable")
+        return Figure()
+
+    monkeypatch.setattr(plots, "violation_cpu_usage_figure", figure)
+    monkeypatch.setattr(plots, "violation_mem_usage_figure", figure)
+    monkeypatch.setattr(email, "render_images", lambda figures: [b"\x89PNG\r\n\x1a\n" for _ in figures])
+    monkeypatch.setattr(notify, "RATE_LIMITER", RateLimiter(0))
+    monkeypatch.setattr(inventory, "PROMETHEUS_CONNECTION", FakePrometheus(BULK_HOSTS))
+    monkeypatch.setattr(HOST_INVENTORY, "_refreshed", None)
+    return failing
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    opened = []
+
+    def get_connection(*args, **kwargs):
+        connection = mail.get_connection(*args, **kwargs)
+        opened.append(connection)
+        return connection
+
+    monkeypatch.setattr(notify, "get_connection", get_connection)
+    return opened
+
+
+@pytest.fixture
+def violations(db, bulk_targets, short_low_harsh_policy):
+    violations = [
+        Violation(target=target, policy=short_low_harsh_policy, expiration=timezone.now() + timedelta(hours=1), offense_count=1)
+        for target in bulk_targets[:10]
+    ]
+    return Violation.objects.bulk_create(violations)
+
+
+@pytest.mark.django_db
+def test_send_notifications(fake_figures, connections, violations):
+    enqueue_notifications(violations)
+
+    assert send_notifications() == {"sent": len(violations), "failed": 0}
+    assert len(mail.outbox) == len(violations)
+    assert len(connections) == 1
+
+    # nothing is sent twice
+    assert send_notifications() == {"sent": 0, "failed": 0}
+
+
+@pytest.mark.django_db
+def test_base_status_not_notified(db, bulk_targets, base_soft_policy):
+    base = Violation.objects.create(target=bulk_targets[0], policy=base_soft_policy, is_base_status=True)
+
+    assert enqueue_notifications([base]) == []
+
+
+@pytest.mark.django_db
+def test_retry_failed_notification(fake_figures, connections, violations):
+    enqueue_notifications(violations)
+    fake_figures.add(violations[0].pk)
+
+    assert send_notifications() == {"sent": len(violations) - 1, "failed": 1}
+    failed = Notification.objects.get(sent__isnull=True)
+    assert failed.attempts == 1
+    assert "prometheus unavailable" in failed.error
+
+    # not retried until the backoff has passed
+    assert send_notifications() == {"sent": 0, "failed": 0}
+
+    fake_figures.clear()
+    Notification.objects.filter(pk=failed.pk).update(next_attempt=timezone.now())
+    assert send_notifications() == {"sent": 1, "failed": 0}
+    assert len(mail.outbox) == len(violations)
@@ -0,0 +1,194 @@
+import json
+import zlib
+import random
+import asyncio
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from arbiter3.arbiter.promclient import (
+    Matrix, Vector, Series, ColumnarMatrix,
+    parse_matrix_result, parse_matrix_columns, parse_vector_result, parse_vector_columns,
+    sort_matrices_by_avg, combine_last_matrices, DECODERS, StreamingDecoder, orjson,
+    PrometheusSession, AsyncPrometheusSession, transfer_stats, decompress,
+)
+
+from testing.fake_prometheus import FakePrometheusServer
+
+
+class RecordedResponse:
+    def __init__(self, body: bytes):
+        self.content = body
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+
+def range_result(processes: int, points: int) -> list[dict]:
+    # processes sample at different steps so the 'other' fold has timestamps only some of them share
+    return [
+        {
+            "metric": {"proc": f"proc{i}"},
+            "values": [[1700000000 + j * 30 * (1 + i % 2), str(round(random.uniform(0, 4), 3))] for j in range(points)],
+        }
+        for i in range(processes)
+    ] + [{"metric": {"proc": "idle"}, "values": []}, {"metric": {"proc": "tie"}, "values": [[1700000000, "2"]]}]
+
+
+def points(matrix) -> list[tuple[float, float]]:
+    return [(float(t), float(v)) for t, v in matrix.values]
+
+
+def test_columnar_matrix_matches_series():
+    result = range_result(processes=12, points=40)
+    columns, series = parse_matrix_columns(result), parse_matrix_result(result)
+
+    assert [points(m) for m in columns] == [points(m) for m in series]
+    assert [m.metric for m in columns] == [m.metric for m in series]
+    assert ColumnarMatrix.from_matrix(series[0]).samples.tolist() == columns[0].samples.tolist()
+
+
+def test_vectorized_sort_and_fold_match_series():
+    result = range_result(processes=12, points=40)
+    columns = combine_last_matrices(sort_matrices_by_avg(parse_matrix_columns(result)), 7)
+    series = combine_last_matrices(sort_matrices_by_avg(parse_matrix_result(result)), 7)
+
+    assert [m.metric for m in columns] == [m.metric for m in series]
+    assert columns[-1].metric == {"proc": "other**"}
+    for c, s in zip(columns, series):
+        assert points(c) == pytest.approx(points(s))
+
+    # the fold covers every timestamp any folded process has, in order
+    folded = {t for m in parse_matrix_columns(result) for t in m.timestamps.tolist()}
+    assert columns[-1].timestamps.tolist() == sorted(folded)
+
+
+def test_fold_without_usage_is_dropped():
+    matrices = [Matrix({"proc": "a"}, [Series(0, "1")]), Matrix({"proc": "b"}, [Series(0, "0")])]
+    assert combine_last_matrices(matrices, 1) == matrices[:1]
+    assert combine_last_matrices([], -1) == []
+
+
+def test_columnar_vectors_view():
+    result = [{"metric": {"instance": "a"}, "value": [1700000000.5, "1"]}, {"metric": {"instance": "b"}, "value": [1700000000.5, "NaN"]}]
+    vectors = parse_vector_columns(result)
+
+    assert len(vectors) == 2
+    assert vectors[0] == Vector({"instance": "a"}, Series(1700000000.5, 1.0))
+    assert [v.metric for v in vectors] == [v.metric for v in parse_vector_result(result)]
+    assert vectors.samples[1] != vectors.samples[1]
+
+
+def response_body(result_type: str, result: list) -> bytes:
+    return json.dumps({"status": "success", "data": {"resultType": result_type, "result": result}, "warnings": ["ignored"]}).encode()
+
+
+@pytest.mark.parametrize("decoder", [StreamingDecoder(chunk_size=7), *(d() for name, d in DECODERS.items() if name != "orjson" or orjson)])
+def test_decoders_agree(decoder):
+    # a multibyte label split across chunks
+    result = range_result(processes=5, points=20) + [{"metric": {"proc": "naïve ✓"}, "values": [[1700000000, "1"]]}]
+
+    result_type, decoded = decoder.decode(RecordedResponse(response_body("matrix", result)))
+    assert result_type == "matrix"
+    assert list(decoded) == result
+
+    result_type, decoded = decoder.decode(RecordedResponse(response_body("vector", [])))
+    assert result_type == "vector"
+    assert list(decoded) == []
+
+
+def test_streaming_decoder_falls_back_and_fails_on_truncation():
+    decoder = StreamingDecoder(chunk_size=16)
+    body = json.dumps({"data": {"result": [{"metric": {}, "value": [1, "2"]}], "resultType": "vector"}, "status": "success"}).encode()
+    assert decoder.decode(RecordedResponse(body)) == ("vector", [{"metric": {}, "value": [1, "2"]}])
+
+    result_type, decoded = decoder.decode(RecordedResponse(response_body("matrix", range_result(3, 10))[:-80]))
+    with pytest.raises(json.JSONDecodeError):
+        list(decoded)
+
+
+@pytest.fixture
+def prometheus_server():
+    # answers every query with the same matrix
+    body = response_body("matrix", range_result(processes=4, points=10))
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+def test_async_session_matches_session(prometheus_server):
+    expected = PrometheusSession(prometheus_server).query_range("up", 0, 1, "1s")
+
+    async def queries():
+        session = AsyncPrometheusSession(prometheus_server, max_connections=2)
+        try:
+            return await asyncio.gather(*(session.query_range("up", 0, 1, "1s") for _ in range(4)))
+        finally:
+            await session.close()
+
+    assert asyncio.run(queries()) == [expected] * 4
+
+
+@pytest.fixture
+def compressing_prometheus():
+    prometheus = FakePrometheusServer(matrix=range_result(processes=20, points=50)).start()
+    yield prometheus
+    prometheus.stop()
+
+
+def test_long_queries_are_posted_and_responses_decompressed(compressing_prometheus):
+    # a query naming many users, too long to send in a url
+    long_query = "cgroup_warden_cpu_usage_seconds{username=~\"" + "|".join(f"user{i}" for i in range(500)) + "\"}"
+    session = PrometheusSession(compressing_prometheus.url)
+    short = session.query_range("up", 0, 1, "1s")
+    long = session.query_range(long_query, 0, 1, "1s")
+
+    async def queries():
+        async_session = AsyncPrometheusSession(compressing_prometheus.url)
+        try:
+            return await asyncio.gather(async_session.query_range("up", 0, 1, "1s"), async_session.query_range(long_query, 0, 1, "1s")), async_session
+        finally:
+            await async_session.close()
+
+    results, async_session = asyncio.run(queries())
+    assert short == long == results[0] == results[1]
+    assert compressing_prometheus.methods == ["GET", "POST", "GET", "POST"]
+
+    for client in (session, async_session):
+        stats = transfer_stats(client)
+        assert (stats["requests"], stats["posts"], stats["compressed"]) == (2, 1, 2)
+        assert 0 < stats["wire_bytes"] < stats["body_bytes"] / 2
+    assert transfer_stats(session, async_session)["requests"] == 4
+
+
+def test_post_threshold():
+    prometheus = FakePrometheusServer(vector=[{"metric": {}, "value": [1, "1"]}]).start()
+    try:
+        PrometheusSession(prometheus.url, post_threshold=0).query("up")
+        PrometheusSession(prometheus.url, post_threshold=None).query("up" + " " * 5000)
+        assert prometheus.methods == ["POST", "GET"]
+    finally:
+        prometheus.stop()
+
+
+def test_decompress_deflate_variants():
+    body = response_body("vector", [])
+    raw = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    assert decompress(zlib.compress(body), "deflate") == body
+    assert decompress(raw.compress(body) + raw.flush(), "deflate") == body
+    assert decompress(body, None) is body
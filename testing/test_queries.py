@@ -0,0 +1,242 @@
+import io
+import re
+
+import pytest
+from django.core.management import call_command
+
+from arbiter3.arbiter import eval, inventory, snapshot, models
+from arbiter3.arbiter.eval import evaluate, refresh_limits, find_violations
+from arbiter3.arbiter.inventory import HOST_INVENTORY
+from arbiter3.arbiter.models import Target, Violation, Event
+from arbiter3.arbiter.prop import CPU_QUOTA, MEMORY_MAX
+from arbiter3.arbiter.querycache import QUERY_CACHE, canonical_query
+from arbiter3.arbiter.planner import QueryPlan
+from arbiter3.arbiter.models import QueryData, QueryParameters, Policy
+from arbiter3.arbiter.rules import recording_rules, policy_rules
+from arbiter3.arbiter.utils import user_slice_regex
+
+from testing.conftest import BULK_HOSTS, SHORT_WINDOW, CPU_LOW_THRESHOLD, MEM_LOW_THRESHOLD
+from testing.util import FakePrometheus, AsyncPrometheus, usage_vector, fake_set_property
+
+
+# statements an evaluation cycle may issue for a handful of policies, however many targets there are.
+# bulk writes are still split into batches of a few hundred rows on sqlite, so this is not a hard
+# constant, but any per-target query brings a cycle over the 4000 bulk targets to thousands.
+QUERY_BUDGET = 120
+
+
+@pytest.fixture
+def fake_cluster(monkeypatch, bulk_targets):
+    # every bulk user is over the usage threshold on every host
+    prometheus = FakePrometheus(BULK_HOSTS, [usage_vector(target) for target in bulk_targets])
+    monkeypatch.setattr(eval, "PROMETHEUS_CONNECTION", prometheus)
+    monkeypatch.setattr(eval, "PROMETHEUS_ASYNC_CONNECTION", AsyncPrometheus(prometheus))
+    monkeypatch.setattr(snapshot, "PROMETHEUS_ASYNC_CONNECTION", AsyncPrometheus(prometheus))
+    monkeypatch.setattr(inventory, "PROMETHEUS_CONNECTION", prometheus)
+    monkeypatch.setattr(HOST_INVENTORY, "_refreshed", None)
+    monkeypatch.setattr(eval, "set_property", fake_set_property)
+    return prometheus
+
+
+@pytest.mark.django_db
+def test_evaluate_query_count(fake_cluster, bulk_targets, bulk_violations, short_low_harsh_policy, base_soft_policy, django_assert_max_num_queries):
+    with django_assert_max_num_queries(QUERY_BUDGET):
+        evaluate([short_low_harsh_policy, base_soft_policy])
+
+    # half of the targets had no usage violation yet, so they got one
+    assert Violation.objects.filter(policy=short_low_harsh_policy).count() == len(bulk_targets)
+
+    # every target is limited, and a second cycle has nothing left to change
+    assert not Target.objects.filter(limits={}).exists()
+    assert Event.objects.last().data["targets"] == {"changed": len(bulk_targets), "released": 0, "failed": 0, "skipped": 0}
+    with django_assert_max_num_queries(QUERY_BUDGET):
+        evaluate([short_low_harsh_policy, base_soft_policy])
+    assert Event.objects.last().data["targets"] == {"changed": 0, "released": 0, "failed": 0, "skipped": len(bulk_targets)}
+
+
+@pytest.mark.django_db
+def test_evaluate_creates_targets_in_bulk(fake_cluster, short_low_harsh_policy, django_assert_max_num_queries):
+    Target.objects.all().delete()
+
+    with django_assert_max_num_queries(QUERY_BUDGET):
+        evaluate([short_low_harsh_policy])
+
+    assert Target.objects.count() == len(fake_cluster.results)
+
+
+@pytest.mark.django_db
+def test_refresh_limits_query_count(fake_cluster, bulk_targets, short_low_harsh_policy, django_assert_max_num_queries):
+    # the wardens report a limit arbiter does not know about on every target
+    fake_cluster.results = [usage_vector(target, value=5) for target in bulk_targets]
+
+    with django_assert_max_num_queries(QUERY_BUDGET):
+        refresh_limits(short_low_harsh_policy)
+
+    assert Target.objects.filter(limits={CPU_QUOTA: 5, MEMORY_MAX: 5}).count() == len(bulk_targets)
+
+
+@pytest.mark.django_db
+def test_evaluate_sends_refresh_queries_together(fake_cluster, bulk_targets, short_low_harsh_policy):
+    fake_cluster.results = [usage_vector(target, value=5) for target in bulk_targets]
+
+    evaluate([short_low_harsh_policy], refresh=True)
+
+    # the policy, both limit refreshes and the inventory, each sent once
+    assert sorted(query.split("{")[0] for query in fake_cluster.queries[:4]) == sorted([
+        short_low_harsh_policy.query.split("{")[0], "cgroup_warden_cpu_quota", "cgroup_warden_memory_max", "up",
+    ])
+    assert HOST_INVENTORY.loaded
+
+
+@pytest.mark.django_db
+def test_evaluate_sends_each_query_once_per_cycle(fake_cluster, bulk_targets, short_low_harsh_policy, short_low_medium_policy):
+    fake_cluster.results = [usage_vector(target, value=5) for target in bulk_targets]
+
+    evaluate([short_low_harsh_policy, short_low_medium_policy], refresh=True)
+
+    # both policies cover every host, so their limit refreshes are the same queries
+    assert len(fake_cluster.queries) == len(set(fake_cluster.queries))
+    assert [query.split("{")[0] for query in fake_cluster.queries].count("cgroup_warden_cpu_quota") == 1
+    # and all of them are evaluated at the same moment
+    assert len(set(fake_cluster.times)) == 1 and None not in fake_cluster.times
+
+    # the cache only lives for the cycle
+    assert not QUERY_CACHE.active
+    # only the queries sent to prometheus missed, at least the second policy's limit refreshes hit
+    assert QUERY_CACHE.counters["misses"] == len(fake_cluster.queries)
+    assert QUERY_CACHE.counters["hits"] >= 2
+
+
+@pytest.mark.django_db
+def test_usage_is_captured_after_limits_are_applied(fake_cluster, monkeypatch, bulk_targets, short_low_harsh_policy):
+    applied, captured = [], []
+
+    async def recording_set_property(target, name, value):
+        applied.append(target)
+        return await fake_set_property(target, name, value)
+
+    monkeypatch.setattr(eval, "set_property", recording_set_property)
+    monkeypatch.setattr(eval, "capture_snapshots", lambda violations, end: captured.append(len(applied)) or [])
+    evaluate([short_low_harsh_policy])
+
+    # snapshot queries don't hold up enforcement
+    assert captured and captured[0] > 0
+
+
+def test_canonical_query():
+    assert canonical_query('sum by (username) (rate(x{job = "a  b"}[5m]))  >  1') == 'sum by(username)(rate(x{job="a  b"}[5m]))>1'
+    assert canonical_query("a or b") != canonical_query("aor b")
+
+
+@pytest.mark.parametrize("min_uid", [0, 1, 9, 500, 1000, 1234, 60001])
+def test_user_slice_regex(min_uid):
+    # prometheus anchors regexes at both ends, as fullmatch does
+    pattern = re.compile(user_slice_regex(min_uid))
+    for uid in range(100000):
+        assert (pattern.fullmatch(f"/user.slice/user-{uid}.slice") is not None) == (uid >= min_uid)
+    assert not pattern.fullmatch("/system.slice")
+    assert not pattern.fullmatch(f"/user.slice/user-{min_uid + 1}.slice/session-1.scope")
+
+
+@pytest.mark.django_db
+def test_refresh_queries_rebuilds_queries_for_the_current_min_uid(monkeypatch, short_low_harsh_policy, base_soft_policy):
+    monkeypatch.setattr(models, "USER_SLICES", user_slice_regex(500))
+    call_command("refresh_queries", stdout=io.StringIO(), stderr=io.StringIO())
+
+    for policy in Policy.objects.all():
+        assert f"cgroup=~`{user_slice_regex(500)}`" in policy.query
+        assert policy.rebuilt_query().query == policy.query
+
+
+@pytest.mark.django_db
+def test_policies_sharing_a_domain_are_queried_together(fake_cluster, bulk_targets, short_low_harsh_policy, short_low_medium_policy):
+    evaluate([short_low_harsh_policy, short_low_medium_policy])
+
+    policy_queries = [query for query in fake_cluster.queries if not query.startswith(("up", "max_over_time"))]
+    assert len(policy_queries) == 1
+    for policy in (short_low_harsh_policy, short_low_medium_policy):
+        assert Violation.objects.filter(policy=policy).count() == len(bulk_targets)
+
+
+@pytest.mark.django_db
+def test_rejected_part_of_a_combined_query_only_loses_its_policy(fake_cluster, bulk_targets, short_low_harsh_policy, short_low_medium_policy, base_soft_policy):
+    # the usage policy form doesn't check whitelists, prometheus rejects the query of this one
+    params = QueryParameters(cpu_threshold=CPU_LOW_THRESHOLD, mem_threshold=MEM_LOW_THRESHOLD, user_whitelist="user-(")
+    broken = Policy.objects.create(
+        name="broken whitelist",
+        domain=short_low_harsh_policy.domain,
+        description="description",
+        penalty_constraints=short_low_harsh_policy.penalty_constraints,
+        query_data=QueryData.build_query(SHORT_WINDOW, short_low_harsh_policy.domain, params).json(),
+        lookback=SHORT_WINDOW,
+    )
+    query = fake_cluster.query
+
+    def rejecting(q, *args, **kwargs):
+        if "`user-(`" in q:
+            raise ValueError("bad_data: invalid regular expression")
+        return query(q, *args, **kwargs)
+
+    fake_cluster.query = rejecting
+    policies = [short_low_harsh_policy, broken, base_soft_policy, short_low_medium_policy]
+    evaluate(policies)
+
+    # the base policy is never combined with usage policies
+    assert any(q == base_soft_policy.query for q in fake_cluster.queries)
+    for policy in (short_low_harsh_policy, short_low_medium_policy, base_soft_policy):
+        assert Violation.objects.filter(policy=policy).count() == len(bulk_targets)
+    assert not Violation.objects.filter(policy=broken).exists()
+
+
+@pytest.mark.django_db
+def test_query_plan_demultiplexes_results(bulk_targets, short_low_harsh_policy, short_low_medium_policy, base_soft_policy):
+    policies = [short_low_harsh_policy, base_soft_policy, short_low_medium_policy]
+    plan = QueryPlan(policies)
+    usage = usage_vector(bulk_targets[0])
+
+    grouped = next(i for i, group in enumerate(plan.groups) if len(group) == 2)
+    results = [None] * len(plan.groups)
+    results[grouped] = [
+        usage._replace(metric={**usage.metric, "arbiter_policy": str(short_low_medium_policy.pk)}),
+        usage._replace(metric={**usage.metric, "arbiter_policy": "0"}),
+    ]
+    for i in range(len(plan.groups)):
+        if i != grouped:
+            results[i] = RuntimeError("timed out")
+
+    # results go to the policy they're labeled with, and the policies of a failed query are left out
+    assert plan.demultiplex(results) == [(short_low_harsh_policy, []), (short_low_medium_policy, [usage])]
+
+
+@pytest.mark.django_db
+def test_repeated_series_of_a_target_violate_once(bulk_targets, short_low_harsh_policy):
+    usage = usage_vector(bulk_targets[0])
+    # e.g. both sides of an `or` whose label sets differ
+    results = [usage, usage._replace(metric={**usage.metric, "__name__": "arbiter:cgroup_warden_cpu_usage_seconds:rate60s"})]
+
+    assert len(find_violations([(short_low_harsh_policy, results)])) == 1
+
+
+@pytest.mark.django_db
+def test_recorded_queries_look_up_generated_rules(short_low_harsh_policy, short_low_medium_policy):
+    params = QueryParameters(cpu_threshold=1, mem_threshold=2**30, proc_whitelist="sshd", user_whitelist="root", use_recording_rules=True)
+    for policy in (short_low_harsh_policy, short_low_medium_policy):
+        policy.query_data = QueryData.build_query(policy.lookback, policy.domain, params).json()
+        policy.save()
+
+    # both policies need the same two rules
+    rules = recording_rules([short_low_harsh_policy, short_low_medium_policy])
+    assert len(rules) == 2 and rules == policy_rules(short_low_harsh_policy)
+
+    query = short_low_harsh_policy.query
+    # instant lookups, without range selectors
+    assert not re.search(r"\[\d+s", query)
+    for rule in rules:
+        assert f"{rule.record}{{" in query
+        assert "cgroup_warden_proc_" in rule.expr and "[" in rule.expr
+
+    out, err = io.StringIO(), io.StringIO()
+    call_command("generate_recording_rules", stdout=out, stderr=err)
+    yaml = pytest.importorskip("yaml")
+    generated = yaml.safe_load(out.getvalue())["groups"][0]["rules"]
+    assert [(rule["record"], rule["expr"], rule["labels"]) for rule in generated] == [tuple(rule) for rule in rules]
@@ -0,0 +1,159 @@
+import time
+import asyncio
+
+import pytest
+import aiohttp
+import requests
+
+from arbiter3.arbiter.promclient import PrometheusSession, AsyncPrometheusSession, Vector, Series
+from arbiter3.arbiter.resilience import QueryPolicy, CircuitBreaker, CircuitOpenError
+
+from testing.fake_prometheus import FakePrometheusServer
+
+
+UP = [{"metric": {"instance": "node1:2112"}, "value": [1700000000, "1"]}]
+
+
+@pytest.fixture
+def prometheus():
+    prometheus = FakePrometheusServer(vector=UP).start()
+    yield prometheus
+    prometheus.stop()
+
+
+def session(prometheus: FakePrometheusServer, **policy) -> PrometheusSession:
+    policy = QueryPolicy(**{"retries": 2, "backoff": 0, **policy})
+    return PrometheusSession(prometheus.url, policy=policy, default_timeout=5)
+
+
+def test_transient_failures_are_retried(prometheus):
+    client = session(prometheus)
+    prometheus.inject(status=503, count=2)
+
+    assert client.query("up") == [Vector({"instance": "node1:2112"}, Series(1700000000, "1"))]
+    assert prometheus.requests == 3
+    assert client.policy.stats()["retries"] == 2
+
+
+def test_rejected_queries_are_not_retried(prometheus):
+    client = session(prometheus)
+    prometheus.inject(status=400)
+
+    with pytest.raises(requests.HTTPError):
+        client.query("up{")
+    assert prometheus.requests == 1
+    assert client.policy.breaker.state == "closed"
+
+
+def test_timeouts_are_retried(prometheus):
+    client = PrometheusSession(prometheus.url, policy=QueryPolicy(retries=1, backoff=0), default_timeout=0.2)
+    prometheus.inject(delay=1)
+
+    assert client.query("up")
+    assert client.policy.stats()["failures"] == 1
+
+
+def test_circuit_breaker_fails_fast_and_recovers(prometheus):
+    client = session(prometheus, retries=0, breaker=CircuitBreaker(threshold=2, reset_timeout=0.3))
+    prometheus.inject(status=503, count=2)
+
+    for _ in range(2):
+        with pytest.raises(requests.HTTPError):
+            client.query("up")
+    with pytest.raises(CircuitOpenError):
+        client.query("up")
+    assert prometheus.requests == 2
+    assert client.policy.breaker.state == "open"
+
+    # one trial query is let through once the breaker resets, and closes it
+    time.sleep(0.3)
+    assert client.query("up")
+    assert client.policy.breaker.state == "closed"
+    assert client.policy.stats()["rejected"] == 1
+
+
+def test_slow_queries_are_hedged(prometheus):
+    client = session(prometheus, hedge_percentile=90, hedge_min_samples=5)
+    for _ in range(5):
+        client.query("up")
+
+    prometheus.inject(delay=2)
+    start = time.monotonic()
+    assert client.query("up")
+    assert time.monotonic() - start < 1
+
+    stats = client.policy.stats()
+    assert (stats["hedges"], stats["hedge_wins"]) == (1, 1)
+
+
+def test_async_session_retries_and_hedges(prometheus):
+    policy = QueryPolicy(retries=2, backoff=0, hedge_percentile=90, hedge_min_samples=5)
+
+    async def queries():
+        client = AsyncPrometheusSession(prometheus.url, policy=policy, default_timeout=5)
+        try:
+            for _ in range(5):
+                await client.query("up")
+            prometheus.inject(status=502)
+            await client.query("up")
+            prometheus.inject(delay=2)
+            start = time.monotonic()
+            await client.query("up")
+            return time.monotonic() - start
+        finally:
+            await client.close()
+
+    assert asyncio.run(queries()) < 1
+    stats = policy.stats()
+    assert (stats["retries"], stats["hedges"], stats["hedge_wins"]) == (1, 1, 1)
+
+
+def test_cancelled_trial_call_does_not_hold_the_breaker_open(prometheus):
+    breaker = CircuitBreaker(threshold=1, reset_timeout=0)
+    policy = QueryPolicy(retries=0, backoff=0, breaker=breaker)
+
+    async def queries():
+        client = AsyncPrometheusSession(prometheus.url, policy=policy, default_timeout=5)
+        try:
+            prometheus.inject(status=503)
+            with pytest.raises(aiohttp.ClientResponseError):
+                await client.query("up")
+            assert breaker.state == "half_open"
+
+            # the trial call is cancelled before prometheus answers
+            prometheus.inject(delay=2)
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(client.query("up"), timeout=0.2)
+            return await client.query("up")
+        finally:
+            await client.close()
+
+    assert asyncio.run(queries())
+    assert breaker.state == "closed"
+
+
+def test_cancelled_call_leaves_another_calls_trial_alone():
+    breaker = CircuitBreaker(threshold=1, reset_timeout=0)
+    policy = QueryPolicy(retries=0, backoff=0, breaker=breaker)
+
+    async def calls():
+        started = asyncio.Event()
+
+        async def slow():
+            started.set()
+            await asyncio.sleep(10)
+
+        # the call starts while the breaker is closed, then it opens and another call becomes the trial
+        call = asyncio.ensure_future(policy.acall(slow))
+        await started.wait()
+        breaker.record_failure()
+        assert breaker.before_call()
+
+        call.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await call
+        # the trial is still in progress, so no second one is let through
+        with pytest.raises(CircuitOpenError):
+            breaker.before_call()
+
+    asyncio.run(calls())
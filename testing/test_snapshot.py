@@ -0,0 +1,183 @@
+import re
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+import numpy as np
+import pytest
+from django.utils import timezone
+
+from arbiter3.arbiter import plots, snapshot
+from arbiter3.arbiter.codec import encode_matrices, decode_matrices, decode_arrays
+from arbiter3.arbiter.models import Violation, UsageSnapshot
+from arbiter3.arbiter.promclient import Matrix, Vector, Series
+from arbiter3.arbiter.snapshot import capture_snapshots
+
+from testing.util import AsyncPrometheus
+
+
+PROCS = [f"proc{i}" for i in range(9)]
+
+
+class FakeUsagePrometheus:
+    """
+    Serves the same per-process usage to the snapshot's batched queries and
+    to the per-violation queries of the graphs.
+    """
+
+    def __init__(self, targets):
+        self.targets = targets
+        self.queries = []
+
+    def matching(self, query):
+        username = re.search(r"username=~?`([^`]*)`", query).group(1)
+        return [target for target in self.targets if re.fullmatch(username, target.username)]
+
+    def labels(self, target, **extra):
+        return dict(instance=target.instance, username=target.username, **extra)
+
+    def usage(self, proc: int, i: int) -> float:
+        return (proc + 1) * 0.25 + (i % 3) * 0.1
+
+    def query_range(self, query, start, end, step, timeout=None, columnar=False):
+        self.queries.append(query)
+        step = int(step[:-1]) * (60 if step.endswith("m") else 1)
+        timestamps = [start + i * step for i in range(int((end - start) // step) + 1)]
+        procs = "_proc_cpu_" in query or "_proc_memory_" in query
+        totals = "cgroup_warden_cpu_usage_seconds" in query or "cgroup_warden_memory_usage_bytes" in query
+
+        matrices = []
+        for target in self.matching(query):
+            if procs and totals:
+                # the graphs' unreported query
+                matrices.append(Matrix({}, [Series(ts, "1.5") for ts in timestamps]))
+            elif procs:
+                for p, proc in enumerate(PROCS):
+                    matrices.append(Matrix(self.labels(target, proc=proc), [Series(ts, str(self.usage(p, i))) for i, ts in enumerate(timestamps)]))
+            else:
+                reported = [sum(self.usage(p, i) for p in range(len(PROCS))) for i in range(len(timestamps))]
+                matrices.append(Matrix(self.labels(target), [Series(ts, str(r + 1.5)) for ts, r in zip(timestamps, reported)]))
+        return matrices
+
+    def query(self, query, time=None, timeout=None, columnar=False):
+        self.queries.append(query)
+        return [Vector(self.labels(target, proc=proc), Series(time, str(p + 1))) for target in self.matching(query) for p, proc in enumerate(PROCS)]
+
+
+class NoPrometheus:
+    def query(self, *args, **kwargs):
+        raise AssertionError("queried prometheus")
+
+    query_range = query
+
+
+@pytest.fixture
+def violations(db, bulk_targets, short_low_harsh_policy):
+    # long enough for a graph of a few dozen points
+    short_low_harsh_policy.lookback = timedelta(hours=1)
+    short_low_harsh_policy.save()
+
+    now = timezone.now()
+    return [
+        Violation(target=target, policy=short_low_harsh_policy, expiration=now + short_low_harsh_policy.penalty_duration, timestamp=now)
+        for target in bulk_targets[:2]
+    ]
+
+
+def traces(figure):
+    return [(trace.name, [round(y, 4) for y in trace.y]) for trace in figure.data]
+
+
+@pytest.mark.django_db
+def test_snapshot_graphs_match_prometheus_graphs(monkeypatch, violations):
+    prometheus = FakeUsagePrometheus([v.target for v in violations])
+    monkeypatch.setattr(snapshot, "PROMETHEUS_ASYNC_CONNECTION", AsyncPrometheus(prometheus))
+    monkeypatch.setattr(plots, "PROMETHEUS_CONNECTION", prometheus)
+
+    snapshots = capture_snapshots(violations, violations[0].timestamp)
+    Violation.objects.bulk_create(violations)
+    UsageSnapshot.objects.bulk_create(snapshots)
+
+    # one set of queries for both violations
+    assert len(prometheus.queries) == 5
+    assert len(snapshots) == 2
+
+    for violation in Violation.objects.select_related("usage"):
+        # the top seven processes and the rest, including unreported usage
+        cpu = [matrix.metric["proc"] for matrix in violation.usage.matrices if matrix.metric["resource"] == "cpu"]
+        counts = {matrix.metric["proc"]: matrix.values[0].value for matrix in violation.usage.matrices if matrix.metric["resource"] == "count"}
+        assert cpu == PROCS[::-1][:7] + ["other**"]
+        assert counts == {proc: p + 1 for p, proc in enumerate(PROCS)}
+
+        stored = Violation.objects.get(pk=violation.pk)
+        stored.usage.delete()
+        stored = Violation.objects.get(pk=violation.pk)
+        for figure_func in (plots.violation_cpu_usage_figure, plots.violation_mem_usage_figure):
+            expected = traces(figure_func(stored))
+
+            monkeypatch.setattr(plots, "PROMETHEUS_CONNECTION", NoPrometheus())
+            assert traces(figure_func(violation)) == expected
+            monkeypatch.setattr(plots, "PROMETHEUS_CONNECTION", prometheus)
+
+
+@pytest.mark.django_db
+def test_snapshot_failure_falls_back(monkeypatch, violations):
+    monkeypatch.setattr(snapshot, "PROMETHEUS_ASYNC_CONNECTION", AsyncPrometheus(NoPrometheus()))
+
+    assert capture_snapshots(violations, timezone.now()) == []
+
+
+def test_codec_roundtrip():
+    matrices = [
+        Matrix({"proc": "python", "resource": "cpu"}, [Series(1700000000.0 + i * 60, str(i * 0.5)) for i in range(400)]),
+        Matrix({"proc": "other**", "resource": "cpu"}, [Series(1700000030.5, "2"), Series(1700009000.25, "1e-3")]),
+        Matrix({"resource": "count"}, []),
+    ]
+
+    decoded = decode_matrices(encode_matrices(matrices))
+    assert [matrix.metric for matrix in decoded] == [matrix.metric for matrix in matrices]
+    for original, matrix in zip(matrices, decoded):
+        assert [s.timestamp for s in matrix.values] == [s.timestamp for s in original.values]
+        assert [s.value for s in matrix.values] == pytest.approx([float(s.value) for s in original.values], rel=1e-6)
+
+    arrays = decode_arrays(encode_matrices(matrices))
+    assert arrays.offsets.tolist() == [0, 400, 402, 402]
+    assert arrays.values.dtype == np.float32
+    assert decode_matrices(encode_matrices([])) == []
+
+
+def test_codec_rejects_other_data():
+    with pytest.raises(ValueError):
+        decode_arrays(b'{"cpu": []}')
+
+
+def test_align_to_step():
+    start = datetime(2024, 1, 1, 12, 0, 7, 500000, tzinfo=dt_timezone.utc)
+    end = datetime(2024, 1, 1, 12, 9, 42, tzinfo=dt_timezone.utc)
+    assert plots.align_to_step(start, end, "30s") == (start.replace(second=0, microsecond=0), end.replace(second=30))
+    assert plots.align_to_step(start, end, "2m") == (start.replace(second=0, microsecond=0), end.replace(minute=8, second=0))
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("backend", ["locmem", "filebased"])
+def test_graph_queries_are_cached(monkeypatch, settings, tmp_path, violations, backend):
+    settings.CACHES = {"default": {
+        "BACKEND": f"django.core.cache.backends.{backend}.{'LocMemCache' if backend == 'locmem' else 'FileBasedCache'}",
+        "LOCATION": str(tmp_path),
+    }}
+    target = violations[0].target
+    prometheus = FakeUsagePrometheus([target])
+    monkeypatch.setattr(plots, "PROMETHEUS_CONNECTION", prometheus)
+
+    # a page loaded and refreshed a few seconds later, within the same step
+    end = datetime.fromtimestamp(1700000000 // 60 * 60 + 5, dt_timezone.utc)
+    expected = traces(plots.cpu_usage_figure(target.instance, end - timedelta(minutes=30), end, step="1m", username=target.username))
+    assert len(prometheus.queries) == 3
+
+    monkeypatch.setattr(plots, "PROMETHEUS_CONNECTION", NoPrometheus())
+    later = end + timedelta(seconds=20)
+    assert traces(plots.cpu_usage_figure(target.instance, later - timedelta(minutes=30), later, step="1m", username=target.username)) == expected
+
+
+def test_recent_graphs_are_cached_briefly():
+    now = datetime.now(dt_timezone.utc)
+    assert plots._graph_cache_ttl(now) == plots.ARBITER_GRAPH_CACHE_TTL
+    assert plots._graph_cache_ttl(now - timedelta(hours=1)) == plots.ARBITER_GRAPH_CACHE_HISTORICAL_TTL
@@ -0,0 +1,107 @@
+import re
+
+import numpy as np
+import pytest
+
+from arbiter3.arbiter import eval, inventory, snapshot
+from arbiter3.arbiter.eval import evaluate
+from arbiter3.arbiter.inventory import HOST_INVENTORY
+from arbiter3.arbiter.models import Violation
+from arbiter3.arbiter.promclient import Matrix, Series
+from arbiter3.arbiter.window import SeriesWindow, WindowEngine
+
+from testing.conftest import BYTES_PER_GIB
+from testing.util import FakePrometheus, AsyncPrometheus, fake_set_property
+
+
+HOSTS = ["node0", "node1"]
+USERS = 4
+
+
+def labels(host: str, user: int) -> dict[str, str]:
+    return {
+        "__name__": "ignored",
+        "cgroup": f"/user.slice/user-{2000 + user}.slice",
+        "instance": f"{host}:2112",
+        "username": f"user-{2000 + user}",
+        "job": "cgroup-warden",
+    }
+
+
+def cpu_rate(user: int) -> float:
+    # users 2 and 3 are over the 0.9 core threshold of the short policies
+    return 0.5 * user
+
+
+def mem_usage(user: int) -> float:
+    # user 0 is over the 0.75 GiB threshold of the short policies
+    return BYTES_PER_GIB if user == 0 else 0.1 * BYTES_PER_GIB
+
+
+class RawUsagePrometheus(FakePrometheus):
+    """
+    Answers range selectors of the usage metrics with a sample per second per
+    user and host, so usage is the same however it is sampled.
+    """
+
+    def __init__(self):
+        super().__init__(HOSTS)
+        self.ranges = []
+
+    def query(self, query, time=None, timeout=None, columnar=False):
+        if not (match := re.match(r"(cgroup_warden_\w+)\{.*\}\[(\d+)s\]$", query)):
+            return super().query(query, time, timeout, columnar)
+        self.queries.append(query)
+        metric, seconds = match.group(1), int(match.group(2))
+        self.ranges.append(seconds)
+        times = np.arange(np.floor(time) - seconds + 1, np.floor(time) + 1)
+        matrices = []
+        for host in HOSTS:
+            for user in range(USERS):
+                values = cpu_rate(user) * times if "cpu" in metric else np.full(len(times), mem_usage(user))
+                matrices.append(Matrix(labels(host, user), [Series(t, str(v)) for t, v in zip(times.tolist(), values.tolist())]))
+        return matrices
+
+
+def test_series_window_keeps_the_span_across_additions():
+    window = SeriesWindow(capacity=4, span=60)
+    metric = {"instance": "node0:2112"}
+    times = np.arange(0.0, 100.0)
+    # a counter reset at t=50, after which the counter restarts from zero
+    values = np.where(times < 50, times * 2, (times - 50) * 2)
+
+    for start in range(0, 100, 10):
+        window.add([Matrix(metric, [Series(t, str(v)) for t, v in zip(times[start:start + 15], values[start:start + 15])])])
+
+    assert window.capacity >= 60
+    # 40..49 and 50..99 count up by 2 a second, and the reset to 0 at 50 is not a decrease
+    assert window.rate(39, 99) == pytest.approx([(2 * 9 + 2 * 49) / 59])
+    assert window.average(89, 99) == pytest.approx([np.mean(values[90:100])])
+    assert np.isnan(window.rate(98.5, 99)).all()
+
+    window.evict(before=100)
+    assert len(window) == 0
+
+
+@pytest.mark.django_db
+def test_window_engine_fetches_only_new_samples(monkeypatch, short_low_harsh_policy, base_soft_policy):
+    prometheus = RawUsagePrometheus()
+    monkeypatch.setattr(eval, "PROMETHEUS_CONNECTION", prometheus)
+    monkeypatch.setattr(eval, "PROMETHEUS_ASYNC_CONNECTION", AsyncPrometheus(prometheus))
+    monkeypatch.setattr(snapshot, "PROMETHEUS_ASYNC_CONNECTION", AsyncPrometheus(prometheus))
+    monkeypatch.setattr(inventory, "PROMETHEUS_CONNECTION", prometheus)
+    monkeypatch.setattr(HOST_INVENTORY, "_refreshed", None)
+    monkeypatch.setattr(eval, "set_property", fake_set_property)
+
+    engine = WindowEngine("cgroup-warden")
+    evaluate([short_low_harsh_policy, base_soft_policy], engine=engine)
+    evaluate([short_low_harsh_policy, base_soft_policy], engine=engine)
+
+    # the first cycle fetches the whole window, the next only what was scraped since
+    first, second = prometheus.ranges[:2], prometheus.ranges[2:]
+    assert min(first) > max(second)
+    assert len(engine.cpu) == len(engine.mem) == len(HOSTS) * USERS
+
+    violating = set(Violation.objects.filter(policy=short_low_harsh_policy).values_list("target__username", flat=True))
+    assert violating == {"user-2000", "user-2002", "user-2003"}
+    assert Violation.objects.filter(policy=base_soft_policy).count() == len(HOSTS) * USERS
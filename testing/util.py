@@ -4,6 +4,7 @@ import math
 import django
 import multiprocessing
 import re
+from collections import Counter
 
 from arbiter3.arbiter.models import Target, Policy, Violation
 from arbiter3.arbiter.conf import WARDEN_USE_TLS, WARDEN_PORT, WARDEN_BEARER, WARDEN_VERIFY_SSL
@@ -155,3 +156,61 @@ def duration(policy):
         return 6
     else:
         return int(policy.penalty_duration.total_seconds()) + 1
+
+
+class FakePrometheus:
+    """
+    Stands in for PROMETHEUS_CONNECTION. `up` queries return every host in
+    `hosts` as up, any other query returns `results`.
+    """
+
+    def __init__(self, hosts: list[str], results: list = None):
+        self.hosts = hosts
+        self.results = results or []
+        self.queries = []
+        self.times = []
+        self.transfer = Counter()
+
+    def query(self, query, time=None, timeout=None, columnar=False):
+        from arbiter3.arbiter.promclient import Vector, Series
+
+        self.queries.append(query)
+        self.times.append(time)
+        if query.startswith("up"):
+            return [Vector({"instance": f"{host}:2112", "job": "cgroup-warden"}, Series(0, "1")) for host in self.hosts]
+        # a combined policy query answers for each of its policies
+        if policies := re.findall(r'"arbiter_policy", "(\d+)"', query):
+            return [Vector({**r.metric, "arbiter_policy": pk}, r.value) for pk in policies for r in self.results]
+        return self.results
+
+
+class AsyncPrometheus:
+    """
+    Serves a fake prometheus to code using PROMETHEUS_ASYNC_CONNECTION.
+    """
+
+    def __init__(self, prometheus):
+        self.prometheus = prometheus
+        self.transfer = Counter()
+
+    async def query(self, *args, **kwargs):
+        return self.prometheus.query(*args, **kwargs)
+
+    async def query_range(self, *args, **kwargs):
+        return self.prometheus.query_range(*args, **kwargs)
+
+
+def usage_vector(target: Target, value: float = 1.0):
+    from arbiter3.arbiter.promclient import Vector, Series
+
+    metric = {
+        "cgroup": f"/user.slice/{target.unit}",
+        "instance": f"{target.host}:2112",
+        "username": target.username,
+        "job": "cgroup-warden",
+    }
+    return Vector(metric, Series(0, str(value)))
+
+
+async def fake_set_property(target: Target, name: str, value: any):
+    return 200, f'{{"property": {{"name": "{name}", "value": {value}}}}}'